@@ -11,22 +11,40 @@ import os
 import re
 import signal
 import sys
+import tempfile
 import traceback
 import urllib.parse
 import logging
 import logging.config
-import datetime
-import hashlib
+import time
 from importlib import reload
 from io import BytesIO
 from PIL import Image
 
-import requests
+import httpx
 from nio import AsyncClient, InviteEvent, JoinError, RoomMessageText, MatrixRoom, LoginError, RoomMemberEvent, \
-    RoomVisibility, RoomPreset, RoomCreateError, RoomResolveAliasResponse, UploadError, UploadResponse, SyncError, \
-    RoomPutStateError
+    RoomVisibility, RoomPreset, RoomCreateError, RoomCreateResponse, RoomResolveAliasResponse, UploadError, UploadResponse, SyncError, \
+    RoomPutStateError, SyncResponse, UploadFilterResponse, ErrorResponse, Event
 
 from modules.common.exceptions import CommandRequiresAdmin, CommandRequiresOwner, UploadFailed
+from modules.common.directrooms import DirectRooms
+from modules.common.dispatcher import CommandDispatcher
+from modules.common.events import EventDispatcher
+from modules.common.httpclient import HttpClient
+from modules.common.imageinfo import HEADER_SIZE, image_size
+from modules.common.mediacache import MediaCache
+from modules.common.membership import MembershipIndex
+from modules.common.metrics import Metrics
+from modules.common.module import BotModule
+from modules.common.moduleloader import UnloadedModule, discover_module
+from modules.common.scheduler import Scheduler
+from modules.common.sendqueue import SendQueue
+from modules.common.urlpreview import UrlPreviews
+from modules.common.watchdog import LoopWatchdog
+
+COMMAND_START = re.compile(r'!\w')
+NON_WORD = re.compile(r'\W+')
+
 
 class Bot:
 
@@ -34,23 +52,121 @@ class Bot:
         self.appid = 'org.vranki.hemppa'
         self.version = '1.5'
         self.client = None
+        self.http = None
         self.join_on_invite = False
         self.invite_whitelist = []
-        self.modules = dict()
+        self.modules = dict()  # Disabled modules are UnloadedModules until enabled
+        self.module_timings = dict()  # module name -> {'import': seconds, 'start': seconds}
         self.module_aliases = dict()
         self.leave_empty_rooms = True
-        self.uri_cache = dict()
-        self.pollcount = 0
-        self.poll_task = None
+        self.upload_slots = asyncio.Semaphore(int(os.getenv('UPLOAD_CONCURRENCY', '4')))
+        self.upload_max_size = int(float(os.getenv('UPLOAD_MAX_SIZE_MB', '50')) * 1024 * 1024)
+        self.upload_spool_size = 1024 * 1024  # Bigger downloads are buffered on disk
+        self.pending_thumbnails = dict()  # media cache key -> Task uploading the thumbnail
+        self.media_cache = MediaCache(max_entries=int(os.getenv('MEDIA_CACHE_SIZE', '1000')),
+                                      ttl=float(os.getenv('MEDIA_CACHE_TTL_DAYS', '30')) * 24 * 60 * 60)
+        self.url_previews = UrlPreviews(max_entries=int(os.getenv('URL_PREVIEW_CACHE_SIZE', '1000')),
+                                        ttl=float(os.getenv('URL_PREVIEW_TTL_HOURS', '24')) * 60 * 60,
+                                        concurrency=int(os.getenv('URL_PREVIEW_CONCURRENCY', '8')))
+        self.metrics = Metrics()
+        self.metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+        self.metrics_port = int(os.getenv('METRICS_PORT', '0'))  # 0 = don't serve metrics
+        watchdog_threshold = float(os.getenv('LOOP_WATCHDOG_THRESHOLD', '0'))  # Seconds, 0 = off
+        self.watchdog = LoopWatchdog(watchdog_threshold, metrics=self.metrics) if watchdog_threshold > 0 else None
+        self.scheduler = Scheduler(self.metrics)
+        self.events = EventDispatcher(self)  # Room events for modules, other than commands
+        self.direct_rooms = None  # DirectRooms, created when user is known
+        self.membership = MembershipIndex()  # Users in rooms the bot is in
+        self.send_queue = SendQueue(self.send_now,
+                                    rate=float(os.getenv('SEND_RATE', '5')),
+                                    burst=int(os.getenv('SEND_BURST', '10')),
+                                    concurrency=int(os.getenv('SEND_CONCURRENCY', '4')))
+        self.poll_interval = 10  # Seconds between matrix_poll calls
+        self.module_start_timeout = float(os.getenv('MODULE_START_TIMEOUT', '30'))  # Seconds, also for stopping
         self.owners = []
         self.debug = os.getenv("DEBUG", "false").lower() == "true"
         self.logger = None
 
-        self.jointime = None  # HACKHACKHACK to avoid running old commands after join
-        self.join_hack_time = 5  # Seconds
-
+        # Settings are written to account data behind the scenes, see save_settings()
+        self.settings_dirty = False
+        self.settings_dirty_since = None
+        self.settings_last_change = None
+        self.settings_save_task = None
+        self.settings_lock = asyncio.Lock()
+        self.saved_settings = dict()  # account data type -> json last written or read
+        self.settings_migration_pending = False  # True if settings still in the old single event
+
+        self.dispatcher = CommandDispatcher(self,
+                                            max_concurrent=int(os.getenv('COMMAND_CONCURRENCY', '16')),
+                                            module_concurrent=int(os.getenv('MODULE_COMMAND_CONCURRENCY', '4')),
+                                            timeout=float(os.getenv('COMMAND_TIMEOUT', '120')))
+        self.settings_save_delay = float(os.getenv('SETTINGS_SAVE_DELAY', '2'))  # Seconds
+        self.settings_save_max_delay = float(os.getenv('SETTINGS_SAVE_MAX_DELAY', '10'))  # Seconds
+
+        # Sync state is kept between restarts so that the bot doesn't need to load everything again
+        self.sync_token_file = os.getenv('SYNC_TOKEN_FILE', 'config/sync_token')
+        self.sync_token_save_interval = 60  # Seconds
+        self.sync_token_saved = None
+        self.sync_token_save_time = 0
+        self.lazy_load_members = os.getenv('SYNC_LAZY_LOAD_MEMBERS', 'false').lower() == 'true'
+        self.sync_timeline_types = ['m.room.*', 'im.vector.modular.widgets']  # Event types modules handle
+        # Events sent before the bot started or joined the room are not handled
+        self.start_timestamp = int(time.time() * 1000)
+        self.join_timestamps = dict()  # room id -> unix time in ms
+        self.last_sync_time = None
+
+        self.init_metrics()
         self.initialize_logger()
 
+    def init_metrics(self):
+        metrics = self.metrics
+        self.command_duration = metrics.histogram('hemppa_command_duration_seconds',
+                                                  'Time taken by commands', ['module', 'outcome'])
+        metrics.callback('hemppa_commands_running', 'Commands running or waiting to run', 'gauge',
+                         lambda: {('running',): self.dispatcher.in_flight, ('queued',): self.dispatcher.queued},
+                         ['state'])
+        metrics.callback('hemppa_commands_timed_out_total', 'Commands cancelled for taking too long', 'counter',
+                         lambda: self.dispatcher.timed_out)
+        self.room_send_duration = metrics.histogram('hemppa_room_send_duration_seconds',
+                                                    'Time from room_send until the message was sent, including queueing')
+        self.send_request_duration = metrics.histogram('hemppa_send_request_duration_seconds',
+                                                       'Time taken by the send request to the homeserver')
+        metrics.callback('hemppa_send_queue_depth', 'Messages waiting to be sent', 'gauge',
+                         lambda: sum(len(queue) for queue in self.send_queue.rooms.values()))
+        metrics.callback('hemppa_send_queue_messages_total', 'Messages handled by the send queue', 'counter',
+                         lambda: {('sent',): self.send_queue.sent, ('failed',): self.send_queue.failed,
+                                  ('retried',): self.send_queue.retried},
+                         ['result'])
+        metrics.callback('hemppa_rate_limited_total', 'Times the homeserver said the bot sends too fast', 'counter',
+                         lambda: self.send_queue.rate_limits)
+        metrics.callback('hemppa_media_cache_lookups_total', 'Media cache lookups', 'counter',
+                         lambda: {('hit',): self.media_cache.hits, ('miss',): self.media_cache.misses,
+                                  ('deduplicated',): self.media_cache.deduplicated},
+                         ['result'])
+        metrics.callback('hemppa_media_cache_entries', 'Uploads in the media cache', 'gauge',
+                         lambda: len(self.media_cache.entries))
+        metrics.callback('hemppa_media_cache_removals_total', 'Uploads dropped from the media cache', 'counter',
+                         lambda: {('evicted',): self.media_cache.evictions, ('expired',): self.media_cache.expirations},
+                         ['reason'])
+        metrics.callback('hemppa_url_preview_lookups_total', 'Link preview lookups', 'counter',
+                         lambda: {('hit',): self.url_previews.hits, ('miss',): self.url_previews.misses,
+                                  ('coalesced',): self.url_previews.coalesced},
+                         ['result'])
+        metrics.callback('hemppa_url_preview_errors_total', 'Link previews that could not be fetched', 'counter',
+                         lambda: self.url_previews.errors)
+        self.account_data_writes = metrics.counter('hemppa_account_data_writes_total',
+                                                   'Account data writes', ['result'])
+        self.account_data_bytes = metrics.counter('hemppa_account_data_written_bytes_total',
+                                                  'Bytes of account data written')
+        self.event_handler_duration = metrics.histogram('hemppa_event_handler_duration_seconds',
+                                                        'Time taken by module event handlers', ['module'])
+        metrics.callback('hemppa_events_delivered_total', 'Room events delivered to module subscriptions', 'counter',
+                         lambda: self.events.delivered)
+        self.sync_interval = metrics.histogram('hemppa_sync_interval_seconds', 'Time between sync responses',
+                                               buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 120))
+        metrics.callback('hemppa_rooms', 'Rooms the bot is in', 'gauge',
+                         lambda: len(self.client.rooms) if self.client else 0)
+
     def initialize_logger(self):
 
         if os.path.exists('config/logging.yml'):
@@ -76,11 +192,9 @@ class Bot:
         :param blob: Flag to indicate if the second param is an url or a binary content
         :return: [matrix_uri, mimetype, w, h, size], or None
         """
-        cache_key = url
-        if blob:  ## url is bytes, cannot be used a key for cache
-            cache_key = hashlib.md5(url).hexdigest()
-
-        return self.uri_cache.get(cache_key)
+        if blob:  ## url is bytes, look up by content
+            return self.media_cache.get_by_hash(MediaCache.content_hash(url))
+        return self.media_cache.get(url)
 
 
     async def upload_and_send_image(self, room, url, event=None, text=None, blob=False, blob_content_type="image/png", no_cache=False):
@@ -98,15 +212,10 @@ class Bot:
         if not text and not blob:
             text = f"Image: {url}"
 
-        res = self.get_uri_cache(url, blob=blob)
-        if res:
-            try:
-                matrix_uri, mimetype, w, h, size = res
-                return await self.send_image(room, matrix_uri, text, event, mimetype, w, h, size)
-            except ValueError: # broken cache?
-                self.logger.warning(f"Image cache for {url} could not be unpacked, attempting to re-upload...")
+        # upload_image looks the image up from the uri cache, so a cache miss is counted once
         try:
-            matrix_uri, mimetype, w, h, size = await self.upload_image(url, blob=blob, no_cache=no_cache)
+            matrix_uri, mimetype, w, h, size = await self.upload_image(url, blob=blob, blob_content_type=blob_content_type,
+                                                                       no_cache=no_cache)
         except (UploadFailed, ValueError):
             return await self.send_text(room, f"Sorry. Something went wrong fetching {url} and uploading the image to matrix server :(", event=event)
 
@@ -115,6 +224,7 @@ class Bot:
     # Wrapper around matrix-nio's client.room_send
     # Use src_event context to modify the msg
     async def room_send(self, room_id, pre_event, msgtype, msg, **kwargs):
+        started = time.monotonic()
         if pre_event is None:
             self.logger.info(f'No pre-event passed. This module may not be set up to support m.thread.')
         try:
@@ -126,7 +236,22 @@ class Bot:
         except (AttributeError, KeyError):
             pass
 
-        return await self.client.room_send(room_id, msgtype, msg, **kwargs)
+        # Queued to keep the order of messages and to not send faster than server allows
+        response = await self.send_queue.send(room_id, msgtype, msg, **kwargs)
+        self.room_send_duration.observe(time.monotonic() - started)
+        return response
+
+    async def send_now(self, room_id, msgtype, msg, **kwargs):
+        started = time.monotonic()
+        try:
+            return await self.client.room_send(room_id, msgtype, msg, **kwargs)
+        finally:
+            self.send_request_duration.observe(time.monotonic() - started)
+
+    async def error_response_cb(self, response):
+        # nio retries rate limited requests itself, but the rest of the messages should wait too
+        if response.status_code == 'M_LIMIT_EXCEEDED':
+            self.send_queue.rate_limited(response.retry_after_ms)
 
     # Helper function to upload a image from URL to homeserver. Use send_image() to actually send it to room.
     # Throws exception if upload fails
@@ -135,47 +260,50 @@ class Bot:
         :param url_or_bytes: Url or binary content of the image to upload
         :param blob: Flag to indicate if the first param is an url or a binary content
         :param blob_content_type: Content type of the image in case of binary content
-        :param no_cache: Flag to indicate whether to cache the resulting uploaded details
+        :param no_cache: Don't use an earlier upload from the same url, the content may have changed.
+            Identical content is still uploaded only once.
         :return: A MXC-Uri https://matrix.org/docs/spec/client_server/r0.6.0#mxc-uri, Content type, Width, Height, Image size in bytes
         """
 
         self.client: AsyncClient
         response: UploadResponse
 
-        cache_key = url_or_bytes
-        if blob:  ## url is bytes, cannot be used a key for cache
-            cache_key = hashlib.md5(url_or_bytes).hexdigest()
-
-        if no_cache:
-            cache_key = None
-
-        if blob:
-            i = Image.open(BytesIO(url_or_bytes))
-            image_length = len(url_or_bytes)
-            content_type = blob_content_type
-            (response, alist) = await self.client.upload(lambda a, b: url_or_bytes, blob_content_type, filesize=image_length)
-        else:
-            self.logger.debug(f"start downloading image from url {url_or_bytes}")
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            url_response = requests.get(url_or_bytes, headers=headers)
-            self.logger.debug(f"response [status_code={url_response.status_code}, headers={url_response.headers}")
-
-            if url_response.status_code == 200:
-                content_type = url_response.headers.get("content-type")
-                self.logger.info(f"uploading content to matrix server [size={len(url_response.content)}, content-type: {content_type}]")
-                (response, alist) = await self.client.upload(lambda a, b: url_response.content, content_type)
-                self.logger.debug("response: %s", response)
-                i = Image.open(BytesIO(url_response.content))
-                image_length = len(url_response.content)
+        url = None if blob else url_or_bytes
+        if url and not no_cache:
+            res = self.media_cache.get(url)
+            if res:
+                return res
+
+        async with self.upload_slots:
+            if blob:
+                content_hash = MediaCache.content_hash(url_or_bytes)
+                res = self.media_cache.get_by_hash(content_hash)
+                if res:
+                    return res
+                width, height = await self.probe_image_size(url_or_bytes, BytesIO(url_or_bytes))
+                image_length = len(url_or_bytes)
+                content_type = blob_content_type
+                (response, alist) = await self.client.upload(lambda a, b: url_or_bytes, blob_content_type, filesize=image_length)
             else:
-                self.logger.error("unable to request url: %s", url_response)
-                raise UploadFailed
+                # Images can be big, so keep them in memory only up to a limit and in a temporary file after that
+                with tempfile.SpooledTemporaryFile(max_size=self.upload_spool_size) as spool:
+                    content_hash, header, image_length, content_type = await self.download_image(url, spool)
+                    res = self.media_cache.get_by_hash(content_hash)
+                    if res:
+                        self.logger.debug(f"same content already uploaded as {res[0]}")
+                        self.media_cache.add_alias(url, content_hash)
+                        self.save_settings()
+                        return res
+                    width, height = await self.probe_image_size(header, spool)
+                    self.logger.info(f"uploading content to matrix server [size={image_length}, content-type: {content_type}]")
+                    (response, alist) = await self.client.upload(lambda a, b: self.read_chunks(spool), content_type, filesize=image_length)
+                    self.logger.debug("response: %s", response)
 
         if isinstance(response, UploadResponse):
             self.logger.info("uploaded file to %s", response.content_uri)
-            res = [response.content_uri, content_type, i.size[0], i.size[1], image_length]
-            if cache_key:
-                self.uri_cache[cache_key] = res
+            res = [response.content_uri, content_type, width, height, image_length]
+            self.media_cache.put(content_hash, res, url=url)
+            self.save_settings()
             return res
         else:
             response: UploadError
@@ -183,6 +311,118 @@ class Bot:
 
         raise UploadFailed
 
+    async def upload_thumbnail(self, url, max_size=480):
+        """Upload a copy of the image at url scaled down to fit in max_size x max_size pixels
+
+        Thumbnails are kept in the uri cache like other uploads, so each is uploaded only once,
+        and asking for one that is already being uploaded waits for that upload.
+
+        :return: same as upload_image
+        """
+        key = f'thumbnail:{max_size}:{url}'
+        res = self.media_cache.get(key)
+        if res:
+            return res
+        task = self.pending_thumbnails.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self.make_thumbnail(url, max_size, key))
+            self.pending_thumbnails[key] = task
+            task.add_done_callback(lambda _: self.pending_thumbnails.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def make_thumbnail(self, url, max_size, key):
+        with tempfile.SpooledTemporaryFile(max_size=self.upload_spool_size) as spool:
+            async with self.upload_slots:
+                await self.download_image(url, spool)
+
+            def scale():
+                spool.seek(0)
+                image = Image.open(spool)
+                if max(image.size) <= max_size and image.format in ('JPEG', 'PNG'):
+                    spool.seek(0)
+                    return spool.read(), Image.MIME[image.format]
+                # Lets JPEG decoding skip pixels that would be scaled away anyway
+                image.draft('RGB', (max_size, max_size))
+                image.thumbnail((max_size, max_size))
+                output = BytesIO()
+                if image.mode in ('RGBA', 'LA', 'P'):
+                    image.save(output, 'PNG', optimize=True)
+                    return output.getvalue(), 'image/png'
+                image.convert('RGB').save(output, 'JPEG', quality=85)
+                return output.getvalue(), 'image/jpeg'
+
+            try:
+                data, content_type = await self.run_blocking(scale)
+            except Exception as e:
+                self.logger.error(f"unable to scale image from {url}: {e}")
+                raise UploadFailed
+        res = await self.upload_image(data, blob=True, blob_content_type=content_type)
+        self.media_cache.add_alias(key, MediaCache.content_hash(data))
+        self.save_settings()
+        return res
+
+    async def download_image(self, url, spool):
+        """Stream image from url to a file, hashing it on the way
+
+        :return: content hash, first bytes of the image, size in bytes, content type
+        """
+        self.logger.debug(f"start downloading image from url {url}")
+        hasher = MediaCache.hasher()
+        header = b''
+        size = 0
+        try:
+            async with self.http.stream('GET', url) as url_response:
+                self.logger.debug(f"response [status_code={url_response.status_code}, headers={url_response.headers}")
+                if url_response.status_code != 200:
+                    self.logger.error("unable to request url: %s", url_response)
+                    raise UploadFailed
+                if int(url_response.headers.get('content-length') or 0) > self.upload_max_size:
+                    self.logger.error(f"image at {url} is too big: {url_response.headers.get('content-length')} bytes")
+                    raise UploadFailed
+                content_type = url_response.headers.get("content-type")
+                async for chunk in url_response.aiter_bytes():
+                    size += len(chunk)
+                    if size > self.upload_max_size:
+                        self.logger.error(f"image at {url} is bigger than {self.upload_max_size} bytes")
+                        raise UploadFailed
+                    if len(header) < HEADER_SIZE:
+                        header += chunk[:HEADER_SIZE - len(header)]
+                    hasher.update(chunk)
+                    spool.write(chunk)
+        except httpx.HTTPError as e:
+            self.logger.error("unable to request url: %s", e)
+            raise UploadFailed
+        return hasher.hexdigest(), header, size, content_type
+
+    async def probe_image_size(self, header, image_file):
+        """Width and height of image, read from its header
+
+        :param header: first bytes of the image
+        :param image_file: the whole image as a file, used for formats not recognized from the header
+        """
+        size = image_size(header)
+        if size:
+            return size
+
+        def pil_image_size():
+            # Pillow reads only as much as it needs to find out the size
+            image_file.seek(0)
+            return Image.open(image_file).size
+
+        try:
+            return await self.run_blocking(pil_image_size)
+        except Exception as e:
+            self.logger.error(f"unable to read image size: {e}")
+            raise UploadFailed
+
+    async def read_chunks(self, image_file, chunk_size=64 * 1024):
+        image_file.seek(0)
+        while True:
+            chunk = image_file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
     async def send_text(self, room, body, event=None, msgtype="m.notice", bot_ignore=False):
         """
 
@@ -316,25 +556,28 @@ class Bot:
         return True
 
     async def find_or_create_private_msg(self, mxid, roomname):
-        # Find if we already have a common room with user:
-        msg_room = None
-        for croomid in self.client.rooms:
-            roomobj = self.client.rooms[croomid]
-            if len(roomobj.users) == 2:
-                for user in roomobj.users:
-                    if user == mxid:
-                        msg_room = roomobj
-
-        # Nope, let's create one
-        if not msg_room:
+        """
+        :param mxid: A Matrix user id
+        :param roomname: Name for the room, if it needs to be created
+        :return: MatrixRoom with only the bot and the user, RoomCreateResponse of a new room or RoomCreateError
+        """
+        async with self.direct_rooms.lock(mxid):
+            # Find if we already have a common room with user:
+            room_id = self.direct_rooms.find(mxid, self.client.rooms)
+            if room_id:
+                return self.client.rooms.get(room_id) or MatrixRoom(room_id, self.matrix_user)
+
+            # Nope, let's create one
             msg_room = await self.client.room_create(visibility=RoomVisibility.private,
                 name=roomname,
                 is_direct=True,
                 preset=RoomPreset.private_chat,
                 invite={mxid},
             )
-        return msg_room
-
+            if isinstance(msg_room, RoomCreateResponse):
+                # Room shows up in client.rooms on next sync, until that find it from here
+                self.direct_rooms.add(mxid, msg_room.room_id)
+            return msg_room
 
     def remove_callback(self, callback):
         for cb_object in self.client.event_callbacks:
@@ -381,23 +624,154 @@ class Bot:
     def should_ignore_event(self, event):
         return "org.vranki.hemppa.ignore" in event.source['content']
 
+    # Returns true if the event was sent before bot started or joined the room, so it has been handled already or is history
+    def is_old_event(self, room, event):
+        return event.server_timestamp < max(self.start_timestamp, self.join_timestamps.get(room.room_id, 0))
+
     def save_settings(self):
+        """Mark settings as changed. They are written to account data in the background.
+
+        Bursts of calls are coalesced into one write which happens when settings have
+        not changed for settings_save_delay seconds, but at latest settings_save_max_delay
+        seconds after the first unsaved change. Use flush_settings() to write immediately.
+
+        Each module's settings are stored in their own account data event and only
+        modules whose settings have changed since last write are written.
+        """
+        now = time.monotonic()
+        self.settings_last_change = now
+        if not self.settings_dirty:
+            self.settings_dirty = True
+            self.settings_dirty_since = now
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not running yet, changes are written on next flush
+            return
+        if not self.settings_save_task or self.settings_save_task.done():
+            self.settings_save_task = loop.create_task(self.settings_writer())
+
+    def settings_type(self, modulename):
+        """Account data event type the settings of given module are stored in"""
+        return f'{self.appid}.module.{modulename}'
+
+    def uri_cache_type(self):
+        return f'{self.appid}.uri_cache'
+
+    def collect_settings(self):
         module_settings = dict()
         for modulename, moduleobject in self.modules.items():
             try:
                 module_settings[modulename] = moduleobject.get_settings()
             except Exception:
                 self.logger.exception(f'unhandled exception {modulename}.get_settings')
-        data = {self.appid: self.version, 'module_settings': module_settings, 'uri_cache': self.uri_cache}
-        self.set_account_data(data)
+        return {self.appid: self.version, 'module_settings': module_settings, 'uri_cache': self.media_cache.to_json()}
+
+    def changed_settings(self):
+        """Serialize settings and return the ones that differ from what is in account data
+
+        :return: dict of account data type -> json payload
+        """
+        data = self.collect_settings()
+        shards = {self.settings_type(modulename): settings for modulename, settings in data['module_settings'].items()}
+        shards[self.uri_cache_type()] = data['uri_cache']
+
+        changed = dict()
+        for data_type, settings in shards.items():
+            payload = json.dumps(settings)
+            if self.saved_settings.get(data_type) != payload:
+                changed[data_type] = payload
+        return changed
+
+    async def settings_writer(self):
+        while self.settings_dirty:
+            deadline = min(self.settings_last_change + self.settings_save_delay,
+                           self.settings_dirty_since + self.settings_save_max_delay)
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if not await self.flush_settings():
+                # Try again later, keeping the already pending changes
+                await asyncio.sleep(self.settings_save_max_delay)
+
+    async def flush_settings(self):
+        """Write pending settings changes to account data now
+
+        :return bool: False if writing failed and settings are still unsaved
+        """
+        async with self.settings_lock:
+            if not self.settings_dirty:
+                return True
+            self.settings_dirty = False
+            # Serialize here so modules can't change settings while the write is in progress
+            changed = self.changed_settings()
+            try:
+                results = await asyncio.gather(*[self.put_account_data(payload, data_type)
+                                                 for data_type, payload in changed.items()])
+            except asyncio.CancelledError:
+                # Writes may not have finished, keep the changes pending for the next flush
+                self.mark_settings_unsaved()
+                raise
+            success = True
+            for (data_type, payload), result in zip(changed.items(), results):
+                if result:
+                    self.saved_settings[data_type] = payload
+                else:
+                    success = False
+            if success and self.settings_migration_pending:
+                # Everything is now in per-module events, drop settings from the old one
+                marker = json.dumps({self.appid: self.version})
+                success = await self.put_account_data(marker)
+                self.settings_migration_pending = not success
+            if success:
+                if changed:
+                    self.logger.debug(f'Saved settings: {", ".join(changed)}')
+                return True
+            self.mark_settings_unsaved()
+            return False
+
+    def mark_settings_unsaved(self):
+        if not self.settings_dirty:
+            self.settings_dirty = True
+            self.settings_dirty_since = self.settings_last_change = time.monotonic()
+
+    async def fetch_settings(self):
+        """Read settings of all modules from account data, fetching the events concurrently
+
+        Settings saved by older versions in a single account data event are migrated
+        to per-module events on next save.
+
+        :return: dict in same format as collect_settings()
+        """
+        data_types = [self.appid, self.uri_cache_type()] + [self.settings_type(modulename) for modulename in self.modules]
+        results = await asyncio.gather(*[self.get_account_data(data_type) for data_type in data_types])
+        shards = dict(zip(data_types, results))
+
+        legacy = shards.pop(self.appid) or dict()
+        if legacy.get('module_settings'):
+            self.logger.info('Found settings in old single account data event, moving them to per-module events')
+            self.settings_migration_pending = True
+            self.save_settings()
+            return legacy
+
+        for data_type, settings in shards.items():
+            if settings is not None:
+                self.saved_settings[data_type] = json.dumps(settings)
+        module_settings = dict()
+        for modulename in self.modules:
+            settings = shards.get(self.settings_type(modulename))
+            if settings is not None:
+                module_settings[modulename] = settings
+        return {self.appid: self.version, 'module_settings': module_settings, 'uri_cache': shards[self.uri_cache_type()] or dict()}
 
     def load_settings(self, data):
         if not data:
             return
+        if data.get('uri_cache'):
+            self.media_cache.load(data['uri_cache'])
         if not data.get('module_settings'):
             return
-        if data.get('uri_cache'):
-            self.uri_cache = data['uri_cache']
         for modulename, moduleobject in self.modules.items():
             if data['module_settings'].get(modulename):
                 try:
@@ -423,42 +797,66 @@ class Bot:
             await self.send_text(room, "Sorry, only bot owner can run commands.", event=event)
             return
 
-        # HACK to ignore messages for some time after joining.
-        if self.jointime:
-            if (datetime.datetime.now() - self.jointime).seconds < self.join_hack_time:
-                self.logger.info(f"Waiting for join delay, ignoring message: {body}")
-                return
-            self.jointime = None
-
-        command = body.split().pop(0)
+        if self.is_old_event(room, event):
+            self.logger.info(f"Ignoring old message: {body}")
+            return
 
-        # Strip away non-alphanumeric characters, including leading ! for security
-        command = re.sub(r'\W+', '', command)
+        command = self.command_name(body)
 
         # Fallback to any declared aliases
         moduleobject = self.modules.get(command) or self.modules.get(self.module_aliases.get(command))
 
         if moduleobject is not None:
             if moduleobject.enabled:
-                try:
-                    await moduleobject.matrix_message(self, room, event)
-                except CommandRequiresAdmin:
-                    await self.send_text(room, f'Sorry, you need admin power level in this room to run that command.', event=event)
-                except CommandRequiresOwner:
-                    await self.send_text(room, f'Sorry, only bot owner can run that command.', event=event)
-                except Exception:
-                    await self.send_text(room, f'Module {command} experienced difficulty: {sys.exc_info()[0]} - see log for details', event=event)
-                    self.logger.exception(f'unhandled exception in !{command}')
+                # Don't wait for the command here, so that other events are handled meanwhile
+                self.dispatcher.dispatch(moduleobject, command, room, event)
         else:
             self.logger.error(f"Unknown command: {command}")
             # TODO Make this configurable
             # await self.send_text(room,
             #                     f"Sorry. I don't know what to do. Execute !help to get a list of available commands.")
 
+    async def run_command(self, moduleobject, command, room, event):
+        started = time.monotonic()
+        outcome = 'cancelled'
+        try:
+            await moduleobject.matrix_message(self, room, event)
+            outcome = 'ok'
+        except CommandRequiresAdmin:
+            outcome = 'denied'
+            await self.send_text(room, f'Sorry, you need admin power level in this room to run that command.', event=event)
+        except CommandRequiresOwner:
+            outcome = 'denied'
+            await self.send_text(room, f'Sorry, only bot owner can run that command.', event=event)
+        except Exception:
+            outcome = 'error'
+            await self.send_text(room, f'Module {command} experienced difficulty: {sys.exc_info()[0]} - see log for details', event=event)
+            self.logger.exception(f'unhandled exception in !{command}')
+        finally:
+            self.command_duration.observe(time.monotonic() - started, moduleobject.name, outcome)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Run a blocking function in a worker thread so that it doesn't stop the bot
+
+        Use this for libraries doing network requests or other slow work without asyncio support.
+        Cancelling the caller, e.g. when a command times out, doesn't stop the function, which
+        runs to the end in its thread.
+
+        :param func: the function to call
+        :return: what the function returned
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
     @staticmethod
     def starts_with_command(body):
         """Checks if body starts with ! and has one or more letters after it"""
-        return re.match(r"^!\w.*", body) is not None
+        return COMMAND_START.match(body) is not None
+
+    @staticmethod
+    def command_name(body):
+        """First word of body with non-alphanumeric characters, including leading !, stripped away for security"""
+        return NON_WORD.sub('', body.split(None, 1)[0])
     
     def on_invite_whitelist(self, sender):
         for entry in self.invite_whitelist:
@@ -480,7 +878,7 @@ class Bot:
 
         if self.join_on_invite or self.is_owner(event):
             for attempt in range(3):
-                self.jointime = datetime.datetime.now()
+                self.join_timestamps[room.room_id] = int(time.time() * 1000)
                 result = await self.client.join(room.room_id)
                 if type(result) == JoinError:
                     self.logger.error(f"Error joining room %s (attempt %d): %s", room.room_id, attempt, result.message)
@@ -499,66 +897,139 @@ class Bot:
     def load_module(self, modulename):
         try:
             self.logger.info(f'Loading module: {modulename}..')
+            started = time.monotonic()
             module = importlib.import_module('modules.' + modulename)
             module = reload(module)
             cls = getattr(module, 'MatrixModule')
-            return cls(modulename)
+            moduleobject = cls(modulename)
+            self.module_timings.setdefault(modulename, dict())['import'] = time.monotonic() - started
+            return moduleobject
         except Exception:
             self.logger.exception(f'Module {modulename} failed to load')
             return None
 
+    def import_module(self, modulename):
+        """Import a module that was found by get_modules() but not imported yet, giving it its settings
+
+        :return: the module object, or None if it failed to load
+        """
+        moduleobject = self.modules.get(modulename)
+        if not isinstance(moduleobject, UnloadedModule):
+            return moduleobject
+        loaded = self.load_module(modulename)
+        if not loaded:
+            return None
+        if moduleobject.settings:
+            try:
+                loaded.set_settings(moduleobject.settings)
+            except Exception:
+                self.logger.exception(f'unhandled exception {modulename}.set_settings')
+        self.modules[modulename] = loaded
+        return loaded
+
     def reload_modules(self):
-        for modulename in self.modules:
+        data = self.collect_settings()
+        for modulename, moduleobject in self.modules.items():
+            if isinstance(moduleobject, UnloadedModule):
+                continue
             self.logger.info(f'Reloading {modulename} ..')
             self.modules[modulename] = self.load_module(modulename)
 
-        self.load_settings(self.get_account_data())
+        self.load_settings(data)
 
     def get_modules(self):
+        """Find modules without importing them, they are imported when started"""
         modulefiles = glob.glob('./modules/*.py')
 
         for modulefile in modulefiles:
-            modulename = os.path.splitext(os.path.basename(modulefile))[0]
-            moduleobject = self.load_module(modulename)
-            if moduleobject:
-                self.modules[modulename] = moduleobject
+            moduleobject = discover_module(modulefile)
+            self.modules[moduleobject.name] = moduleobject
 
     def clear_modules(self):
         self.modules = dict()
 
-    async def poll_timer(self):
-        while True:
-            self.pollcount = self.pollcount + 1
-            for modulename, moduleobject in self.modules.items():
-                if moduleobject.enabled:
-                    try:
-                        await moduleobject.matrix_poll(self, self.pollcount)
-                    except Exception:
-                        self.logger.exception(f'unhandled exception from {modulename}.matrix_poll')
-            await asyncio.sleep(10)
-
-    def set_account_data(self, data):
+    async def start_module(self, moduleobject):
+        """Start an enabled module and schedule its matrix_poll, if it has one
+
+        :return: True if the module started, False if starting it failed or timed out
+        """
+        timing = self.module_timings.setdefault(moduleobject.name, dict())
+        timing.pop('error', None)
+        started = time.monotonic()
+        try:
+            moduleobject.matrix_start(self)
+            await asyncio.wait_for(moduleobject.matrix_start_async(self), self.module_start_timeout)
+        except asyncio.TimeoutError:
+            timing['error'] = f'start timed out after {self.module_start_timeout:g}s'
+            self.logger.error(f'{moduleobject.name} did not start in {self.module_start_timeout:g} seconds')
+            return False
+        except Exception:
+            timing['error'] = 'start failed'
+            self.logger.exception(f'unhandled exception from {moduleobject.name}.matrix_start')
+            return False
+        finally:
+            timing['start'] = time.monotonic() - started
+        if type(moduleobject).matrix_poll is not BotModule.matrix_poll:
+            pollcount = 0
+
+            async def poll():
+                nonlocal pollcount
+                pollcount = pollcount + 1
+                await moduleobject.matrix_poll(self, pollcount)
+
+            self.scheduler.add_job(f'{moduleobject.name}.matrix_poll', poll, interval=self.poll_interval, run_now=True)
+        return True
+
+    async def stop_module(self, moduleobject):
+        try:
+            moduleobject.matrix_stop(self)
+            await asyncio.wait_for(moduleobject.matrix_stop_async(self), self.module_start_timeout)
+        except asyncio.TimeoutError:
+            self.logger.error(f'{moduleobject.name} did not stop in {self.module_start_timeout:g} seconds')
+        except Exception:
+            self.logger.exception(f'unhandled exception from {moduleobject.name}.matrix_stop')
+
+    async def set_account_data(self, data, data_type=None):
+        return await self.put_account_data(json.dumps(data), data_type)
+
+    def account_data_url(self, data_type):
         userid = urllib.parse.quote(self.matrix_user)
+        return f"{self.client.homeserver}/_matrix/client/r0/user/{userid}/account_data/{data_type}"
 
-        ad_url = f"{self.client.homeserver}/_matrix/client/r0/user/{userid}/account_data/{self.appid}?access_token={self.client.access_token}"
+    async def put_account_data(self, payload, data_type=None):
+        data_type = data_type or self.appid
 
-        response = requests.put(ad_url, json.dumps(data))
+        try:
+            response = await self.http.put(self.account_data_url(data_type), content=payload,
+                                           headers={'Authorization': f'Bearer {self.client.access_token}'})
+        except httpx.HTTPError as e:
+            self.account_data_writes.inc('error')
+            self.logger.error('Setting account data %s failed: %s', data_type, e)
+            return False
         self.__handle_error_response(response)
 
         if response.status_code != 200:
-            self.logger.error('Setting account data failed. response: %s json: %s', response, response.json())
-
-    def get_account_data(self):
-        userid = urllib.parse.quote(self.matrix_user)
+            self.account_data_writes.inc('error')
+            self.logger.error('Setting account data %s failed. response: %s json: %s', data_type, response, response.text)
+            return False
+        self.account_data_writes.inc('ok')
+        self.account_data_bytes.inc(amount=len(payload))
+        return True
 
-        ad_url = f"{self.client.homeserver}/_matrix/client/r0/user/{userid}/account_data/{self.appid}?access_token={self.client.access_token}"
+    async def get_account_data(self, data_type=None):
+        legacy = data_type is None
+        data_type = data_type or self.appid
 
-        response = requests.get(ad_url)
+        response = await self.http.get(self.account_data_url(data_type),
+                                       headers={'Authorization': f'Bearer {self.client.access_token}'})
         self.__handle_error_response(response)
 
         if response.status_code == 200:
             return response.json()
-        self.logger.error(f'Getting account data failed: {response} {response.json()} - this is normal if you have not saved any settings yet.')
+        if response.status_code == 404 and not legacy:
+            self.logger.debug(f'No account data {data_type} saved yet')
+            return None
+        self.logger.error(f'Getting account data {data_type} failed: {response} {response.text} - this is normal if you have not saved any settings yet.')
         return None
 
     def __handle_error_response(self, response):
@@ -580,10 +1051,15 @@ class Bot:
         if matrix_server and self.matrix_user and bot_owners and access_token:
             self.client = AsyncClient(matrix_server, self.matrix_user, ssl = matrix_server.startswith("https://"))
             self.client.access_token = access_token
+            self.http = HttpClient(f"Mozilla/5.0 (compatible; Hemppa/{self.version}; +https://github.com/vranki/hemppa/)",
+                                   timeout=float(os.getenv('HTTP_TIMEOUT', '30')),
+                                   max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', '100')),
+                                   max_connections_per_host=int(os.getenv('HTTP_MAX_CONNECTIONS_PER_HOST', '8')))
             self.join_on_invite = (join_on_invite or '').lower() == 'true'
             self.invite_whitelist = invite_whitelist.split(',') if invite_whitelist is not None else []
             self.leave_empty_rooms = (leave_empty_rooms or 'true').lower() == 'true'
             self.owners = bot_owners.split(',')
+            self.direct_rooms = DirectRooms(self.matrix_user)
             self.owners_only = owners_only
             self.get_modules()
 
@@ -591,72 +1067,199 @@ class Bot:
             self.logger.error("The environment variables MATRIX_SERVER, MATRIX_USER, MATRIX_ACCESS_TOKEN and BOT_OWNERS are mandatory")
             sys.exit(1)
 
-    def start(self):
-        self.load_settings(self.get_account_data())
+    async def start(self):
+        """Start enabled modules. Their matrix_start_async run concurrently, a slow or failing one doesn't hold up others."""
         enabled_modules = [module for module_name, module in self.modules.items() if module.enabled]
         self.logger.info(f'Starting {len(enabled_modules)} modules..')
-        for modulename, moduleobject in self.modules.items():
-            if moduleobject.enabled:
-                try:
-                    moduleobject.matrix_start(self)
-                except Exception:
-                    self.logger.exception(f'unhandled exception from {modulename}.matrix_start')
-        self.logger.info(f'All modules started.')
-
-    def stop(self):
+        started = time.monotonic()
+        starting = []
+        for modulename in list(self.modules):
+            unloaded = self.modules[modulename]
+            if not unloaded.enabled:
+                continue
+            moduleobject = self.import_module(modulename)
+            if not moduleobject:
+                del self.modules[modulename]
+                continue
+            if not moduleobject.enabled:
+                # Enabled was guessed without importing, the module itself says it's disabled
+                self.logger.info(f'Module {modulename} is disabled, not starting it')
+                unloaded.enabled = False
+                self.modules[modulename] = unloaded
+                continue
+            starting.append(moduleobject)
+        results = await asyncio.gather(*[self.start_module(moduleobject) for moduleobject in starting])
+        failed = [moduleobject.name for moduleobject, result in zip(starting, results) if not result]
+        unloaded = sum(1 for module in self.modules.values() if isinstance(module, UnloadedModule))
+        self.logger.info(f'{len(starting) - len(failed)} modules started in {time.monotonic() - started:.2f}s, '
+                         f'{unloaded} disabled modules not imported. Slowest: {self.module_timing_summary(5)}')
+        if failed:
+            self.logger.error(f'Modules failed to start: {", ".join(failed)}')
+
+    def module_timing_summary(self, count):
+        timings = sorted(self.module_timings.items(), key=lambda item: -(item[1].get('import', 0) + item[1].get('start', 0)))[:count]
+        return ', '.join(f'{name} ({timing.get("import", 0):.2f}s import, {timing.get("start", 0):.2f}s start)'
+                         for name, timing in timings)
+
+    async def stop(self):
         self.logger.info(f'Stopping {len(self.modules)} modules..')
-        for modulename, moduleobject in self.modules.items():
-            try:
-                moduleobject.matrix_stop(self)
-            except Exception:
-                self.logger.exception(f'unhandled exception from {modulename}.matrix_stop')
+        await asyncio.gather(*[self.stop_module(moduleobject) for moduleobject in self.modules.values()])
         self.logger.info(f'All modules stopped.')
 
+    def sync_filter(self, timeline_limit=None):
+        """Sync filter asking the server only for what the bot uses"""
+        timeline = {'types': self.sync_timeline_types, 'lazy_load_members': self.lazy_load_members}
+        if timeline_limit:
+            timeline['limit'] = timeline_limit
+        return {
+            'presence': {'not_types': ['*']},
+            'account_data': {'types': ['m.direct']},
+            'room': {
+                'state': {'lazy_load_members': self.lazy_load_members},
+                'timeline': timeline,
+                'ephemeral': {'not_types': ['*']},
+                'account_data': {'not_types': ['*']},
+            },
+        }
+
+    async def upload_sync_filter(self):
+        """Store the sync filter on server, so it doesn't need to be sent with every sync
+
+        :return: filter id, or the filter itself if uploading failed
+        """
+        sync_filter = self.sync_filter()
+        response = await self.client.upload_filter(user_id=self.matrix_user, presence=sync_filter['presence'],
+                                                   account_data=sync_filter['account_data'], room=sync_filter['room'])
+        if isinstance(response, UploadFilterResponse):
+            return response.filter_id
+        self.logger.warning(f'Uploading sync filter failed: {response}')
+        return sync_filter
+
+    def load_sync_token(self):
+        if not self.sync_token_file:
+            return None
+        try:
+            with open(self.sync_token_file) as token_file:
+                return token_file.read().strip() or None
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.logger.warning(f'Could not read sync token from {self.sync_token_file}: {e}')
+            return None
+
+    def save_sync_token(self, token):
+        self.sync_token_save_time = time.monotonic()
+        if not self.sync_token_file or not token or token == self.sync_token_saved:
+            return
+        try:
+            with open(self.sync_token_file + '.tmp', 'w') as token_file:
+                token_file.write(token)
+            os.replace(self.sync_token_file + '.tmp', self.sync_token_file)
+            self.sync_token_saved = token
+        except OSError as e:
+            self.logger.warning(f'Could not save sync token to {self.sync_token_file}: {e}')
+
+    async def sync_cb(self, response):
+        now = time.monotonic()
+        if self.last_sync_time is not None:
+            self.sync_interval.observe(now - self.last_sync_time)
+        self.last_sync_time = now
+        self.direct_rooms.sync(response, self.client.rooms)
+        self.membership.sync(response, self.client.rooms)
+        if time.monotonic() - self.sync_token_save_time >= self.sync_token_save_interval:
+            self.save_sync_token(response.next_batch)
+
+    def add_callbacks(self):
+        """Start handling events from sync"""
+        self.client.add_event_callback(self.message_cb, RoomMessageText)
+        self.client.add_event_callback(self.events.event_cb, (Event,))
+        self.client.add_event_callback(self.invite_cb, (InviteEvent,))
+        self.client.add_event_callback(self.memberevent_cb, (RoomMemberEvent,))
+        self.client.add_response_callback(self.sync_cb, SyncResponse)
+
     async def run(self):
-        sync_response = await self.client.sync()
+        # nio doesn't keep room state between runs, so full state is needed even when
+        # continuing from saved token. Timeline of the first sync is not handled.
+        self.send_queue.start()
+        if self.watchdog:
+            self.watchdog.start()
+        if self.metrics_port:
+            try:
+                await self.metrics.start(self.metrics_host, self.metrics_port)
+            except OSError as e:
+                self.logger.error(f'Could not serve metrics on {self.metrics_host}:{self.metrics_port}: {e}')
+        self.client.add_response_callback(self.error_response_cb, ErrorResponse)
+        sync_token = self.load_sync_token()
+        first_sync_filter = self.sync_filter(timeline_limit=1)
+        sync_response = await self.client.sync(sync_filter=first_sync_filter, since=sync_token, full_state=True)
+        if type(sync_response) == SyncError and sync_token:
+            self.logger.warning(f'Sync from saved token failed ({sync_response.message}), doing initial sync')
+            sync_response = await self.client.sync(sync_filter=first_sync_filter, full_state=True)
         if type(sync_response) == SyncError:
             self.logger.error(f"Received Sync Error when trying to do initial sync! Error message is: %s", sync_response.message)
         else:
+            self.direct_rooms.rebuild(self.client.rooms)
+            self.direct_rooms.sync(sync_response, self.client.rooms)
+            self.membership.rebuild(self.client.rooms)
             for roomid, room in self.client.rooms.items():
-                self.logger.info(f"Bot is on '{room.display_name}'({roomid}) with {len(room.users)} users")
-                if len(room.users) == 1 and self.leave_empty_rooms:
+                self.logger.info(f"Bot is on '{room.display_name}'({roomid}) with {room.member_count} users")
+                # Not room.users, it's incomplete when members are lazy loaded
+                if room.member_count == 1 and self.leave_empty_rooms:
                     self.logger.info(f'Room {roomid} has no other users - leaving it.')
                     self.logger.info(await self.client.room_leave(roomid))
 
             if self.client.logged_in:
-                self.start()
-                self.poll_task = asyncio.get_event_loop().create_task(self.poll_timer())
-                self.load_settings(self.get_account_data())
-                self.client.add_event_callback(self.message_cb, RoomMessageText)
-                self.client.add_event_callback(self.invite_cb, (InviteEvent,))
-                self.client.add_event_callback(self.memberevent_cb, (RoomMemberEvent,))
+                settings = await self.fetch_settings()
+                self.load_settings(settings)
+                await self.start()
+                self.scheduler.start()
+                self.load_settings(settings)
+                self.add_callbacks()
+                sync_filter = await self.upload_sync_filter()
 
                 if self.join_on_invite:
                     self.logger.info('Note: Bot will join rooms if invited')
                 if len(self.invite_whitelist) > 0:
                     self.logger.info(f'Note: Bot will only join rooms when the inviting user is contained in {self.invite_whitelist}')
                 self.logger.info('Bot running as %s, owners %s', self.client.user, self.owners)
-                self.bot_task = asyncio.create_task(self.client.sync_forever(timeout=30000))
-                await self.bot_task
+                self.bot_task = asyncio.create_task(self.client.sync_forever(timeout=30000, sync_filter=sync_filter))
+                try:
+                    await self.bot_task
+                except asyncio.CancelledError:
+                    self.logger.info('Sync loop stopped')
             else:
                 self.logger.error('Client was not able to log in, check env variables!')
 
     async def shutdown(self):
+        self.scheduler.stop()
+        await self.stop()
+        await self.send_queue.stop()
+        if self.settings_save_task:
+            # A write in progress is cancelled too, its changes stay pending and are written below
+            self.settings_save_task.cancel()
+            try:
+                await self.settings_save_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush_settings()
+        self.save_sync_token(self.client.next_batch)
+        await self.metrics.stop()
+        if self.watchdog:
+            self.watchdog.stop()
         await self.close()
 
     async def close(self):
         try:
             await self.client.close()
+            await self.http.aclose()
             self.logger.info("Connection closed")
         except Exception as ex:
             self.logger.error("error while closing client: %s", ex)
 
     def handle_exit(self, signame, loop):
         self.logger.info(f"Received signal {signame}")
-        if self.poll_task:
-            self.poll_task.cancel()
+        self.scheduler.stop()
         self.bot_task.cancel()
-        self.stop()
 
 
 async def main():
@@ -674,7 +1277,8 @@ async def main():
     await bot.shutdown()
 
 
-try:
-    asyncio.run(main())
-except Exception as e:
-    traceback.print_exc(file=sys.stderr)
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
@@ -1,8 +1,8 @@
 import os
 import re
 import html
+import urllib.parse
 
-import requests
 from nio import AsyncClient, UploadError
 from nio import UploadResponse
 
@@ -37,7 +37,6 @@ class MatrixModule(BotModule):
         super().__init__(name)
         self.api_key = os.getenv("APOD_API_KEY", "DEMO_KEY")
         self.update_api_urls()
-        self.matrix_uri_cache = dict()
         self.APOD_DATE_PATTERN = r"^\d\d\d\d-\d\d-\d\d$"
 
     def update_api_urls(self):
@@ -81,7 +80,7 @@ class MatrixModule(BotModule):
 
     async def send_apod(self, bot, room, uri, set_room_avatar=False):
         self.logger.debug(f"send request using uri {uri}")
-        response = requests.get(uri)
+        response = await bot.http.get(uri)
 
         if response.status_code == 400:
             self.logger.error("unable to request apod api. status: %d text: %s", response.status_code, response.text)
@@ -99,14 +98,9 @@ class MatrixModule(BotModule):
 
         await bot.send_html(room, f"<b>{html.escape(apod.title)} ({html.escape(apod.date)})</b>", f"{apod.title} ({apod.date})")
         try:
-            matrix_uri = None
-            matrix_uri, mimetype, w, h, size = bot.get_uri_cache(apod.hdurl)
-        except (TypeError, ValueError):
-            self.logger.debug(f"Not found in cache: {apod.hdurl}")
-            try:
-                matrix_uri, mimetype, w, h, size = await bot.upload_image(apod.hdurl)
-            except (UploadFailed, TypeError, ValueError):
-                await bot.send_text(room, f"Something went wrong uploading {apod.hdurl}.")
+            matrix_uri, mimetype, w, h, size = await bot.upload_image(apod.hdurl)
+        except (UploadFailed, TypeError, ValueError):
+            return await bot.send_text(room, f"Something went wrong uploading {apod.hdurl}.")
         await bot.send_image(room, matrix_uri, apod.hdurl, None, mimetype, w, h, size)
         await bot.send_text(room, f"{apod.explanation}")
         if matrix_uri and set_room_avatar:
@@ -123,14 +117,11 @@ class MatrixModule(BotModule):
 
     def get_settings(self):
         data = super().get_settings()
-        data["matrix_uri_cache"] = self.matrix_uri_cache
         data["api_key"] = self.api_key
         return data
 
     def set_settings(self, data):
         super().set_settings(data)
-        if data.get("matrix_uri_cache"):
-            self.matrix_uri_cache = data["matrix_uri_cache"]
         if data.get("api_key"):
             self.api_key = data["api_key"]
             self.update_api_urls()
@@ -139,19 +130,25 @@ class MatrixModule(BotModule):
         return 'Sends latest Astronomy Picture of the Day to the room. (https://apod.nasa.gov/apod/astropix.html)'
 
     async def send_stats(self, bot, room):
-        msg = f"collected {len(self.matrix_uri_cache)} upload matrix uri's"
+        msg = f"uri cache: {bot.media_cache.stats()}"
         await bot.send_text(room, msg)
 
     async def clear_uri_cache(self, bot, room):
-        self.matrix_uri_cache.clear()
+        # The uri cache is shared by all modules, drop only the APOD images
+        count = bot.media_cache.remove_urls(self.is_apod_url)
         bot.save_settings()
-        await bot.send_text(room, "cleared uri cache")
+        await bot.send_text(room, f"cleared {count} APOD images from uri cache, use !bot uricache clear to clear all")
+
+    @staticmethod
+    def is_apod_url(url):
+        host = urllib.parse.urlsplit(url).hostname or ''
+        return host == 'nasa.gov' or host.endswith('.nasa.gov')
 
     async def command_help(self, bot, room):
         msg = """commands:
         - YYYY-MM-DD - date of the APOD image to retrieve (ex. 2020-03-15)
         - stats - show information about uri cache
-        - clear - clear uri cache (Must be done as owner)
+        - clear - clear APOD images from uri cache (Must be done as owner)
         - apikey [api-key] - set the nasa api key (Must be done as bot owner)
         - help - show command help
         - avatar, avatar YYYY-MM-DD - Additionally set the room's avatar to the fetched image (Must be done as admin)
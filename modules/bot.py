@@ -1,13 +1,19 @@
+import asyncio
 import collections
+import heapq
 import logging
 import json
-import requests
+import math
+import os
+import tempfile
 from html import escape
 from datetime import timedelta
 import time
 
 from nio import RoomCreateError
 from modules.common.module import BotModule, ModuleCannotBeDisabled
+from modules.common.moduleloader import UnloadedModule
+from modules.common.profiling import LoopProfiler, MemoryTracer, dump_path
 
 class LogDequeHandler(logging.Handler):
     def __init__(self, count):
@@ -16,10 +22,12 @@ class LogDequeHandler(logging.Handler):
         self.level = logging.INFO
 
     def emit(self, record):
+        # Records about a module logged from elsewhere, e.g. by the watchdog, name the module
+        key = str(getattr(record, 'hemppa_module', None) or record.module)
         try:
-            self.logs[str(record.module)].append(record)
+            self.logs[key].append(record)
         except:
-            self.logs[str(record.module)] = collections.deque([record], maxlen=15)
+            self.logs[key] = collections.deque([record], maxlen=15)
 
 class MatrixModule(BotModule):
 
@@ -27,6 +35,11 @@ class MatrixModule(BotModule):
         super().__init__(name)
         self.starttime = None
         self.can_be_disabled = False
+        self.profiler = LoopProfiler()
+        self.profile_task = None
+        self.max_profile_seconds = 600
+        self.memtracer = MemoryTracer()
+        self.profile_dir = os.getenv('PROFILE_DIR', tempfile.gettempdir())
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
@@ -35,6 +48,12 @@ class MatrixModule(BotModule):
         self.loghandler.setFormatter(logging.Formatter('%(levelname)s - %(name)s - %(message)s'))
         logging.root.addHandler(self.loghandler)
 
+    def matrix_stop(self, bot):
+        super().matrix_stop(bot)
+        if self.profile_task:
+            self.profile_task.cancel()
+        self.memtracer.stop()
+
     async def matrix_message(self, bot, room, event):
         args = event.body.split(None, 2)
 
@@ -59,6 +78,12 @@ class MatrixModule(BotModule):
                 await self.get_ping(bot, room, event)
             elif args[1] == 'rooms':
                 await self.rooms(bot, room, event)
+            elif args[1] == 'jobs':
+                await self.jobs(bot, room, event)
+            elif args[1] == 'profile':
+                await self.profile(bot, room, event, [])
+            elif args[1] == 'memtrace':
+                await self.memtrace(bot, room, event, [])
 
         elif len(args) == 3:
             if args[1] == 'enable':
@@ -73,6 +98,12 @@ class MatrixModule(BotModule):
                 await self.last_logs(bot, room, event, args[2])
             elif args[1] == 'uricache':
                 await self.manage_uri_cache(bot, room, event, args[2])
+            elif args[1] == 'modules' and args[2] == '--timing':
+                await self.show_modules(bot, room, timing=True)
+            elif args[1] == 'profile':
+                await self.profile(bot, room, event, args[2].split())
+            elif args[1] == 'memtrace':
+                await self.memtrace(bot, room, event, args[2].split())
         else:
             pass
 
@@ -90,9 +121,10 @@ class MatrixModule(BotModule):
 
         # ask the server what the timestamp was on our pong
         serv_delta = None
-        event_url = f'{bot.client.homeserver}/_matrix/client/r0/rooms/{room.room_id}/event/{pong.event_id}?access_token={bot.client.access_token}'
+        event_url = f'{bot.client.homeserver}/_matrix/client/r0/rooms/{room.room_id}/event/{pong.event_id}'
         try:
-            serv_delta = requests.get(event_url).json()['origin_server_ts'] - serv_before
+            response = await bot.http.get(event_url, headers={'Authorization': f'Bearer {bot.client.access_token}'})
+            serv_delta = response.json()['origin_server_ts'] - serv_before
             delta = f'server response in {local_delta}ms, event created in {serv_delta}ms'
         except Exception as e:
             self.logger.error(f"Failed getting server timestamp: {e}")
@@ -111,7 +143,7 @@ class MatrixModule(BotModule):
             'msgtype': 'm.notice',
             'body': delta
         }
-        await bot.client.room_send(room.room_id, 'm.room.message', content)
+        await bot.room_send(room.room_id, None, 'm.room.message', content)
 
     async def leave(self, bot, room, event):
         bot.must_be_admin(room, event)
@@ -120,28 +152,19 @@ class MatrixModule(BotModule):
         await bot.client.room_leave(room.room_id)
 
     async def stats(self, bot, room):
+        await bot.send_text(room, self.stats_text(bot))
+
+    def stats_text(self, bot):
         roomcount = len(bot.client.rooms)
-        homeservers = dict()
-        for croomid in bot.client.rooms:
-            try:
-                users = bot.client.rooms[croomid].users
-            except (KeyError, ValueError) as e:
-                self.logger.warning(f"Couldn't get user list in room with id {croomid}, skipping: {repr(e)}")
-                continue
-            for user in users:
-                user, hs = user.split(':', 1)
-                if homeservers.get(hs):
-                    homeservers[hs].add(user)
-                else:
-                    homeservers[hs] = {user}
-        homeservers = {k: len(v) for k, v in homeservers.items()}
-        usercount = sum(homeservers.values())
+        # Kept up to date from member events, no need to go through all rooms
+        homeservers = bot.membership.homeservers
+        usercount = len(bot.membership.users)
         hscount = len(homeservers)
-        homeservers = sorted(homeservers.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
-        homeservers = ', '.join(['{} ({} users, {:.1f}%)'.format(hs[0], hs[1], 100.0 * hs[1] / usercount)
-            for hs in homeservers[:10]])
-        await bot.send_text(room, f'I\'m seeing {usercount} users in {roomcount} rooms.'
-                f' Top ten homeservers (out of {hscount}): {homeservers}')
+        top = heapq.nlargest(10, homeservers.items(), key=lambda kv: (kv[1], kv[0]))
+        top = ', '.join(['{} ({} users, {:.1f}%)'.format(hs[0], hs[1], 100.0 * hs[1] / usercount)
+            for hs in top])
+        return f'I\'m seeing {usercount} users in {roomcount} rooms.' \
+               f' Top ten homeservers (out of {hscount}): {top}'
 
     async def status(self, bot, room):
         systime = time.time()
@@ -150,14 +173,18 @@ class MatrixModule(BotModule):
         enabled = sum(1 for module in bot.modules.values() if module.enabled)
 
         return await bot.send_text(room, f'Uptime: {uptime} - System time: {systime} '
-                f'- {enabled} modules enabled out of {len(bot.modules)} loaded.')
+                f'- {enabled} modules enabled out of {len(bot.modules)} loaded. '
+                f'Commands: {bot.dispatcher.status()}.\n'
+                f'Send queue: {bot.send_queue.status()}.\n'
+                f'Events: {bot.events.status()}.')
 
     async def reload(self, bot, room, event):
         bot.must_be_owner(event)
         msg = await bot.send_text(room, f'Reloading modules...')
-        bot.stop()
+        await bot.flush_settings()
+        await bot.stop()
         bot.reload_modules()
-        bot.start()
+        await bot.start()
         # update event
         content = {
             'm.new_content': {
@@ -171,7 +198,7 @@ class MatrixModule(BotModule):
             'msgtype': 'm.notice',
             'body': 'Modules reloaded!'
         }
-        await bot.client.room_send(room.room_id, 'm.room.message', content)
+        await bot.room_send(room.room_id, None, 'm.room.message', content)
 
     async def version(self, bot, room):
         await bot.send_text(room, f'Hemppa version {bot.version} - https://github.com/vranki/hemppa')
@@ -186,10 +213,13 @@ class MatrixModule(BotModule):
         bot.must_be_owner(event)
         self.logger.info(f"Asked to enable {module_name}")
         if bot.modules.get(module_name):
-            module = bot.modules.get(module_name)
+            module = bot.import_module(module_name)
+            if not module:
+                return await bot.send_text(room, f"Module {module_name} failed to load, see log for details")
             module.enable()
-            module.matrix_start(bot)
             bot.save_settings()
+            if not await bot.start_module(module):
+                return await bot.send_text(room, f"Module {module_name} enabled, but it failed to start. See log for details")
             return await bot.send_text(room, f"Module {module_name} enabled")
         return await bot.send_text(room, f"Module with name {module_name} not found. Execute !bot modules for a list of available modules")
 
@@ -204,21 +234,29 @@ class MatrixModule(BotModule):
                 return await bot.send_text(room, f"Module {module_name} cannot be disabled.")
             except Exception as e:
                 return await bot.send_text(room, f"Module {module_name} was not disabled: {repr(e)}")
-            module.matrix_stop(bot)
+            await bot.stop_module(module)
             bot.save_settings()
             return await bot.send_text(room, f"Module {module_name} disabled")
         return await bot.send_text(room, f"Module with name {module_name} not found. Execute !bot modules for a list of available modules")
 
-    async def show_modules(self, bot, room):
+    async def show_modules(self, bot, room, timing=False):
         modules_message = "Modules:\n"
         for modulename, module in collections.OrderedDict(sorted(bot.modules.items())).items():
             state = 'Enabled' if module.enabled else 'Disabled'
-            modules_message += f"{state}: {modulename} - {module.help()}\n"
+            if isinstance(module, UnloadedModule):
+                state += ' (not loaded)'
+            modules_message += f"{state}: {modulename} - {module.help()}"
+            if timing and modulename in bot.module_timings:
+                times = bot.module_timings[modulename]
+                modules_message += f" - import {times.get('import', 0):.3f}s, start {times.get('start', 0):.3f}s"
+                if times.get('error'):
+                    modules_message += f" ({times['error']})"
+            modules_message += "\n"
         await bot.send_text(room, modules_message)
 
     async def export_settings(self, bot, event, module_name=None):
         bot.must_be_owner(event)
-        data = bot.get_account_data()['module_settings']
+        data = bot.collect_settings()['module_settings']
         if module_name:
             data = data[module_name]
             self.logger.info(f"{event.sender} is exporting settings for module {module_name}")
@@ -230,12 +268,8 @@ class MatrixModule(BotModule):
         bot.must_be_owner(event)
 
         self.logger.info(f"{event.sender} is importing settings")
-        try:
-            account_data = bot.get_account_data()
-            child = account_data['module_settings']
-        except KeyError: # no data yet
-            account_data['module_settings'] = dict()
-            child = account_data['module_settings']
+        account_data = bot.collect_settings()
+        child = account_data['module_settings']
 
         key = None
         data = event.body.split(None, 2)[2]
@@ -290,15 +324,79 @@ class MatrixModule(BotModule):
         bot.must_be_owner(event)
         if action == 'view':
             self.logger.info(f"{event.sender} wants to see the uri cache")
-            msg = [f'uri cache size: {len(bot.uri_cache)}']
-            for key, val in bot.uri_cache.items():
-                msg.append('- ' + key + ': ' + val[0])
+            msg = [f'uri cache: {bot.media_cache.stats()}']
+            for entry in bot.media_cache.entries.values():
+                msg.append('- ' + (', '.join(entry['urls']) or 'uploaded data') + ': ' + entry['res'][0])
             return await bot.send_text(room, '\n'.join(msg))
         if action in ['clean', 'clear']:
             self.logger.info(f"{event.sender} wants to clear the uri cache")
-            bot.uri_cache = dict()
+            bot.media_cache.clear()
             bot.save_settings()
 
+    async def jobs(self, bot, room, event):
+        bot.must_be_owner(event)
+        jobs = bot.scheduler.status()
+        await bot.send_text(room, f'Scheduled jobs ({len(jobs)}):\n' + '\n'.join(jobs))
+
+    async def profile(self, bot, room, event, args):
+        bot.must_be_owner(event)
+        seconds = 10
+        dump = 'dump' in args
+        try:
+            seconds = float(next(arg for arg in args if arg != 'dump'))
+            if not math.isfinite(seconds) or seconds <= 0:
+                raise ValueError(seconds)
+            seconds = min(seconds, self.max_profile_seconds)
+        except StopIteration:
+            pass
+        except ValueError:
+            return await bot.send_text(room, 'Usage: !bot profile [seconds] [dump], seconds must be positive',
+                                       event=event)
+        if self.profile_task and not self.profile_task.done():
+            return await bot.send_text(room, 'Profiling is already running, wait for it to finish.', event=event)
+        self.logger.info(f'{event.sender} started profiling for {seconds:g} seconds')
+        self.profile_task = asyncio.get_running_loop().create_task(self.run_profile(bot, event.sender, seconds, dump))
+        await bot.send_text(room, f'Profiling for {seconds:g} seconds, I\'ll send the results to you privately.', event=event)
+
+    async def run_profile(self, bot, mxid, seconds, dump):
+        try:
+            profile = await self.profiler.run(seconds)
+            report = await bot.run_blocking(self.profiler.report, profile)
+            if dump:
+                path = dump_path(self.profile_dir, 'profile', 'prof')
+                await bot.run_blocking(profile.dump_stats, path)
+                report += f'\n\nProfile saved to {path}'
+            await bot.send_msg(mxid, f'Private message from {bot.matrix_user}',
+                               f'Event loop profile for {seconds:g} seconds:\n{report}')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception('Profiling failed')
+            await bot.send_msg(mxid, f'Private message from {bot.matrix_user}', 'Profiling failed, see log for details')
+
+    async def memtrace(self, bot, room, event, args):
+        bot.must_be_owner(event)
+        action = args[0] if args else 'snapshot'
+        if action not in ['start', 'snapshot', 'dump', 'stop']:
+            return await bot.send_text(room, 'Usage: !bot memtrace [start|snapshot|dump|stop]', event=event)
+        if action == 'stop':
+            self.memtracer.stop()
+            return await bot.send_text(room, 'Stopped tracing memory allocations.', event=event)
+        if action == 'start' or not self.memtracer.tracing:
+            self.memtracer.start()
+            self.logger.info(f'{event.sender} started tracing memory allocations')
+            return await bot.send_text(room, 'Started tracing memory allocations. This slows down the bot a bit. '
+                                       'Run !bot memtrace again later to see where memory goes, '
+                                       'and !bot memtrace stop when done.', event=event)
+
+        snapshot, previous = await bot.run_blocking(self.memtracer.snapshot)
+        report = await bot.run_blocking(self.memtracer.report, snapshot, previous)
+        if action == 'dump':
+            path = dump_path(self.profile_dir, 'memtrace', 'snapshot')
+            await bot.run_blocking(snapshot.dump, path)
+            report += f'\n\nSnapshot saved to {path}'
+        await bot.send_msg(event.sender, f'Private message from {bot.matrix_user}', report)
+
     async def rooms(self, bot, room, event):
         bot.must_be_owner(event)
         output = f'I\'m in following {len(bot.client.rooms)} rooms:\n'
@@ -322,6 +420,10 @@ class MatrixModule(BotModule):
         if bot and event and bot.is_owner(event):
             text += ('\n- "!bot quit": kill the bot :('
                      '\n- "!bot reload": reload the bot modules'
+                     '\n- "!bot jobs": list scheduled jobs and their timing'
+                     '\n- "!bot modules --timing": list modules with their import and start times'
+                     '\n- "!bot profile [seconds] [dump]": profile the bot and get the slowest functions privately'
+                     '\n- "!bot memtrace [start|snapshot|dump|stop]": find out where memory is allocated'
                      '\n- "!bot uricache (view|clean)": view or clean the bot\'s URI cache'
                      '\n- "!bot logs [module] ([count])": get [count] most recent logs from [module]'
                      '\n- "!bot enable [module]": enable a module'
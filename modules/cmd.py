@@ -17,7 +17,7 @@ class MatrixModule(BotModule):
         if args[0] == 'run':
             command_body = MatrixModule.stitch(args[1:])
             bot.must_be_owner(event)
-            out = self.run_command(command_body, event.sender, room.display_name)
+            out = await bot.run_blocking(self.run_command, command_body, event.sender, room.display_name)
             await self.send_output(bot, room, out)
         # Message body possibilities:
         #   ["remove", "command_name"]
@@ -59,7 +59,7 @@ class MatrixModule(BotModule):
                 self.logger.debug(
                     f"room: {room.display_name} sender: {event.sender} wants to run cmd {target_command}"
                 )
-                out = self.run_command(target_command, event.sender, room.display_name)
+                out = await bot.run_blocking(self.run_command, target_command, event.sender, room.display_name)
                 await self.send_output(bot, room, out)
             else:
                 await bot.send_text(room, 'Unknown command.')
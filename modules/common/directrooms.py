@@ -0,0 +1,108 @@
+import asyncio
+
+from nio import RoomMemberEvent, UnknownAccountDataEvent
+
+
+class DirectRooms:
+    """Index of rooms where the bot and one user are the only members, by user
+
+    Built from the rooms the bot is in and the m.direct account data, and kept up to
+    date from sync responses, so finding a room for a private message doesn't need to
+    go through all rooms.
+    """
+
+    def __init__(self, own_user):
+        self.own_user = own_user
+        self.rooms = dict()  # mxid -> set of room ids
+        self.room_users = dict()  # room id -> mxid of the other member
+        self.direct = dict()  # mxid -> room ids listed in m.direct
+        self.locks = dict()  # mxid -> [Lock, number of users]
+
+    def rebuild(self, rooms):
+        """
+        :param rooms: dict of room id -> MatrixRoom, as in client.rooms
+        """
+        self.rooms.clear()
+        self.room_users.clear()
+        for room in rooms.values():
+            self.update_room(room)
+
+    def update_room(self, room):
+        self.remove_room(room.room_id)
+        # member_count stays correct with lazy loaded members, room.users may not
+        if room.member_count != 2:
+            return
+        others = [user for user in room.users if user != self.own_user]
+        if len(others) == 1:
+            self.add(others[0], room.room_id)
+
+    def add(self, mxid, room_id):
+        self.rooms.setdefault(mxid, set()).add(room_id)
+        self.room_users[room_id] = mxid
+
+    def remove_room(self, room_id):
+        mxid = self.room_users.pop(room_id, None)
+        if mxid:
+            self.rooms[mxid].discard(room_id)
+            if not self.rooms[mxid]:
+                del self.rooms[mxid]
+
+    def sync(self, response, rooms):
+        """Update from a sync response
+
+        :param response: nio SyncResponse
+        :param rooms: dict of room id -> MatrixRoom, as in client.rooms
+        """
+        for event in response.account_data_events:
+            if isinstance(event, UnknownAccountDataEvent) and event.type == 'm.direct':
+                self.direct = {mxid: list(room_ids) for mxid, room_ids in event.content.items()}
+        for room_id, info in response.rooms.join.items():
+            if room_id in rooms and any(isinstance(event, RoomMemberEvent)
+                                        for event in info.state + info.timeline.events):
+                self.update_room(rooms[room_id])
+        for room_id in response.rooms.leave:
+            self.remove_room(room_id)
+
+    def find(self, mxid, rooms):
+        """
+        :param mxid: user to find a room with
+        :param rooms: dict of room id -> MatrixRoom, as in client.rooms
+        :return: id of a room with only the bot and the user, or None
+        """
+        candidates = self.rooms.get(mxid, set())
+        # Prefer rooms marked as direct chats. With lazy loaded members, user may be
+        # missing from room.users, but the room is still there with two members.
+        for room_id in self.direct.get(mxid, []):
+            room = rooms.get(room_id)
+            if room_id in candidates or (room and room.member_count == 2):
+                return room_id
+        return min(candidates) if candidates else None
+
+    def lock(self, mxid):
+        """Lock to hold while finding or creating a room for the user, so only one room gets created"""
+        return DirectRoomLock(self, mxid)
+
+
+class DirectRoomLock:
+    def __init__(self, index, mxid):
+        self.index = index
+        self.mxid = mxid
+
+    async def __aenter__(self):
+        entry = self.index.locks.setdefault(self.mxid, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.release_entry(entry)
+            raise
+
+    async def __aexit__(self, *exc):
+        entry = self.index.locks[self.mxid]
+        entry[0].release()
+        self.release_entry(entry)
+
+    def release_entry(self, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.index.locks[self.mxid]
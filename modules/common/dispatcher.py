@@ -0,0 +1,97 @@
+import asyncio
+import logging
+
+from modules.common import sendqueue
+
+
+class CommandDispatcher:
+    """Runs bot commands as their own tasks so a slow command doesn't hold up others
+
+    Number of commands running at the same time is limited both globally and per module.
+    Commands waiting for a free slot are queued. Commands given to a module in the same
+    room run one at a time in the order they were received, unless the module sets
+    ordered_commands to False.
+
+    Each command has a deadline (module's command_timeout or the default timeout). A command
+    running past its deadline is cancelled and the room is told about it. Functions it started
+    with bot.run_blocking can't be cancelled and run to the end in their worker thread.
+    """
+
+    def __init__(self, bot, max_concurrent=16, module_concurrent=4, timeout=120):
+        self.bot = bot
+        self.logger = logging.getLogger("hemppa.dispatcher")
+        self.module_concurrent = module_concurrent
+        self.timeout = timeout
+        self.global_slots = asyncio.Semaphore(max_concurrent)
+        self.module_slots = dict()  # module name -> Semaphore
+        self.room_locks = dict()  # (module name, room id) -> [Lock, number of commands using it]
+        self.tasks = set()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.timed_out = 0
+
+    def dispatch(self, moduleobject, command, room, event):
+        task = asyncio.get_running_loop().create_task(self.run(moduleobject, command, room, event))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run(self, moduleobject, command, room, event):
+        timeout = moduleobject.command_timeout or self.timeout
+        sendqueue.interactive.set(True)
+        room_lock = self.acquire_room_lock(moduleobject, room) if moduleobject.ordered_commands else None
+        self.queued += 1
+        waiting = True
+        room_locked = False
+        try:
+            if room_lock:
+                await room_lock.acquire()
+                room_locked = True
+            async with self.get_module_slots(moduleobject), self.global_slots:
+                self.queued -= 1
+                waiting = False
+                self.in_flight += 1
+                try:
+                    await asyncio.wait_for(self.bot.run_command(moduleobject, command, room, event), timeout)
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    self.logger.warning(f'!{command} in {room.room_id} timed out after {timeout} seconds')
+                    await self.bot.send_text(room, f'Sorry, !{command} took too long (over {timeout} seconds) and was cancelled.', event=event)
+                finally:
+                    self.in_flight -= 1
+                    self.completed += 1
+        finally:
+            if waiting:
+                self.queued -= 1
+            if room_locked:
+                room_lock.release()
+            if room_lock:
+                self.release_room_lock(moduleobject, room)
+
+    def get_module_slots(self, moduleobject):
+        slots = self.module_slots.get(moduleobject.name)
+        if not slots:
+            slots = asyncio.Semaphore(moduleobject.max_concurrent_commands or self.module_concurrent)
+            self.module_slots[moduleobject.name] = slots
+        return slots
+
+    def acquire_room_lock(self, moduleobject, room):
+        key = (moduleobject.name, room.room_id)
+        entry = self.room_locks.get(key)
+        if not entry:
+            entry = [asyncio.Lock(), 0]
+            self.room_locks[key] = entry
+        entry[1] += 1
+        return entry[0]
+
+    def release_room_lock(self, moduleobject, room):
+        key = (moduleobject.name, room.room_id)
+        entry = self.room_locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.room_locks[key]
+
+    def status(self):
+        return f'{self.in_flight} commands running, {self.queued} queued, ' \
+               f'{self.completed} completed, {self.timed_out} timed out'
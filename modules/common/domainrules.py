@@ -0,0 +1,215 @@
+import time
+import urllib.parse
+
+ALL_DOMAINS = '*'
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).lower()
+    if value in ('yes', 'true', 'on', '1'):
+        return True
+    if value in ('no', 'false', 'off', '0'):
+        return False
+    raise ValueError(f'{value} is not yes or no')
+
+
+def positive(kind):
+    def parse(value):
+        value = kind(value)
+        if value <= 0:
+            raise ValueError(f'{value} is not positive')
+        return value
+    return parse
+
+
+def normalize_domain(domain):
+    """:return: domain in lower case without leading *. or trailing dot, or ALL_DOMAINS"""
+    domain = domain.strip().lower().rstrip('.')
+    if domain in ('', ALL_DOMAINS, '*.'):
+        return ALL_DOMAINS
+    if domain.startswith('*.'):
+        domain = domain[2:]
+    return domain.lstrip('.')
+
+
+def url_host(url):
+    """:return: host name of url in lower case, or None"""
+    try:
+        return urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        return None
+
+
+class RuleNode:
+    __slots__ = ('children', 'settings', 'domain')
+
+    def __init__(self, domain):
+        self.children = dict()  # next label -> RuleNode
+        self.settings = None  # dict of settings for this domain, if it has rules
+        self.domain = domain
+
+
+class Policy:
+    """Settings that apply to a host, from the rules of the host and its parent domains"""
+
+    def __init__(self, host):
+        self.host = host
+        self.settings = dict()
+        self.domains = dict()  # setting -> domain of the rule it came from
+
+    def get(self, setting, default=None):
+        return self.settings.get(setting, default)
+
+    def domain(self, setting):
+        return self.domains.get(setting)
+
+
+class DomainRules:
+    """Settings for domains, applying to the domain and all its subdomains
+
+    Rules are kept in a trie keyed by domain labels from the right, so finding the rules
+    for a host takes one step per label of the host name, however many rules there are.
+    Rules of a subdomain override those of its parent and the rule for ALL_DOMAINS
+    applies to every host. For example blocking ALL_DOMAINS and unblocking example.com
+    allows only example.com and its subdomains.
+
+    Known settings and their types are in SETTINGS.
+    """
+
+    SETTINGS = {
+        'block': parse_bool,  # Don't touch urls of this domain
+        'agent': str,  # User agent to use
+        'cookies': str,  # Cookies to send, as name=value;name=value
+        'maxbytes': positive(int),  # Read at most this much of a response
+        'rate': positive(float),  # Fetches per minute from this domain and its subdomains
+        'ttl': positive(float),  # Hours to remember the result
+    }
+
+    def __init__(self, rules=None):
+        """
+        :param rules: dict of domain -> dict of setting -> value, as from get_rules
+        """
+        self.root = RuleNode(ALL_DOMAINS)
+        self.rules = dict()  # domain -> dict of settings
+        self.buckets = dict()  # domain -> [fetches left, monotonic time of last update]
+        if rules:
+            self.load(rules)
+
+    def load(self, rules):
+        self.root = RuleNode(ALL_DOMAINS)
+        self.rules = dict()
+        self.buckets.clear()
+        for domain, settings in rules.items():
+            for setting, value in settings.items():
+                self.set(domain, setting, value)
+
+    def get_rules(self):
+        """:return: dict of domain -> dict of setting -> value"""
+        return {domain: dict(settings) for domain, settings in self.rules.items()}
+
+    def node(self, domain, create=False):
+        node = self.root
+        if domain == ALL_DOMAINS:
+            return node
+        for label in reversed(domain.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = RuleNode(f'{label}.{node.domain}' if node is not self.root else label)
+            node = child
+        return node
+
+    def set(self, domain, setting, value):
+        """
+        :raises: ValueError if setting is unknown or value is not valid for it
+        """
+        parse = self.SETTINGS.get(setting)
+        if parse is None:
+            raise ValueError(f'Unknown setting {setting}, known are {", ".join(self.SETTINGS)}')
+        value = parse(value)
+        domain = normalize_domain(domain)
+        node = self.node(domain, create=True)
+        if node.settings is None:
+            node.settings = self.rules[domain] = dict()
+        node.settings[setting] = value
+        if setting == 'rate':
+            self.buckets.pop(domain, None)
+
+    def remove(self, domain, setting=None):
+        """Remove one setting, or all settings of the domain
+
+        :return: True if something was removed
+        """
+        domain = normalize_domain(domain)
+        node = self.node(domain)
+        if node is None or node.settings is None:
+            return False
+        if setting is None:
+            node.settings.clear()
+        elif node.settings.pop(setting, None) is None:
+            return False
+        if not node.settings:
+            node.settings = None
+            del self.rules[domain]
+        self.buckets.pop(domain, None)
+        return True
+
+    def remove_setting(self, setting, value=None):
+        """Remove a setting from all domains, or only where it has given value"""
+        for domain, settings in list(self.rules.items()):
+            if setting in settings and (value is None or settings[setting] == value):
+                self.remove(domain, setting)
+
+    def lookup(self, host):
+        """
+        :param host: host name, in lower case
+        :return: Policy for the host
+        """
+        policy = Policy(host)
+        node = self.root
+        labels = reversed(host.rstrip('.').split('.')) if host else iter(())
+        while node is not None:
+            if node.settings:
+                policy.settings.update(node.settings)
+                for setting in node.settings:
+                    policy.domains[setting] = node.domain
+            label = next(labels, None)
+            node = node.children.get(label) if label is not None else None
+        return policy
+
+    def lookup_url(self, url):
+        """:return: Policy for the host of url"""
+        return self.lookup(url_host(url) or '')
+
+    def allow_fetch(self, policy, now=None):
+        """Take one fetch from the rate limit of the policy, if it has one
+
+        :return: False if the domain has been fetched from too often
+        """
+        rate = policy.get('rate')
+        if not rate:
+            return True
+        if now is None:
+            now = time.monotonic()
+        domain = policy.domain('rate')
+        bucket = self.buckets.get(domain)
+        if bucket is None:
+            bucket = self.buckets[domain] = [rate, now]
+        # Allows bursts of up to a minute's worth of fetches
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate / 60)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def describe(self):
+        """:return: rules as text, one domain per line"""
+        lines = []
+        for domain in sorted(self.rules, key=lambda d: (d != ALL_DOMAINS, list(reversed(d.split('.'))))):
+            settings = ', '.join(f'{setting} {value}' for setting, value in self.rules[domain].items())
+            lines.append(f'{domain}: {settings}')
+        return '\n'.join(lines)
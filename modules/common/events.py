@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+
+class Subscription:
+    def __init__(self, dispatcher, owner, event_type, callback, rooms):
+        self.dispatcher = dispatcher
+        self.owner = owner
+        self.event_type = event_type
+        self.callback = callback
+        self.rooms = None if rooms is None else set(rooms)
+
+    def set_rooms(self, rooms):
+        """Change rooms the subscription is for
+
+        :param rooms: iterable of room ids, or None for all rooms
+        """
+        self.dispatcher.unindex(self)
+        self.rooms = None if rooms is None else set(rooms)
+        self.dispatcher.index(self)
+
+
+class EventDispatcher:
+    """Delivers room events to modules that subscribed to them
+
+    Subscriptions are indexed by room, so an event in a room nobody is interested
+    in costs one dict lookup. Events the bot should ignore and events sent before
+    the bot started or joined the room are not delivered. Each callback runs as its
+    own task so a slow handler doesn't hold up syncing.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.logger = logging.getLogger("hemppa.events")
+        self.room_subscriptions = dict()  # room id -> list of Subscription
+        self.global_subscriptions = []  # Subscriptions for all rooms
+        self.subscriptions = []
+        self.tasks = set()
+        self.delivered = 0
+
+    def subscribe(self, owner, event_type, callback, rooms=None):
+        """
+        :param owner: name of the module subscribing
+        :param event_type: nio event class or tuple of classes
+        :param callback: coroutine function (room, event)
+        :param rooms: iterable of room ids, or None for all rooms
+        :return: Subscription, use its set_rooms() when the rooms change
+        """
+        subscription = Subscription(self, owner, event_type, callback, rooms)
+        self.subscriptions.append(subscription)
+        self.index(subscription)
+        return subscription
+
+    def unsubscribe(self, owner):
+        """Remove all subscriptions of a module"""
+        for subscription in [s for s in self.subscriptions if s.owner == owner]:
+            self.unindex(subscription)
+            self.subscriptions.remove(subscription)
+
+    def index(self, subscription):
+        if subscription not in self.subscriptions:
+            return
+        if subscription.rooms is None:
+            self.global_subscriptions.append(subscription)
+            return
+        for room_id in subscription.rooms:
+            self.room_subscriptions.setdefault(room_id, []).append(subscription)
+
+    def unindex(self, subscription):
+        if subscription.rooms is None:
+            if subscription in self.global_subscriptions:
+                self.global_subscriptions.remove(subscription)
+            return
+        for room_id in subscription.rooms:
+            subscriptions = self.room_subscriptions.get(room_id)
+            if subscriptions and subscription in subscriptions:
+                subscriptions.remove(subscription)
+                if not subscriptions:
+                    del self.room_subscriptions[room_id]
+
+    async def event_cb(self, room, event):
+        subscriptions = self.room_subscriptions.get(room.room_id)
+        if not subscriptions and not self.global_subscriptions:
+            return
+        subscriptions = (subscriptions or []) + self.global_subscriptions
+        matching = [s for s in subscriptions if isinstance(event, s.event_type)]
+        if not matching:
+            return
+        if 'content' in event.source and self.bot.should_ignore_event(event):
+            return
+        if self.bot.is_old_event(room, event):
+            return
+        loop = asyncio.get_running_loop()
+        for subscription in matching:
+            task = loop.create_task(self.deliver(subscription, room, event))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def deliver(self, subscription, room, event):
+        self.delivered += 1
+        started = time.monotonic()
+        try:
+            await subscription.callback(room, event)
+        except Exception:
+            self.logger.exception(f'unhandled exception from {subscription.owner} event handler')
+        finally:
+            self.bot.event_handler_duration.observe(time.monotonic() - started, subscription.owner)
+
+    def status(self):
+        return f'{len(self.subscriptions)} subscriptions ({len(self.global_subscriptions)} for all rooms) ' \
+               f'in {len(self.room_subscriptions)} rooms, {self.delivered} delivered, {len(self.tasks)} running'
@@ -4,6 +4,9 @@
 class UploadFailed(Exception):
     pass
 
+class PreviewFailed(Exception):
+    pass
+
 class CommandRequiresAdmin(Exception):
     pass
 
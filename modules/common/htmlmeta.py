@@ -0,0 +1,187 @@
+import codecs
+import re
+from html.parser import HTMLParser
+
+# Like browsers, look for <meta charset> only in the first bytes of the page
+PRESCAN_SIZE = 1024
+# Text is parsed in slices this big, so that parsing stops soon after the head
+SLICE_SIZE = 16 * 1024
+META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.-]+)', re.IGNORECASE)
+BOMS = ((codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be'))
+
+
+def header_charset(content_type):
+    """:return: charset parameter of a Content-Type header, or None"""
+    if not content_type:
+        return None
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            return value.strip().strip('"\'') or None
+    return None
+
+
+def known_encoding(name):
+    """:return: normalized name of the encoding, or None if python doesn't know it"""
+    if not name:
+        return None
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+class HtmlMeta:
+    """Title, description and image of a page. Any of them can be None."""
+
+    def __init__(self, title=None, description=None, image=None):
+        self.title = title
+        self.description = description
+        self.image = image
+
+    def __repr__(self):
+        return f'HtmlMeta(title={self.title!r}, description={self.description!r}, image={self.image!r})'
+
+
+class HeadParser(HTMLParser):
+    """Collects <title> and <meta> tags until the end of <head>"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.done = False
+        self.in_title = False
+        self.title = []  # pieces of text in <title>, a str once it has ended
+        self.meta_tags = dict()  # name or property -> content, first one wins
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and isinstance(self.title, list):
+            self.in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            key = attrs.get('property') or attrs.get('name')
+            content = attrs.get('content')
+            if key and content is not None:
+                self.meta_tags.setdefault(key.lower(), content)
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self.title = ''.join(self.title)
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title.append(data)
+
+    def feed_until_done(self, text):
+        for start in range(0, len(text), SLICE_SIZE):
+            if self.done:
+                break
+            self.feed(text[start:start + SLICE_SIZE])
+
+    def meta(self):
+        """:return: HtmlMeta, preferring <title> and description over Open Graph tags"""
+        title = self.title if isinstance(self.title, str) else ''.join(self.title)
+        title = title or self.meta_tags.get('title') or self.meta_tags.get('og:title') or ''
+        # Title should not contain newlines or tabs
+        title = ' '.join(title.split())
+        description = self.meta_tags.get('description') or self.meta_tags.get('og:description')
+        image = self.meta_tags.get('og:image') or self.meta_tags.get('og:image:url')
+        return HtmlMeta(title or None, description or None, image or None)
+
+
+class HtmlMetaExtractor:
+    """Reads title, description and og:image from the <head> of a html page, given piece by piece
+
+    Meant for reading a page while downloading it, and stopping as soon as the head has
+    been seen:
+
+        extractor = HtmlMetaExtractor(response.headers.get('content-type'))
+        async for chunk in response.aiter_bytes():
+            if extractor.feed(chunk):
+                break
+        meta = extractor.close()
+
+    The encoding is taken from a byte order mark, the Content-Type header or a <meta> tag
+    near the start of the page, in that order, and defaults to UTF-8.
+    """
+
+    def __init__(self, content_type=None):
+        self.charset = known_encoding(header_charset(content_type))
+        self.decoder = None
+        self.pending = b''  # bytes waiting until the encoding is known
+        self.parser = HeadParser()
+        self.bytes_read = 0
+
+    @property
+    def done(self):
+        return self.parser.done
+
+    def feed(self, data):
+        """
+        :param data: next bytes of the page
+        :return: True when the head has ended and the rest of the page is not needed
+        """
+        if self.done:
+            return True
+        self.bytes_read += len(data)
+        if self.decoder is None:
+            self.pending += data
+            if len(self.pending) < PRESCAN_SIZE:
+                return False
+            data = self.start_decoding()
+        self.parser.feed_until_done(self.decoder.decode(data))
+        return self.done
+
+    def start_decoding(self):
+        data = self.pending
+        self.pending = b''
+        encoding = None
+        for bom, name in BOMS:
+            if data.startswith(bom):
+                encoding = name
+                data = data[len(bom):]
+                break
+        if encoding is None:
+            encoding = self.charset
+        if encoding is None:
+            match = META_CHARSET.search(data, 0, PRESCAN_SIZE)
+            if match:
+                encoding = known_encoding(match.group(1).decode('ascii'))
+                # The page was read as ascii compatible bytes to find the tag, so it can't really be utf-16
+                if encoding and encoding.startswith('utf-16'):
+                    encoding = 'utf-8'
+        self.charset = encoding or 'utf-8'
+        self.decoder = codecs.getincrementaldecoder(self.charset)(errors='replace')
+        return data
+
+    def close(self):
+        """:return: HtmlMeta of what was found"""
+        if self.decoder is None:
+            data = self.start_decoding()
+            self.parser.feed_until_done(self.decoder.decode(data, final=True))
+        elif not self.done:
+            self.parser.feed_until_done(self.decoder.decode(b'', final=True))
+        if not self.done:
+            self.parser.close()
+        return self.parser.meta()
+
+
+def parse_head(page, content_type=None):
+    """Title, description and og:image of a whole page
+
+    :param page: bytes or str
+    :return: HtmlMeta
+    """
+    if isinstance(page, str):
+        parser = HeadParser()
+        parser.feed_until_done(page)
+        if not parser.done:
+            parser.close()
+        return parser.meta()
+    extractor = HtmlMetaExtractor(content_type)
+    extractor.feed(page)
+    return extractor.close()
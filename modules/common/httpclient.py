@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class HttpClient:
+    """Shared asynchronous HTTP client, available to modules as bot.http
+
+    Connections are pooled and kept alive between requests, so repeated requests to
+    the same host skip connection setup and DNS lookups. Number of simultaneous
+    requests to a single host is limited. HTTP/2 is used when the h2 package is installed.
+
+    Methods mirror httpx.AsyncClient and return httpx.Response objects:
+
+        response = await bot.http.get(url, params={'q': query})
+        if response.status_code == 200:
+            data = response.json()
+
+    Pass verify=False to skip TLS certificate verification for hosts with broken certificates.
+    """
+
+    def __init__(self, user_agent, timeout=30.0, max_connections=100, max_connections_per_host=8):
+        self.logger = logging.getLogger("hemppa.http")
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.client = self.create_client(verify=True)
+        self.insecure_client = None
+        self.host_slots = dict()  # host -> [Semaphore, number of requests using it]
+        self.requests = 0
+        self.errors = 0
+
+    def create_client(self, verify):
+        return httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            verify=verify,
+            timeout=httpx.Timeout(self.timeout),
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_connections // 2),
+            headers={'User-Agent': self.user_agent},
+            follow_redirects=True,
+        )
+
+    def get_client(self, verify):
+        if verify:
+            return self.client
+        if not self.insecure_client:
+            self.insecure_client = self.create_client(verify=False)
+        return self.insecure_client
+
+    @asynccontextmanager
+    async def host_slot(self, url):
+        """Wait for a free slot for the host of url. Hosts are forgotten when no requests use them."""
+        host = httpx.URL(str(url)).host
+        entry = self.host_slots.get(host)
+        if entry is None:
+            entry = self.host_slots[host] = [asyncio.Semaphore(self.max_connections_per_host), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.host_slots[host]
+
+    async def request(self, method, url, verify=True, **kwargs):
+        self.requests += 1
+        async with self.host_slot(url):
+            try:
+                return await self.get_client(verify).request(method, url, **kwargs)
+            except httpx.HTTPError:
+                self.errors += 1
+                raise
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method, url, verify=True, **kwargs):
+        """Stream the response instead of reading it all to memory
+
+            async with bot.http.stream('GET', url) as response:
+                async for chunk in response.aiter_bytes():
+                    ...
+        """
+        self.requests += 1
+        async with self.host_slot(url):
+            try:
+                async with self.get_client(verify).stream(method, url, **kwargs) as response:
+                    yield response
+            except httpx.HTTPError:
+                self.errors += 1
+                raise
+
+    async def aclose(self):
+        await self.client.aclose()
+        if self.insecure_client:
+            await self.insecure_client.aclose()
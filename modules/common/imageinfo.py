@@ -0,0 +1,63 @@
+import struct
+
+# Enough for the size of PNG, GIF and WebP images and most JPEGs. JPEGs with big
+# EXIF data or thumbnails before the frame header may need more.
+HEADER_SIZE = 64 * 1024
+
+
+def image_size(header):
+    """Width and height of an image from the first bytes of the file, without decoding it
+
+    Supports PNG, GIF, JPEG and WebP.
+
+    :param header: bytes from the start of the image file
+    :return: (width, height), or None if the format is unknown or header is too short
+    """
+    try:
+        if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+            return struct.unpack('>II', header[16:24])
+        if header[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', header[6:10])
+        if header.startswith(b'\xff\xd8'):
+            return jpeg_size(header)
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return webp_size(header)
+    except struct.error:
+        pass
+    return None
+
+
+def jpeg_size(header):
+    pos = 2
+    while pos + 9 < len(header):
+        if header[pos] != 0xff:
+            return None
+        marker = header[pos + 1]
+        if marker == 0xff:  # Padding
+            pos += 1
+            continue
+        if marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:  # No length
+            pos += 2
+            continue
+        length = struct.unpack('>H', header[pos + 2:pos + 4])[0]
+        # Start of frame markers, except DHT, JPG and DAC which share the range
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>HH', header[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+
+def webp_size(header):
+    chunk = header[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(header[24:27], 'little') + 1
+        height = int.from_bytes(header[27:30], 'little') + 1
+        return width, height
+    return None
@@ -0,0 +1,120 @@
+import logging
+import re
+
+# Rewrites links to privacy friendly front ends
+DEFAULT_RULES = {
+    'twitter': (r'https?://(?:www\.|mobile\.)?twitter\.com/([^?#\s]*)', r'https://nitter.net/\1'),
+    'youtube': (r'https?://(?:www\.|m\.)?youtube\.com/(\S*)', r'https://yewtu.be/\1'),
+    'youtu.be': (r'https?://youtu\.be/([\w-]+)', r'https://yewtu.be/watch?v=\1'),
+    'reddit': (r'https?://(?:www\.|old\.|new\.)?reddit\.com/(\S*)', r'https://libreddit.kavin.rocks/\1'),
+    'instagram': (r'https?://(?:www\.)?instagram\.com/([^?#\s]*)', r'https://bibliogram.art/\1'),
+}
+
+# Rules are tried only where a link starts, scanning for this is much faster than for all rules
+LINK_START = re.compile(r'https?://', re.IGNORECASE)
+GROUP_REFERENCE = re.compile(r'\\(\d+)|\\g<(\w+)>')
+# Backslash and digit not preceded by an escaped backslash
+BACKREFERENCE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]')
+
+
+class RewriteRule:
+    def __init__(self, name, pattern, replacement):
+        self.name = name
+        self.pattern = pattern
+        self.replacement = replacement
+        self.regex = re.compile(pattern)
+
+
+class LinkRewriter:
+    """Rewrites links in messages, for example twitter.com links to nitter.net
+
+    A rule is a regular expression matching the link and a replacement, which can refer
+    to groups of the expression like re.sub does. Rules are matched at the start of each
+    http or https link. All rules in use in a room are compiled into a single expression,
+    so each link is matched once however many rules there are.
+    Rules can't use named groups, backreferences or global inline flags, as they would
+    clash in the combined expression.
+    """
+
+    def __init__(self, rules=None):
+        """
+        :param rules: dict of name -> (pattern, replacement)
+        """
+        self.rules = dict()  # name -> RewriteRule
+        self.matchers = dict()  # frozenset of rule names -> (combined regex, list of rules by group)
+        for name, (pattern, replacement) in (rules or {}).items():
+            self.add(name, pattern, replacement)
+
+    def add(self, name, pattern, replacement):
+        """Add or replace a rule
+
+        :raises: ValueError if the pattern or replacement is not valid
+        """
+        try:
+            rule = RewriteRule(name, pattern, replacement)
+        except re.error as e:
+            raise ValueError(f'Invalid pattern {pattern}: {e}')
+        if rule.regex.groupindex or '(?P=' in pattern:
+            raise ValueError('Named groups are not supported')
+        if BACKREFERENCE.search(pattern):
+            # Would refer to groups of other rules in the combined expression
+            raise ValueError('Backreferences are not supported')
+        for number, group in GROUP_REFERENCE.findall(replacement):
+            group = number or group
+            if not group.isdigit() or int(group) > rule.regex.groups:
+                raise ValueError(f'Replacement refers to group {group}, pattern has {rule.regex.groups} groups')
+        try:
+            # As in matcher(), so that inline flags and backreferences are caught here
+            re.compile(f'(?P<r0>{pattern})|(?P<r1>x)')
+        except re.error as e:
+            raise ValueError(f'Pattern {pattern} can not be combined with other rules: {e}')
+        self.rules[name] = rule
+        self.matchers.clear()
+
+    def remove(self, name):
+        """:return: True if there was such rule"""
+        if self.rules.pop(name, None) is None:
+            return False
+        self.matchers.clear()
+        return True
+
+    def get_rules(self):
+        """:return: dict of name -> [pattern, replacement]"""
+        return {name: [rule.pattern, rule.replacement] for name, rule in self.rules.items()}
+
+    def matcher(self, names):
+        """:return: (combined regex, list of rules by group), or None if no rules"""
+        key = frozenset(names)
+        matcher = self.matchers.get(key)
+        if matcher is None:
+            rules = [rule for name, rule in self.rules.items() if name in key]
+            if not rules:
+                return None
+            try:
+                regex = re.compile('|'.join(f'(?P<r{i}>{rule.pattern})' for i, rule in enumerate(rules)))
+            except re.error as e:
+                # Rules are checked when added, but settings could have been edited by hand
+                logging.getLogger("hemppa.linkrewrite").error(f'Could not combine rules {", ".join(key)}: {e}')
+                regex = None
+            matcher = self.matchers[key] = (regex, rules)
+        return matcher
+
+    def rewrite(self, text, names=None):
+        """Find links in text and rewrite them
+
+        :param names: names of rules to use, or None for all
+        :return: list of rewritten links, in order and without duplicates
+        """
+        matcher = self.matcher(self.rules if names is None else names)
+        if matcher is None or matcher[0] is None:
+            return []
+        regex, rules = matcher
+        links = dict()
+        for start in LINK_START.finditer(text):
+            match = regex.match(text, start.start())
+            if match is None:
+                continue
+            rule = rules[int(match.lastgroup[1:])]
+            # Match again with the rule alone, so its groups are numbered as in the replacement
+            links[rule.regex.match(text, match.start()).expand(rule.replacement)] = None
+        return list(links)
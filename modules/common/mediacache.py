@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+
+class MediaCache:
+    """Remembers images uploaded to the homeserver so they don't need to be uploaded again
+
+    Entries are keyed by hash of the content, so the same image fetched from different
+    urls is uploaded only once. Urls the content was fetched from are kept as aliases of
+    the content hash. Cache holds at most max_entries uploads, dropping least recently
+    used ones first, and forgets uploads older than ttl seconds.
+
+    Each entry is [matrix_uri, mimetype, width, height, size].
+    """
+
+    VERSION = 1
+
+    def __init__(self, max_entries=1000, ttl=30 * 24 * 60 * 60):
+        self.logger = logging.getLogger("hemppa.mediacache")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # content hash -> {'res': [...], 'urls': [...], 'created': unix time}
+        self.aliases = dict()  # url -> content hash
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0  # Uploads avoided because same content was uploaded from elsewhere
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def content_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def hasher():
+        """Incremental version of content_hash(): update() it with the data, then call hexdigest()"""
+        return hashlib.sha256()
+
+    def get(self, url):
+        """
+        :param url: Url the image was fetched from
+        :return: [matrix_uri, mimetype, w, h, size], or None
+        """
+        res = self.lookup(self.aliases.get(url))
+        if res:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return res
+
+    def get_by_hash(self, content_hash):
+        """
+        :param content_hash: Hash of the content from content_hash()
+        :return: [matrix_uri, mimetype, w, h, size], or None
+        """
+        res = self.lookup(content_hash)
+        if res:
+            self.deduplicated += 1
+        return res
+
+    def lookup(self, content_hash):
+        entry = self.entries.get(content_hash)
+        if not entry:
+            return None
+        if self.ttl and time.time() - entry['created'] > self.ttl:
+            self.expirations += 1
+            self.remove(content_hash)
+            return None
+        self.entries.move_to_end(content_hash)
+        return entry['res']
+
+    def put(self, content_hash, res, url=None):
+        """Add an uploaded image
+
+        :param content_hash: Hash of the content from content_hash()
+        :param res: [matrix_uri, mimetype, w, h, size]
+        :param url: Url the image was fetched from, if any
+        """
+        entry = self.entries.get(content_hash)
+        if not entry:
+            entry = {'res': list(res), 'urls': [], 'created': int(time.time())}
+            self.entries[content_hash] = entry
+        self.entries.move_to_end(content_hash)
+        if url:
+            self.add_alias(url, content_hash)
+        while len(self.entries) > self.max_entries:
+            oldest = next(iter(self.entries))
+            self.evictions += 1
+            self.remove(oldest)
+
+    def add_alias(self, url, content_hash):
+        entry = self.entries.get(content_hash)
+        if not entry:
+            return
+        previous = self.aliases.get(url)
+        if previous == content_hash:
+            return
+        if previous in self.entries:
+            # Url has new content now
+            self.entries[previous]['urls'].remove(url)
+        self.aliases[url] = content_hash
+        entry['urls'].append(url)
+
+    def remove(self, content_hash):
+        entry = self.entries.pop(content_hash, None)
+        if entry:
+            for url in entry['urls']:
+                self.aliases.pop(url, None)
+
+    def remove_urls(self, match):
+        """Remove uploads fetched from urls for which match(url) is true
+
+        :return: number of uploads removed
+        """
+        matching = [content_hash for content_hash, entry in self.entries.items()
+                    if any(match(url) for url in entry['urls'])]
+        for content_hash in matching:
+            self.remove(content_hash)
+        return len(matching)
+
+    def clear(self):
+        self.entries.clear()
+        self.aliases.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = f'{100 * self.hits / lookups:.0f}%' if lookups else '-'
+        return f'{len(self.entries)}/{self.max_entries} uploads, {len(self.aliases)} urls, ' \
+               f'{self.hits} hits, {self.misses} misses ({hit_rate} hit rate), ' \
+               f'{self.deduplicated} deduplicated, {self.evictions} evicted, {self.expirations} expired'
+
+    def to_json(self):
+        # Saved in upload order instead of use order, so lookups don't cause account data writes
+        entries = sorted(self.entries.items(), key=lambda item: item[1]['created'])
+        return {'version': MediaCache.VERSION,
+                'entries': [[content_hash, entry] for content_hash, entry in entries]}
+
+    def load(self, data):
+        """Load cache saved with to_json(), or the url -> upload dict of older versions"""
+        self.clear()
+        if not data:
+            return
+        if data.get('version') == MediaCache.VERSION:
+            for content_hash, entry in data.get('entries', []):
+                self.entries[content_hash] = entry
+                for url in entry['urls']:
+                    self.aliases[url] = content_hash
+        else:
+            # Old cache doesn't know content of the uploads. Entries keyed by url are kept with
+            # the url as their hash, entries keyed by md5 of uploaded bytes can't be found anymore.
+            for key, res in data.items():
+                if '://' in key and isinstance(res, list) and len(res) == 5:
+                    self.put(f'url:{key}', res, url=key)
+            self.logger.info(f'Migrated {len(self.entries)} of {len(data)} entries from old uri cache')
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
@@ -0,0 +1,114 @@
+from nio import RoomMemberEvent
+
+
+def homeserver(mxid):
+    return mxid.split(':', 1)[1] if ':' in mxid else ''
+
+
+class MembershipIndex:
+    """Index of users in the rooms the bot is in
+
+    Keeps the members of each room, every user seen in any room once, and number of users
+    per homeserver. Built from client.rooms at start and kept up to date from member
+    events in sync responses, so questions about all users don't need to go through
+    every member of every room.
+
+    Members are the same as in room.users, so with lazy loaded members only users who
+    have been active are known.
+    """
+
+    def __init__(self):
+        self.room_users = dict()  # room id -> set of mxids
+        self.user_rooms = dict()  # mxid -> number of rooms the user is in
+        self.homeservers = dict()  # server name -> number of users
+        self.version = 0  # Changes when users are added or removed
+
+    @property
+    def users(self):
+        """All users in any room, as a dict view"""
+        return self.user_rooms.keys()
+
+    def rebuild(self, rooms):
+        """
+        :param rooms: dict of room id -> MatrixRoom, as in client.rooms
+        """
+        self.room_users.clear()
+        self.user_rooms.clear()
+        self.homeservers.clear()
+        for room in rooms.values():
+            self.update_room(room)
+        self.version += 1
+
+    def update_room(self, room):
+        """Make members of a room match room.users"""
+        current = set(room.users)
+        members = self.room_users.setdefault(room.room_id, set())
+        for mxid in members - current:
+            self.remove_member(room.room_id, mxid)
+        for mxid in current - members:
+            self.add_member(room.room_id, mxid)
+
+    def update_member(self, room, mxid):
+        """Update membership of one user in a room from room.users"""
+        if mxid in room.users:
+            self.add_member(room.room_id, mxid)
+        else:
+            self.remove_member(room.room_id, mxid)
+
+    def add_member(self, room_id, mxid):
+        members = self.room_users.setdefault(room_id, set())
+        if mxid in members:
+            return
+        members.add(mxid)
+        count = self.user_rooms.get(mxid, 0)
+        self.user_rooms[mxid] = count + 1
+        if count == 0:
+            server = homeserver(mxid)
+            self.homeservers[server] = self.homeservers.get(server, 0) + 1
+        self.version += 1
+
+    def remove_member(self, room_id, mxid):
+        members = self.room_users.get(room_id)
+        if not members or mxid not in members:
+            return
+        members.discard(mxid)
+        count = self.user_rooms[mxid] - 1
+        if count:
+            self.user_rooms[mxid] = count
+        else:
+            del self.user_rooms[mxid]
+            server = homeserver(mxid)
+            self.homeservers[server] -= 1
+            if not self.homeservers[server]:
+                del self.homeservers[server]
+        self.version += 1
+
+    def remove_room(self, room_id):
+        for mxid in list(self.room_users.get(room_id, ())):
+            self.remove_member(room_id, mxid)
+        self.room_users.pop(room_id, None)
+
+    def sync(self, response, rooms):
+        """Update from a sync response, looking only at users in member events
+
+        :param response: nio SyncResponse
+        :param rooms: dict of room id -> MatrixRoom, as in client.rooms
+        """
+        for room_id, info in response.rooms.join.items():
+            room = rooms.get(room_id)
+            if not room:
+                continue
+            if room_id not in self.room_users:
+                self.update_room(room)
+                continue
+            for event in info.state + info.timeline.events:
+                if isinstance(event, RoomMemberEvent):
+                    self.update_member(room, event.state_key)
+        for room_id in response.rooms.leave:
+            self.remove_room(room_id)
+
+    def get_users(self, room_id=None):
+        """:return: users in given room, or in all rooms"""
+        if room_id:
+            return self.room_users.get(room_id, set())
+        return self.users
@@ -0,0 +1,186 @@
+import asyncio
+import bisect
+import logging
+import time
+
+from aiohttp import web
+
+# Seconds, for latencies from a few milliseconds to slow commands
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def header(self, kind):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {kind}']
+
+
+class Counter(Metric):
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = dict()  # tuple of label values -> value
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self.header('counter')
+        for labels, value in self.values.items():
+            lines.append(f'{self.name}{format_labels(self.labels, labels)} {format_value(value)}')
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Counter or gauge whose value is read from elsewhere when scraped
+
+    func returns a number, or a dict of tuple of label values -> number.
+    """
+
+    def __init__(self, name, help, kind, func, labels=()):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.func = func
+
+    def render(self):
+        lines = self.header(self.kind)
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            lines.append(f'{self.name}{format_labels(self.labels, labels)} {format_value(value)}')
+        return lines
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = dict()  # tuple of label values -> [count per bucket + overflow, sum, count]
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = [[0] * (len(self.buckets) + 1), 0, 0]
+            self.values[labels] = entry
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = self.header('histogram')
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = format_labels(self.labels, labels, f'le="{format_value(float(bound))}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            label_text = format_labels(self.labels, labels)
+            lines.append(f'{self.name}_sum{label_text} {format_value(float(total))}')
+            lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class Metrics:
+    """Collects bot metrics and serves them in Prometheus text format
+
+    Recording a value is a dict lookup and a few additions, so metrics are always
+    collected. The HTTP endpoint and event loop lag measurement only run after start().
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("hemppa.metrics")
+        self.metrics = dict()  # name -> Metric
+        self.runner = None
+        self.lag_task = None
+        self.loop_lag = self.histogram('hemppa_event_loop_lag_seconds',
+                                       'How late the event loop runs a timer',
+                                       buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, kind, func, labels=()):
+        """
+        :param kind: 'counter' or 'gauge'
+        :param func: returns the value, or dict of tuple of label values -> value
+        """
+        return self.add(CallbackMetric(name, help, kind, func, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                self.logger.exception(f'Rendering metric {metric.name} failed')
+        return '\n'.join(lines) + '\n'
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self, host, port, lag_interval=1.0):
+        """Serve metrics at http://host:port/metrics"""
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.lag_task = asyncio.get_running_loop().create_task(self.measure_loop_lag(lag_interval))
+        self.logger.info(f'Serving metrics at http://{host}:{port}/metrics')
+
+    async def stop(self):
+        if self.lag_task:
+            self.lag_task.cancel()
+            self.lag_task = None
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def measure_loop_lag(self, interval):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0, time.monotonic() - started - interval))
@@ -33,15 +33,31 @@ class BotModule(ABC):
         self.enabled = True
         self.name = name
         self.logger = logging.getLogger("module " + self.name)
+        self.command_timeout = None  # Seconds a command may run, None = bot default
+        self.max_concurrent_commands = None  # Commands running at once, None = bot default
+        self.ordered_commands = True  # Run commands in a room one at a time, in order
 
     def matrix_start(self, bot):
         """Called once on startup
 
+        Modules are started one after another, so keep this quick. Do anything
+        slow, such as network requests, in matrix_start_async.
+
         :param bot: a reference to the bot
         :type bot: Bot
         """
         self.logger.info('Starting..')
 
+    async def matrix_start_async(self, bot):
+        """Called once on startup after matrix_start, concurrently with other modules
+
+        Must finish within bot's module start timeout, or the module is considered failed to start.
+
+        :param bot: a reference to the bot
+        :type bot: Bot
+        """
+        pass
+
     @abstractmethod
     async def matrix_message(self, bot, room, event):
         """Called when a message is sent to room starting with !module_name
@@ -62,10 +78,22 @@ class BotModule(ABC):
         :type bot: Bot
         """
         self.logger.info('Stopping..')
+        bot.scheduler.remove_jobs(self.name + '.')
+        bot.events.unsubscribe(self.name)
+
+    async def matrix_stop_async(self, bot):
+        """Called once before exit after matrix_stop, concurrently with other modules
+
+        :param bot: a reference to the bot
+        :type bot: Bot
+        """
+        pass
 
     async def matrix_poll(self, bot, pollcount):
         """Called every 10 seconds
 
+        For anything that doesn't need to run this often, prefer add_job.
+
         :param bot: a reference to the bot
         :type bot: Bot
         :param pollcount: the actual poll count
@@ -128,6 +156,32 @@ class BotModule(ABC):
                 self.logger.debug(f"overriding alias {name} for {prev}")
             bot.module_aliases[name] = self.name
 
+    def add_job(self, bot, name, func, **kwargs):
+        """Run func periodically. Call this in matrix_start, jobs are removed on matrix_stop.
+
+        :param name: name of the job, unique within this module
+        :type name: str
+        :param func: coroutine function to run, called without arguments
+        :param kwargs: when to run it - interval (seconds) or cron (spec string), and
+            optionally jitter, overrun and run_now. See Scheduler.add_job.
+        :return: the scheduled Job
+        """
+        return bot.scheduler.add_job(f'{self.name}.{name}', func, **kwargs)
+
+    def subscribe(self, bot, event_type, callback, rooms=None):
+        """Get room events other than commands. Call this in matrix_start, subscriptions are removed on matrix_stop.
+
+        Events the bot should ignore and events from before the bot started or joined
+        the room are not delivered. Prefer this to client.add_event_callback, as events
+        in rooms the module is not subscribed to cost nothing.
+
+        :param event_type: nio event class, or tuple of them
+        :param callback: coroutine function (room, event)
+        :param rooms: room ids to get events from, None for all rooms
+        :return: the Subscription. Call its set_rooms() when the rooms the module is active in change.
+        """
+        return bot.events.subscribe(self.name, event_type, callback, rooms)
+
     def enable(self):
         self.enabled = True
 
@@ -0,0 +1,100 @@
+import ast
+import os
+
+from modules.common.module import BotModule
+
+
+def read_module_info(path):
+    """Find out what is needed of a module before importing it, by parsing its source
+
+    Imports of many modules pull in big libraries, so disabled modules are not imported
+    until they are enabled. Whether a module is enabled by default and its help text are
+    read from MatrixModule's __init__ and help() if they are simple enough.
+
+    :param path: path to the module's python file
+    :return: dict with 'enabled' (bool) and 'help' (str or None)
+    """
+    info = {'enabled': True, 'help': None}
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == 'MatrixModule':
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and item.name == '__init__':
+                    enabled = default_enabled(item)
+                    if enabled is not None:
+                        info['enabled'] = enabled
+                elif isinstance(item, ast.FunctionDef) and item.name == 'help':
+                    info['help'] = constant_return(item)
+    return info
+
+
+def default_enabled(function):
+    """Value of the last self.enabled = True/False in the function, if any"""
+    enabled = None
+    for node in ast.walk(function):
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) \
+                and isinstance(node.value.value, bool):
+            for target in node.targets:
+                if isinstance(target, ast.Attribute) and target.attr == 'enabled' \
+                        and isinstance(target.value, ast.Name) and target.value.id == 'self':
+                    enabled = node.value.value
+    return enabled
+
+
+def constant_return(function):
+    body = [node for node in function.body if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant))]
+    if len(body) == 1 and isinstance(body[0], ast.Return) and isinstance(body[0].value, ast.Constant) \
+            and isinstance(body[0].value.value, str):
+        return body[0].value.value
+    return None
+
+
+class UnloadedModule(BotModule):
+    """Stands in for a module that hasn't been imported yet
+
+    Keeps the module's settings as they were read, so that they are saved unchanged
+    and given to the module when it's imported.
+    """
+
+    def __init__(self, name, path, info):
+        super().__init__(name)
+        self.path = path
+        self.enabled = info['enabled']
+        self.help_text = info['help']
+        self.settings = None
+
+    async def matrix_message(self, bot, room, event):
+        pass
+
+    def matrix_start(self, bot):
+        pass
+
+    def matrix_stop(self, bot):
+        pass
+
+    def help(self):
+        return self.help_text or 'Not loaded'
+
+    def get_settings(self):
+        data = dict(self.settings or {})
+        data['enabled'] = self.enabled
+        return data
+
+    def set_settings(self, data):
+        super().set_settings(data)
+        self.settings = data
+
+
+def discover_module(path):
+    """
+    :param path: path to the module's python file
+    :return: UnloadedModule for it
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        info = read_module_info(path)
+    except (OSError, SyntaxError, ValueError):
+        # Import it to find out, errors get logged then
+        info = {'enabled': True, 'help': None}
+    return UnloadedModule(name, path, info)
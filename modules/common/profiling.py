@@ -0,0 +1,135 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+
+class LoopProfiler:
+    """Profiles the event loop thread for a while with cProfile
+
+    Everything running in the event loop is profiled: commands, jobs, callbacks and the
+    sync loop. Functions run with bot.run_blocking() run in other threads and show up
+    only as time spent waiting for them.
+    """
+
+    def __init__(self):
+        self.profile = None
+        self.running = False
+
+    async def run(self, seconds):
+        """Profile for given number of seconds
+
+        :return: the cProfile.Profile
+        """
+        if self.running:
+            raise RuntimeError('Profiling is already running')
+        self.running = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+        finally:
+            self.running = False
+        self.profile = profile
+        return profile
+
+    @staticmethod
+    def report(profile, top=30, sort='cumulative'):
+        """:return: text with top functions sorted by cumulative time"""
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+        return stream.getvalue().strip()
+
+
+class MemoryTracer:
+    """Finds out where memory is allocated, with tracemalloc
+
+    Tracing slows down the bot and uses memory itself, so it's only on between start()
+    and stop(). Allocations are grouped by the source file they were made in. Each
+    snapshot is compared to the previous one to see where memory use grows.
+    """
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.previous = None
+        self.started_here = False
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_here = True
+        self.previous = None
+
+    def stop(self):
+        if self.started_here:
+            tracemalloc.stop()
+            self.started_here = False
+        self.previous = None
+
+    def snapshot(self):
+        """Take a snapshot, ignoring allocations made by tracing itself
+
+        :return: (snapshot, previous snapshot or None)
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+        previous = self.previous
+        self.previous = snapshot
+        return snapshot, previous
+
+    @staticmethod
+    def report(snapshot, previous=None, top=20):
+        """:return: text with files allocating most memory, and those growing most since previous snapshot"""
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'Traced memory: {format_size(current)}, peak {format_size(peak)}',
+                 f'Top {top} files by allocated memory:']
+        for stat in snapshot.statistics('filename')[:top]:
+            lines.append(f'{format_size(stat.size):>10} {stat.count:>8} blocks  {short_path(stat.traceback[0].filename)}')
+        if previous:
+            lines.append(f'Top {top} files by growth since previous snapshot:')
+            for stat in snapshot.compare_to(previous, 'filename')[:top]:
+                if stat.size_diff == 0:
+                    break
+                sign = '+' if stat.size_diff > 0 else '-'
+                lines.append(f'{sign + format_size(abs(stat.size_diff)):>11} {stat.count_diff:>+8} blocks  '
+                             f'{short_path(stat.traceback[0].filename)}')
+        return '\n'.join(lines)
+
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GiB'
+
+
+def short_path(filename):
+    """Path relative to the bot directory, or to site-packages for libraries"""
+    cwd = os.getcwd() + os.sep
+    if filename.startswith(cwd):
+        return filename[len(cwd):]
+    marker = 'site-packages' + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return filename
+
+
+def dump_path(directory, kind, extension):
+    """:return: path for a dump file named by kind and current time"""
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'hemppa-{kind}-{time.strftime("%Y%m%d-%H%M%S")}.{extension}')
@@ -0,0 +1,272 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+
+class CronSpec:
+    """Minimal cron expression: minute hour day-of-month month day-of-week
+
+    Fields support *, numbers, ranges (1-5), lists (1,15) and steps (*/10, 8-18/2).
+    Day of week is 0-6, 0 being Sunday (7 is accepted as Sunday too).
+    """
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, spec):
+        self.spec = spec
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron spec needs 5 fields, got "{spec}"')
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            CronSpec.parse_field(field, low, high) for field, (low, high) in zip(fields, CronSpec.RANGES)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(v) for v in part.split('-', 1)]
+            else:
+                start = end = int(part)
+                if step > 1:
+                    end = high
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f'Invalid cron field "{field}"')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, dt):
+        weekday = (dt.weekday() + 1) % 7  # cron counts from sunday
+        if self.any_day:
+            return self.any_weekday or weekday in self.weekdays
+        if self.any_weekday:
+            return dt.day in self.days
+        # Like cron, if both are restricted either one matching is enough
+        return dt.day in self.days or weekday in self.weekdays
+
+    def next_after(self, dt):
+        """Next matching time after given datetime, on a whole minute"""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt = dt + timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f'Cron spec "{self.spec}" never matches')
+
+
+class Job:
+    """A function run by the scheduler periodically
+
+    overrun tells what to do when the job is due while its previous run is still going:
+    'skip' skips the run, 'coalesce' runs the job once more right after the previous run ends.
+    Runs missed while the bot was busy are never run more than once.
+    """
+
+    def __init__(self, name, func, interval=None, cron=None, jitter=0, overrun='skip', run_now=False):
+        if not interval and not cron:
+            raise ValueError('Job needs an interval or a cron spec')
+        if overrun not in ['skip', 'coalesce']:
+            raise ValueError(f'Unknown overrun policy {overrun}')
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.cron = CronSpec(cron) if cron else None
+        self.jitter = jitter
+        self.overrun = overrun
+        self.next_run = None  # Unix time
+        self.due = None  # Next run without jitter, used to keep interval jobs from drifting
+        self.task = None
+        self.pending = False
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_start = None
+        self.last_duration = None
+        self.schedule(time.time(), run_now)
+
+    def schedule(self, now, run_now=False):
+        if run_now:
+            self.due = now
+        elif self.cron:
+            self.due = self.cron.next_after(datetime.fromtimestamp(now)).timestamp()
+        elif self.due is None:
+            self.due = now + self.interval
+        else:
+            self.due += self.interval
+            if self.due <= now:
+                # Fell behind, continue from now on the same beat
+                missed = int((now - self.due) // self.interval) + 1
+                self.skipped += missed
+                self.due += missed * self.interval
+        self.next_run = self.due + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def labels(self):
+        """Module and job name, for metrics"""
+        module, _, name = self.name.partition('.')
+        return module, name
+
+    def describe(self):
+        if self.cron:
+            return f'cron "{self.cron.spec}"'
+        return f'every {self.interval:g}s'
+
+
+class Scheduler:
+    """Runs jobs at their own intervals or cron times, concurrently
+
+    Jobs are kept in a heap ordered by next run time and a single task sleeps until
+    the next one is due.
+    """
+
+    def __init__(self, metrics=None):
+        """
+        :param metrics: Metrics to record job durations and failures in, optional
+        """
+        self.logger = logging.getLogger("hemppa.scheduler")
+        self.job_duration = None
+        self.job_failures = None
+        if metrics:
+            self.job_duration = metrics.histogram('hemppa_job_duration_seconds',
+                                                  'Time taken by scheduled jobs, including matrix_poll', ['module', 'job'])
+            self.job_failures = metrics.counter('hemppa_job_failures_total',
+                                                'Scheduled jobs that raised an exception', ['module', 'job'])
+            metrics.callback('hemppa_job_skipped_total', 'Job runs skipped because previous run was still going',
+                             'counter', lambda: {job.labels(): job.skipped for job in self.jobs.values()},
+                             ['module', 'job'])
+        self.jobs = dict()  # name -> Job
+        self.heap = []  # (next run, sequence number, job)
+        self.sequence = 0
+        self.wakeup = None
+        self.task = None
+
+    def add_job(self, name, func, interval=None, cron=None, jitter=0, overrun='skip', run_now=False):
+        """Add a job, replacing any existing job with same name
+
+        :param name: unique name of the job, prefix with module name
+        :param func: coroutine function to run, called without arguments
+        :param interval: seconds between runs
+        :param cron: cron spec (minute hour day month weekday) to run on, instead of interval
+        :param jitter: random delay up to this many seconds added to each run
+        :param overrun: 'skip' or 'coalesce', see Job
+        :param run_now: run first time right away instead of after the interval
+        :return: the Job
+        """
+        self.remove_job(name)
+        job = Job(name, func, interval=interval, cron=cron, jitter=jitter, overrun=overrun, run_now=run_now)
+        self.jobs[name] = job
+        self.push(job)
+        return job
+
+    def remove_job(self, name):
+        job = self.jobs.pop(name, None)
+        if job and job.task and not job.task.done():
+            job.task.cancel()
+        # Stale heap entries are dropped when they come up
+        return job
+
+    def remove_jobs(self, prefix):
+        for name in [name for name in self.jobs if name.startswith(prefix)]:
+            self.remove_job(name)
+
+    def push(self, job):
+        self.sequence += 1
+        heapq.heappush(self.heap, (job.next_run, self.sequence, job))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+        for job in self.jobs.values():
+            if job.task and not job.task.done():
+                job.task.cancel()
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                next_run, _, job = heapq.heappop(self.heap)
+                if self.jobs.get(job.name) is not job or job.next_run != next_run:
+                    continue  # Removed or rescheduled
+                self.run_job(job, now)
+                job.schedule(now)
+                self.push(job)
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def run_job(self, job, now):
+        if job.task and not job.task.done():
+            if job.overrun == 'coalesce':
+                job.pending = True
+            else:
+                job.skipped += 1
+                self.logger.warning(f'Job {job.name} is still running, skipping this run')
+            return
+        job.task = asyncio.get_running_loop().create_task(self.execute(job))
+
+    async def execute(self, job):
+        while True:
+            job.pending = False
+            job.last_start = time.time()
+            started = time.monotonic()
+            try:
+                await job.func()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                job.failures += 1
+                if self.job_failures:
+                    self.job_failures.inc(*job.labels())
+                self.logger.exception(f'unhandled exception from job {job.name}')
+            finally:
+                job.runs += 1
+                job.last_duration = time.monotonic() - started
+                if self.job_duration:
+                    self.job_duration.observe(job.last_duration, *job.labels())
+            if not job.pending:
+                return
+
+    def status(self):
+        """Human readable list of jobs"""
+        now = time.time()
+        lines = []
+        for name, job in sorted(self.jobs.items()):
+            line = f'{name}: {job.describe()}, next in {max(0, job.next_run - now):.0f}s, runs {job.runs}'
+            if job.last_duration is not None:
+                line += f', last took {job.last_duration * 1000:.0f}ms'
+            if job.skipped:
+                line += f', skipped {job.skipped}'
+            if job.failures:
+                line += f', failed {job.failures}'
+            if job.task and not job.task.done():
+                line += ', running now'
+            lines.append(line)
+        return lines
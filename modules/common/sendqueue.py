@@ -0,0 +1,205 @@
+import asyncio
+import contextvars
+import logging
+import time
+import uuid
+from collections import deque
+
+from aiohttp import ClientConnectionError
+from nio import ErrorResponse
+
+# Set while running a command, so replies to users go before notifications from polling and jobs
+interactive = contextvars.ContextVar('hemppa_interactive', default=False)
+
+
+class OutgoingMessage:
+    def __init__(self, room_id, msgtype, content, kwargs, interactive):
+        self.room_id = room_id
+        self.msgtype = msgtype
+        self.content = content
+        self.kwargs = dict(kwargs)
+        # Same transaction id on every attempt, so the server ignores a retry of a send that got through
+        self.tx_id = self.kwargs.pop('tx_id', None) or str(uuid.uuid4())
+        self.interactive = interactive
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+
+class SendQueue:
+    """Sends messages to rooms at a pace the homeserver accepts
+
+    Messages to the same room are sent one at a time in the order they were queued.
+    Rooms with replies to commands waiting are served before rooms with only
+    notifications from polling and jobs.
+
+    Sending is paced with a token bucket: up to burst messages are sent right away,
+    after that rate messages per second. When the server says the bot is sending too
+    fast, all sending pauses for the time the server asks. Sends failing because of
+    connection problems are retried with exponential backoff, with the same transaction
+    id so that a message the server did get is not posted twice.
+    """
+
+    def __init__(self, send_func, rate=5.0, burst=10, concurrency=4, max_retries=5, backoff=1.0, max_backoff=60.0):
+        """
+        :param send_func: coroutine function (room_id, msgtype, content, tx_id=..., **kwargs) doing the actual sending
+        """
+        self.logger = logging.getLogger("hemppa.sendqueue")
+        self.send_func = send_func
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rooms = dict()  # room id -> deque of OutgoingMessage, only rooms with messages waiting
+        self.busy_rooms = set()  # rooms with a message being sent
+        self.tokens = burst
+        self.token_time = time.monotonic()
+        self.paused_until = 0  # monotonic time
+        self.wakeup = None
+        self.workers = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limits = 0
+        self.max_wait = 0
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self.workers = [loop.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout=10):
+        """Send what is still queued, waiting at most timeout seconds, then stop"""
+        deadline = time.monotonic() + timeout
+        while (self.rooms or self.busy_rooms) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        for queue in self.rooms.values():
+            for message in queue:
+                message.future.cancel()
+        self.rooms.clear()
+
+    async def send(self, room_id, msgtype, content, **kwargs):
+        """Queue a message and wait until it has been sent
+
+        :return: the nio response of the send
+        """
+        message = OutgoingMessage(room_id, msgtype, content, kwargs, interactive.get())
+        self.rooms.setdefault(room_id, deque()).append(message)
+        if self.wakeup:
+            self.wakeup.set()
+        return await message.future
+
+    def rate_limited(self, retry_after_ms):
+        """Pause all sending, called when server responds with M_LIMIT_EXCEEDED"""
+        self.rate_limits += 1
+        delay = (retry_after_ms or 5000) / 1000
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.logger.warning(f'Rate limited by server, pausing sending for {delay:.1f} seconds')
+
+    def pick_room(self):
+        best = None
+        for room_id, queue in self.rooms.items():
+            if room_id in self.busy_rooms:
+                continue
+            key = (not any(message.interactive for message in queue), queue[0].queued_at)
+            if best is None or key < best[0]:
+                best = (key, room_id)
+        return best[1] if best else None
+
+    def take_token(self):
+        """:return: seconds to wait before a message may be sent, 0 if a token was taken"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.token_time) * self.rate)
+        self.token_time = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0
+
+    async def next_message(self):
+        while True:
+            room_id = self.pick_room()
+            if room_id is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            delay = self.take_token()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            queue = self.rooms[room_id]
+            message = queue.popleft()
+            if not queue:
+                del self.rooms[room_id]
+            self.busy_rooms.add(room_id)
+            return message
+
+    async def worker(self):
+        while True:
+            message = await self.next_message()
+            try:
+                self.max_wait = max(self.max_wait, time.monotonic() - message.queued_at)
+                await self.deliver(message)
+            finally:
+                self.busy_rooms.discard(message.room_id)
+                self.wakeup.set()
+
+    async def deliver(self, message):
+        if message.future.cancelled():
+            return  # Sender gave up waiting, e.g. command timed out
+        attempt = 0
+        while True:
+            try:
+                response = await self.send_func(message.room_id, message.msgtype, message.content,
+                                                tx_id=message.tx_id, **message.kwargs)
+                error = None
+                if isinstance(response, ErrorResponse) and response.status_code == 'M_LIMIT_EXCEEDED':
+                    self.rate_limited(response.retry_after_ms)
+                    error = response.message
+            except asyncio.CancelledError:
+                raise
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                response = None
+                error = e
+            except Exception as e:
+                self.failed += 1
+                if not message.future.done():
+                    message.future.set_exception(e)
+                return
+
+            if error is None or attempt >= self.max_retries:
+                if error is None and not isinstance(response, ErrorResponse):
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                    self.logger.error(f'Sending to {message.room_id} failed: {error or response}')
+                if message.future.done():
+                    return
+                if response is None:
+                    message.future.set_exception(error)
+                else:
+                    message.future.set_result(response)
+                return
+
+            attempt += 1
+            self.retried += 1
+            if response is not None:
+                # Rate limited, server told how long to wait
+                delay = max(0, self.paused_until - time.monotonic())
+            else:
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+            self.logger.warning(f'Sending to {message.room_id} failed ({error}), retrying in {delay:.1f} seconds')
+            await asyncio.sleep(delay)
+
+    def status(self):
+        interactive_count = sum(1 for queue in self.rooms.values() for message in queue if message.interactive)
+        queued = sum(len(queue) for queue in self.rooms.values())
+        return f'{queued} queued ({interactive_count} replies), {len(self.busy_rooms)} sending, ' \
+               f'{self.sent} sent, {self.retried} retried, {self.failed} failed, ' \
+               f'rate limited {self.rate_limits} times, longest wait {self.max_wait:.1f}s'
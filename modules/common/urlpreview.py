@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+
+class Preview:
+    """What was found about a link. error is set if fetching it failed."""
+
+    def __init__(self, title=None, description=None, image=None, error=None):
+        self.title = title
+        self.description = description
+        self.image = image  # url of og:image
+        self.error = error
+        self.expires = 0  # monotonic time
+
+    def __repr__(self):
+        return f'Preview(title={self.title!r}, description={self.description!r}, image={self.image!r}, ' \
+               f'error={self.error!r})'
+
+
+class UrlPreviews:
+    """Fetches link previews for modules, with caching and limits
+
+    Lives in the bot rather than in a module, so the cache survives module reloads.
+    Modules give the function that does the actual fetching:
+
+        previews = await bot.url_previews.get_many(urls, self.fetch_preview)
+
+    The fetch function is a coroutine function taking the url and returning a Preview,
+    or raising an exception if the link could not be fetched. Failures are cached too,
+    for a shorter time, so a broken link posted again isn't fetched again right away.
+
+    Links are fetched concurrently, at most concurrency in total and per_host from a
+    single host. When the same link is asked for again while it's being fetched, e.g.
+    posted to many rooms, it's fetched only once.
+    """
+
+    def __init__(self, max_entries=1000, ttl=24 * 60 * 60, error_ttl=10 * 60, concurrency=8, per_host=2):
+        """
+        :param ttl: seconds previews are cached
+        :param error_ttl: seconds failures are cached
+        """
+        self.logger = logging.getLogger("hemppa.urlpreview")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.entries = OrderedDict()  # url -> Preview, most recently used last
+        self.pending = dict()  # url -> Task fetching it
+        self.slots = None
+        self.host_slots = dict()  # host -> [Semaphore, number of fetches using it]
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def lookup(self, url):
+        """:return: cached Preview or None"""
+        preview = self.entries.get(url)
+        if preview is None:
+            return None
+        if preview.expires <= time.monotonic():
+            del self.entries[url]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(url)
+        return preview
+
+    async def get(self, url, fetch, ttl=None):
+        """
+        :param fetch: coroutine function (url) -> Preview
+        :param ttl: seconds to cache this preview, instead of the default
+        :return: Preview, check its error
+        """
+        preview = self.lookup(url)
+        if preview is not None:
+            self.hits += 1
+            return preview
+        task = self.pending.get(url)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.get_running_loop().create_task(self.fetch(url, fetch, ttl))
+            self.pending[url] = task
+            task.add_done_callback(lambda _: self.pending.pop(url, None))
+        # Shielded so that a caller giving up doesn't cancel the fetch for others
+        return await asyncio.shield(task)
+
+    async def get_many(self, urls, fetch, ttl=None):
+        """:return: list of Previews in the same order as urls"""
+        return await asyncio.gather(*[self.get(url, fetch, ttl) for url in urls])
+
+    async def fetch(self, url, fetch, ttl):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        host = httpx.URL(url).host
+        entry = self.host_slots.get(host)
+        if entry is None:
+            entry = self.host_slots[host] = [asyncio.Semaphore(self.per_host), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self.slots:
+                try:
+                    preview = await fetch(url)
+                    preview.expires = time.monotonic() + (ttl if ttl is not None else self.ttl)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.errors += 1
+                    self.logger.warning(f'Could not get preview of {url}: {e}')
+                    preview = Preview(error=str(e) or type(e).__name__)
+                    preview.expires = time.monotonic() + self.error_ttl
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.host_slots[host]
+        self.entries[url] = preview
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return preview
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        hit_rate = 100 * (self.hits + self.coalesced) / lookups if lookups else 0
+        failed = sum(1 for preview in self.entries.values() if preview.error)
+        return f'{len(self.entries)} previews cached ({failed} failures), {len(self.pending)} fetching, ' \
+               f'{self.hits} hits, {self.misses} misses, {self.coalesced} coalesced ({hit_rate:.0f}% hit rate), ' \
+               f'{self.errors} errors, {self.expirations} expired, {self.evictions} evicted'
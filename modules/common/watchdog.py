@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+class LoopWatchdog:
+    """Finds code that blocks the event loop
+
+    A task in the event loop updates a heartbeat every interval seconds. A thread checks
+    the heartbeat and when it's older than threshold seconds, takes the stack of the event
+    loop thread. The stack is logged, attributed to the bot module whose code was running,
+    so it shows up in !bot logs for that module. When the loop runs again, the total time
+    it was blocked is logged too.
+    """
+
+    def __init__(self, threshold=0.5, interval=None, metrics=None):
+        """
+        :param threshold: seconds the loop may be blocked before it's reported
+        :param interval: seconds between heartbeats and checks, default a quarter of threshold
+        :param metrics: Metrics to count blocks in, optional
+        """
+        self.logger = logging.getLogger("hemppa.watchdog")
+        self.threshold = threshold
+        self.interval = interval or threshold / 4
+        self.modules_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '')
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+        self.task = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.blocks = 0
+        self.blocked_counter = None
+        if metrics:
+            self.blocked_counter = metrics.counter('hemppa_event_loop_blocked_total',
+                                                   'Times the event loop was blocked longer than the watchdog threshold',
+                                                   ['module'])
+
+    def start(self):
+        """Call from the event loop thread"""
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopping.clear()
+        self.task = asyncio.get_running_loop().create_task(self.beat())
+        self.thread = threading.Thread(target=self.watch, name='hemppa-watchdog', daemon=True)
+        self.thread.start()
+        self.logger.info(f'Reporting event loop blocked for over {self.threshold:g} seconds')
+
+    def stop(self):
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def watch(self):
+        blocked_since = None
+        module = None
+        while not self.stopping.wait(self.interval):
+            heartbeat = self.heartbeat
+            lag = time.monotonic() - heartbeat - self.interval
+            if lag > self.threshold and blocked_since != heartbeat:
+                blocked_since = heartbeat
+                module = self.report(lag)
+            elif blocked_since is not None and heartbeat != blocked_since:
+                total = heartbeat - blocked_since - self.interval
+                self.logger.warning(f'Event loop was blocked for {total:.2f} seconds',
+                                    extra={'hemppa_module': module})
+                blocked_since = None
+
+    def report(self, lag):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        del frame
+        # Drop the event loop's own frames, the callback that is running is what matters
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].filename.endswith(os.path.join('asyncio', 'events.py')):
+                stack = stack[i + 1:]
+                break
+        module = self.attribute(stack)
+        self.blocks += 1
+        if self.blocked_counter:
+            self.blocked_counter.inc(module)
+        self.logger.warning(f'Event loop blocked for over {lag:.2f} seconds in {module}, at:\n'
+                            + ''.join(traceback.format_list(stack[-12:])).rstrip(),
+                            extra={'hemppa_module': module})
+        return module
+
+    def attribute(self, stack):
+        """:return: name of the bot module whose code was running, innermost first"""
+        common = None
+        for entry in reversed(stack):
+            filename = os.path.abspath(entry.filename)
+            if not filename.startswith(self.modules_dir):
+                continue
+            relative = filename[len(self.modules_dir):]
+            name = os.path.splitext(relative)[0]
+            if os.sep not in relative:
+                return name
+            if common is None:
+                common = name.replace(os.sep, '.')
+        if common:
+            return common
+        return 'hemppa'
@@ -7,7 +7,10 @@ from .common.module import BotModule
 
 class MatrixModule(BotModule):
     daily_commands = dict()  # room_id -> command json
-    last_hour = datetime.now().hour
+
+    def matrix_start(self, bot):
+        super().matrix_start(bot)
+        self.add_job(bot, 'hourly', lambda: self.run_commands(bot), cron='0 * * * *')
 
     async def matrix_message(self, bot, room, event):
         bot.must_be_admin(room, event)
@@ -47,19 +50,18 @@ class MatrixModule(BotModule):
         if data.get('daily_commands'):
             self.daily_commands = data['daily_commands']
 
-    async def matrix_poll(self, bot, pollcount):
+    async def run_commands(self, bot):
         delete_rooms = []
-        if self.last_hour != datetime.now().hour:
-            self.last_hour = datetime.now().hour
+        hour = datetime.now().hour
 
-            for room_id in self.daily_commands:
-                if room_id in bot.client.rooms:
-                    commands = self.daily_commands[room_id]
-                    for command in commands:
-                        if int(command['time']) == self.last_hour:
-                            await bot.send_text(bot.get_room_by_id(room_id), command['command'], 'm.text')
-                else:
-                    delete_rooms.append(room_id)
+        for room_id in self.daily_commands:
+            if room_id in bot.client.rooms:
+                commands = self.daily_commands[room_id]
+                for command in commands:
+                    if int(command['time']) == hour:
+                        await bot.send_text(bot.get_room_by_id(room_id), command['command'], 'm.text')
+            else:
+                delete_rooms.append(room_id)
 
         for roomid in delete_rooms:
             self.daily_commands.pop(roomid, None)
@@ -4,16 +4,12 @@ import traceback
 import json
 import time
 import datetime
-import requests
-import urllib3
 
 from datetime import datetime, timedelta
 from random import randrange
 
 from modules.common.module import BotModule
 
-urllib3.disable_warnings()
-
 # API docs at: https://gitlab.com/lemoidului/ogn-flightbook/-/blob/master/doc/API.md
 class FlightBook:
     def __init__(self):
@@ -25,12 +21,10 @@ class FlightBook:
         self.logged_flights = dict() # station -> [index of flight]
         self.device_cache = dict() # Registration -> [address, CN]
 
-    def get_flights(self, icao):
+    async def get_flights(self, http, icao):
         log_url = f'{self.base_url}/logbook/{icao}'
-        data = None
-        with requests.Session() as session:
-            response = session.get(log_url, headers={'Connection': 'close'}, verify=False)
-            data = response.json()
+        response = await http.get(log_url, verify=False)
+        data = response.json()
 
         # print(json.dumps(data, sort_keys=True, indent=4))
         self.update_device_cache(data)
@@ -85,9 +79,9 @@ class FlightBook:
                 continue
             print(self.flight2string(flight, data))
 
-    def test():
+    async def test(http):
         fb = FlightBook()
-        data = fb.get_flights('LFMX')
+        data = await fb.get_flights(http, 'LFMX')
         fb.print_flights(data)
 
 class MatrixModule(BotModule):
@@ -104,15 +98,12 @@ class MatrixModule(BotModule):
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.add_module_aliases(bot, ['sar'])
-
-    async def matrix_poll(self, bot, pollcount):
-        if pollcount % (6 * 5) == 0:  # Poll every 5 min
-            await self.poll_implementation(bot)
+        self.add_job(bot, 'poll', lambda: self.poll_implementation(bot), interval=5 * 60, jitter=10)
 
     async def poll_implementation(self, bot):
         for roomid in self.live_rooms:
             station = self.station_rooms[roomid]
-            data = self.fb.get_flights(station)
+            data = await self.fb.get_flights(bot.http, station)
             if not data:
                 self.logger.warning(f"FLOG: Failed to get flights at {station}!")
                 return
@@ -188,7 +179,7 @@ class MatrixModule(BotModule):
 
             coords = None
             if address:
-                coords = self.get_coords_for_address(address)
+                coords = await self.get_coords_for_address(bot, address)
             if coords:
                 await bot.send_location(room, f'{registration} ({coords["utc"]})', coords["lat"], coords["lng"])
             else:
@@ -206,13 +197,11 @@ class MatrixModule(BotModule):
                 await bot.send_text(room, f'Set OGN station {station} to this room')
 
 
-    def get_coords_for_address(self, address):
+    async def get_coords_for_address(self, bot, address):
         # https://flightbook.glidernet.org/api/live/address/~91DADF5B86
         url = f'{self.fb.base_url}/live/address/{address}'
-        data = None
-        with requests.Session() as session:
-            response = session.get(url, headers={'Connection': 'close'}, verify=False)
-            data = response.json()
+        response = await bot.http.get(url, verify=False)
+        data = response.json()
 
         # print(json.dumps(data, sort_keys=True, indent=4))
         return data
@@ -223,12 +212,13 @@ class MatrixModule(BotModule):
         if len(data["flights"]) == 0:
             out = f'No known flights today at {data["airfield"]["name"]}'
         else:
-            out = f'Flights at {data["airfield"]["name"]} ({data["airfield"]["code"]}) {data["date"]}:' + "\n"
+            lines = [f'Flights at {data["airfield"]["name"]} ({data["airfield"]["code"]}) {data["date"]}:']
             flights = data['flights']
             for flight in flights:
                 if not showtow and flight["towing"]:
                     continue
-                out = out + self.fb.flight2string(flight, data) + "\n"
+                lines.append(self.fb.flight2string(flight, data))
+            out = "\n".join(lines) + "\n"
         return out
 
     def html_flog(self, data, showtow):
@@ -238,16 +228,17 @@ class MatrixModule(BotModule):
         else:
             out = f'<b>✈ Flights at {data["airfield"]["name"]} ({data["airfield"]["code"]}) {data["date"]}:' + "</b>\n"
             flights = data['flights']
-            out = out + "<ul>"
+            # Joined at the end, adding to the string in the loop copies it for every flight
+            items = []
             for flight in flights:
                 if not showtow and flight["towing"]:
                     continue
-                out = out + "<li>" + self.fb.flight2string(flight, data) + "</li>\n"
-            out = out + "</ul>"
+                items.append("<li>" + self.fb.flight2string(flight, data) + "</li>\n")
+            out = out + "<ul>" + "".join(items) + "</ul>"
         return out
 
     async def show_flog(self, bot, room, station):
-        data = self.fb.get_flights(station)
+        data = await self.fb.get_flights(bot.http, station)
         if data:
             await bot.send_html(room, self.html_flog(data, False), self.text_flog(data, False))
         else:
@@ -1,8 +1,3 @@
-import urllib.request
-import urllib.parse
-import urllib.error
-
-import requests
 from nio import AsyncClient, UploadError
 from nio import UploadResponse
 
@@ -18,23 +13,21 @@ class gfycat(object):
     # Urls
     url = "https://api.gfycat.com"
 
-    def __init__(self):
+    def __init__(self, http):
         super(gfycat, self).__init__()
-
-    def __fetch(self, url, param):
-        import json
-        try:
-            # added simple User-Ajent string to avoid CloudFlare block this request
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            req = urllib.request.Request(url+param, headers=headers)
-            connection = urllib.request.urlopen(req).read()
-        except urllib.error.HTTPError as err:
-            raise ValueError(err.read())
+        self.http = http
+
+    async def __fetch(self, url, path, params):
+        # added simple User-Ajent string to avoid CloudFlare block this request
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        response = await self.http.get(url + path, params=params, headers=headers)
+        if response.status_code != 200:
+            raise ValueError(response.content)
         result = namedtuple("result", "raw json")
-        return result(raw=connection, json=json.loads(connection))
+        return result(raw=response.content, json=response.json())
 
-    def search(self, param):
-        result = self.__fetch(self.url, "/v1/gfycats/search?search_text=%s" % urllib.parse.quote_plus(param))
+    async def search(self, param):
+        result = await self.__fetch(self.url, "/v1/gfycats/search", {'search_text': param})
         if "errorMessage" in result.json:
             raise ValueError("%s" % self.json["errorMessage"])
         return _gfycatSearch(result)
@@ -83,7 +76,7 @@ class MatrixModule(BotModule):
             gif_url = "No image found"
             query = event.body[len(args[0])+1:]
             try:
-                gifs = gfycat().search(query)
+                gifs = await gfycat(bot.http).search(query)
                 if len(gifs) < 1:
                     await bot.send_text(room, gif_url)
                     return
@@ -91,7 +91,7 @@ class MatrixModule(BotModule):
             domain = args[0]
             reponame = self.repo_rooms.get(room.room_id, None)
             if reponame:
-                issues, ok = GithubProject.get_domain(reponame, domain)
+                issues, ok = await bot.run_blocking(GithubProject.get_domain, reponame, domain)
                 if issues or ok:
                     await self.send_domain_status(bot, room, reponame, issues, ok)
                 else:
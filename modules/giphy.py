@@ -1,10 +1,5 @@
-import urllib.request
-import urllib.parse
-import urllib.error
-
 import os
 import giphypop
-import requests
 from nio import AsyncClient, UploadError
 from nio import UploadResponse
 
@@ -29,8 +24,7 @@ class MatrixModule(BotModule):
                 g = giphypop.Giphy(api_key=self.api_key)
                 gifs = []
                 try:
-                    for x in g.search(phrase=query, limit=1):
-                        gifs.append(x)
+                    gifs = await bot.run_blocking(lambda: list(g.search(phrase=query, limit=1)))
                 except Exception:
                     pass
                 if len(gifs) < 1:
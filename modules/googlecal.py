@@ -32,11 +32,15 @@ class MatrixModule(BotModule):
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.bot = bot
-        creds = None
 
+    async def matrix_start_async(self, bot):
         if not os.path.exists(self.credentials_file) or os.path.getsize(self.credentials_file) == 0:
             return  # No-op if not set up
+        # Refreshing credentials and listing calendars are blocking network requests
+        self.service = await bot.run_blocking(self.connect)
 
+    def connect(self):
+        creds = None
         if os.path.exists('token.pickle'):
             with open('token.pickle', 'rb') as token:
                 creds = pickle.load(token)
@@ -55,15 +59,16 @@ class MatrixModule(BotModule):
                 pickle.dump(creds, token)
                 self.logger.info('Pickle saved')
 
-        self.service = build('calendar', 'v3', credentials=creds)
+        service = build('calendar', 'v3', credentials=creds)
 
         try:
-            calendar_list = self.service.calendarList().list().execute()['items']
+            calendar_list = service.calendarList().list().execute()['items']
             self.logger.info(f'Google calendar set up successfully with access to {len(calendar_list)} calendars:\n')
             for calendar in calendar_list:
                 self.logger.info(f"{calendar['summary']} - + {calendar['id']}")
         except Exception:
             self.logger.error('Getting calendar list failed!')
+        return service
 
     async def matrix_message(self, bot, room, event):
         if not self.service:
@@ -77,7 +82,7 @@ class MatrixModule(BotModule):
             if args[1] == 'today':
                 for calid in calendars:
                     self.logger.info(f'Listing events in cal {calid}')
-                    events = events + self.list_today(calid)
+                    events = events + await bot.run_blocking(self.list_today, calid)
             if args[1] == 'list':
                 await bot.send_text(room, 'Calendars in this room: ' + str(self.calendar_rooms.get(room.room_id)))
                 return
@@ -124,7 +129,7 @@ class MatrixModule(BotModule):
         else:
             for calid in calendars:
                 self.logger.info(f'Listing events in cal {calid}')
-                events = events + self.list_upcoming(calid)
+                events = events + await bot.run_blocking(self.list_upcoming, calid)
 
         if len(events) > 0:
             self.logger.info(f'Found {len(events)} events')
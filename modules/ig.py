@@ -19,7 +19,7 @@ class MatrixModule(PollingService):
 
     async def poll_implementation(self, bot, account, roomid, send_messages):
         try:
-            medias = self.instagram.get_medias(account, 5)
+            medias = await bot.run_blocking(self.instagram.get_medias, account, 5)
             self.logger.info(f'Polling instagram account {account} for room {roomid} - got {len(medias)} posts.')
             for media in medias:
                 if send_messages:
@@ -1,5 +1,4 @@
 import html
-import requests
 
 from modules.common.module import BotModule
 
@@ -9,7 +8,6 @@ class MatrixModule(BotModule):
     def __init__(self, name):
         super().__init__(name)
         self.url_generator_url = "https://inspirobot.me/api?generate=true"
-        self.matrix_uri_cache = dict()
 
     async def matrix_message(self, bot, room, event):
         self.logger.debug(f"room: {room.name} sender: {event.sender} wants to be inspired!")
@@ -28,7 +26,7 @@ class MatrixModule(BotModule):
 
     async def send_inspiration(self, bot, room, url_generator_url):
         self.logger.debug(f"Asking inspirobot for pic url at {url_generator_url}")
-        response = requests.get(url_generator_url)
+        response = await bot.http.get(url_generator_url)
 
         if response.status_code != 200:
             self.logger.error("unable to request inspirobot api. response: [status: %d text: %s]", response.status_code, response.text)
@@ -1,4 +1,4 @@
-from nio import RoomMessageUnknown, UnknownEvent
+from nio import UnknownEvent
 
 from modules.common.module import BotModule
 
@@ -9,11 +9,7 @@ class MatrixModule(BotModule):
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.bot = bot
-        bot.client.add_event_callback(self.unknownevent_cb, (UnknownEvent,))
-
-    def matrix_stop(self, bot):
-        super().matrix_stop(bot)
-        bot.remove_callback(self.unknownevent_cb)
+        self.subscribe(bot, UnknownEvent, self.unknownevent_cb)
 
     async def unknownevent_cb(self, room, event):
         try:
@@ -8,16 +8,21 @@ class MatrixModule(BotModule):
     def __init__(self, name):
         super().__init__(name)
         self.bot = None
+        self.subscription = None
         self.enabled_rooms = []
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.bot = bot
-        bot.client.add_event_callback(self.unknown_cb, RoomMessageUnknown)
+        self.subscription = self.subscribe(bot, RoomMessageUnknown, self.unknown_cb, rooms=self.enabled_rooms)
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.unknown_cb)
+        self.subscription = None
+
+    def update_rooms(self):
+        if self.subscription:
+            self.subscription.set_rooms(self.enabled_rooms)
 
     '''
     Location events are like: https://spec.matrix.org/v1.2/client-server-api/#mlocation
@@ -70,8 +75,6 @@ class MatrixModule(BotModule):
     async def unknown_cb(self, room, event):
         if event.msgtype != 'm.location':
             return
-        if room.room_id not in self.enabled_rooms:
-            return
         location_text = event.content['body']
 
         # Fallback if body is empty
@@ -114,12 +117,14 @@ class MatrixModule(BotModule):
                 bot.must_be_admin(room, event)
                 self.enabled_rooms.append(room.room_id)
                 self.enabled_rooms = list(dict.fromkeys(self.enabled_rooms)) # Deduplicate
+                self.update_rooms()
                 await bot.send_text(room, "Ok, sending locations events here as text versions")
                 bot.save_settings()
                 return
             if args[0] == 'disable':
                 bot.must_be_admin(room, event)
                 self.enabled_rooms.remove(room.room_id)
+                self.update_rooms()
                 await bot.send_text(room, "Ok, disabled here")
                 bot.save_settings()
                 return
@@ -127,7 +132,7 @@ class MatrixModule(BotModule):
         query = event.body[4:]
         geolocator = Nominatim(user_agent=bot.appid)
         self.logger.info('loc: looking up %s ..', query)
-        location = geolocator.geocode(query)
+        location = await bot.run_blocking(geolocator.geocode, query)
         self.logger.info('loc rx %s', location)
         if location:
             await bot.send_location(room, location.address, location.latitude, location.longitude, "m.pin")
@@ -146,3 +151,4 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("enabled_rooms"):
             self.enabled_rooms = data["enabled_rooms"]
+            self.update_rooms()
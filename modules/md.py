@@ -32,7 +32,7 @@ class MatrixModule(BotModule):
                         access_token = accesstoken,
                         api_base_url = instanceurl
                     )
-                    tootdict = toottodon.toot(toot_body)
+                    tootdict = await bot.run_blocking(toottodon.toot, toot_body)
                     await bot.send_text(room, tootdict['url'])
                 else:
                     await bot.send_text(room, f'{event.sender} has not logged in yet with the bot. Please do so.')
@@ -108,14 +108,14 @@ class MatrixModule(BotModule):
 
     async def register_app_if_necessary(self, bot, room, instanceurl):
         if not instanceurl in self.apps.keys():
-            app = Mastodon.create_app(f'Hemppa The Bot - {bot.client.user}', api_base_url = instanceurl)
+            app = await bot.run_blocking(Mastodon.create_app, f'Hemppa The Bot - {bot.client.user}', api_base_url = instanceurl)
             self.apps[instanceurl] = [app[0], app[1]]
             bot.save_settings()
             await bot.send_text(room, f'Registered Mastodon app on {instanceurl}')
 
     async def login_to_account(self, bot, room, mxid, roomid, instanceurl, username, password):
         mastodon = Mastodon(client_id = self.apps[instanceurl][0], client_secret = self.apps[instanceurl][1], api_base_url = instanceurl)
-        access_token = mastodon.log_in(username, password)
+        access_token = await bot.run_blocking(mastodon.log_in, username, password)
         print('login_To_account', mxid, roomid)
         if mxid:
             self.logins[mxid] = [username, access_token, instanceurl]
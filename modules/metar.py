@@ -1,5 +1,3 @@
-import urllib.request
-
 from modules.common.module import BotModule
 
 
@@ -10,9 +8,10 @@ class MatrixModule(BotModule):
             icao = args[1]
             metar_url = "https://tgftp.nws.noaa.gov/data/observations/metar/stations/" + \
                         icao.upper() + ".TXT"
-            response = urllib.request.urlopen(metar_url)
-            lines = response.readlines()
-            await bot.send_text(room, lines[1].decode("utf-8").strip())
+            response = await bot.http.get(metar_url)
+            response.raise_for_status()
+            lines = response.text.splitlines()
+            await bot.send_text(room, lines[1].strip())
         else:
             await bot.send_text(room, 'Usage: !metar <icao code>')
 
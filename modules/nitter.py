@@ -1,41 +1,40 @@
-import re
-
+from modules.common.linkrewrite import DEFAULT_RULES, LinkRewriter
 from modules.common.module import BotModule
 from nio import RoomMessageText
 
 
-# This module reads matrix messages and converts twitter.com links to nitter.nl
-# Module will only target messages that contain only the twitter link
-# Additionally module will target only profile links or post links, query parameters are removed
+# This module reads matrix messages and converts links to privacy friendly front ends,
+# for example twitter.com links to nitter.net. Which rules are used is chosen per room.
+# All links converted from a message are sent in one reply.
 class MatrixModule(BotModule):
     def __init__(self, name):
         super().__init__(name)
-        self.regex = re.compile(r'https://twitter.com/([^?]*)')
+        self.rewriter = LinkRewriter(DEFAULT_RULES)
         self.bot = None
-        self.enabled_rooms = []
+        self.subscription = None
+        self.rooms = dict()  # room_id -> list of rule names used in the room
 
     def matrix_start(self, bot):
         """
-        Register callback for all RoomMessageText events on startup
+        Subscribe to RoomMessageText events in enabled rooms on startup
         """
         super().matrix_start(bot)
         self.bot = bot
-        bot.client.add_event_callback(self.text_cb, RoomMessageText)
+        self.subscription = self.subscribe(bot, RoomMessageText, self.text_cb, rooms=list(self.rooms))
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.text_cb)
+        self.subscription = None
+
+    def update_rooms(self):
+        self.rooms = {room_id: names for room_id, names in self.rooms.items() if names}
+        if self.subscription:
+            self.subscription.set_rooms(list(self.rooms))
 
     async def text_cb(self, room, event):
         """
-        Handle client callbacks for all room text events
+        Handle text events in enabled rooms
         """
-        if room.room_id not in self.enabled_rooms:
-            return
-
-        if self.bot.should_ignore_event(event):
-            return
-
         # no content at all?
         if len(event.body) < 1:
             return
@@ -43,45 +42,95 @@ class MatrixModule(BotModule):
         if event.body.startswith('!'):
             return
 
-        if len(event.body.split()) <= 1:
-            if event.body.startswith('https://twitter.com/'):
-                for link in self.regex.findall(event.body):
-                    await self.bot.send_text(room, f'https://nitter.net/{link}')
-                return
+        # skip edits, the links were converted from the original message already
+        if "m.new_content" in event.source.get("content", {}):
+            return
+
+        links = self.rewriter.rewrite(event.body, self.rooms.get(room.room_id, []))
+        if links:
+            await self.bot.send_text(room, '\n'.join(links), event=event)
 
     async def matrix_message(self, bot, room, event):
         """
-        Required for initialization of the module
+        commands for enabling and disabling rules in this room, listing them and adding or deleting rules
         """
         args = event.body.split()
         args.pop(0)
         if len(args) == 0:
-            await bot.send_text(room, 'Usage: !nitter <enable|disable>')
+            await bot.send_text(room, 'Usage: !nitter <enable|disable|rules> [rule ...]')
             return
-        if len(args) == 1:
+        if args[0] in ('enable', 'disable'):
+            bot.must_be_admin(room, event)
+            names = args[1:]
+            if not names:
+                # Converting twitter links was all this module used to do
+                names = ['twitter'] if args[0] == 'enable' else list(self.rewriter.rules)
+            elif names == ['all']:
+                names = list(self.rewriter.rules)
+            unknown = [name for name in names if name not in self.rewriter.rules]
+            if unknown:
+                await bot.send_text(room, f'Unknown rules: {", ".join(unknown)}. Known rules: '
+                                          f'{", ".join(self.rewriter.rules)}')
+                return
+            enabled = self.rooms.get(room.room_id, [])
             if args[0] == 'enable':
-                bot.must_be_admin(room, event)
-                self.enabled_rooms.append(room.room_id)
-                self.enabled_rooms = list(dict.fromkeys(self.enabled_rooms))  # Deduplicate
-                await bot.send_text(room, "Ok, enabling conversion of twitter links to nitter links here")
-                bot.save_settings()
+                enabled = list(dict.fromkeys(enabled + names))  # Deduplicate
+            else:
+                enabled = [name for name in enabled if name not in names]
+            self.rooms[room.room_id] = enabled
+            self.update_rooms()
+            bot.save_settings()
+            if enabled:
+                await bot.send_text(room, f'Ok, converting links here with rules: {", ".join(enabled)}')
+            else:
+                await bot.send_text(room, 'Ok, not converting links here')
+            return
+        if args[0] == 'rules':
+            enabled = self.rooms.get(room.room_id, [])
+            lines = [f'{name}{" (enabled here)" if name in enabled else ""}: {rule.pattern} -> {rule.replacement}'
+                     for name, rule in self.rewriter.rules.items()]
+            await bot.send_text(room, '\n'.join(lines) or 'No rules')
+            return
+        if args[0] == 'rule' and len(args) == 5 and args[1] == 'add':
+            bot.must_be_owner(event)
+            try:
+                self.rewriter.add(args[2], args[3], args[4])
+            except ValueError as e:
+                await bot.send_text(room, f'Invalid rule: {e}')
                 return
-            if args[0] == 'disable':
-                bot.must_be_admin(room, event)
-                self.enabled_rooms.remove(room.room_id)
-                await bot.send_text(room, "Ok, disabling conversion of twitter links to nitter links here")
-                bot.save_settings()
+            bot.save_settings()
+            await bot.send_text(room, f'Added rule {args[2]}, enable it in rooms with !nitter enable {args[2]}')
+            return
+        if args[0] == 'rule' and len(args) == 3 and args[1] == 'del':
+            bot.must_be_owner(event)
+            if not self.rewriter.remove(args[2]):
+                await bot.send_text(room, f'No rule named {args[2]}')
                 return
+            for room_id, names in self.rooms.items():
+                self.rooms[room_id] = [name for name in names if name != args[2]]
+            self.update_rooms()
+            bot.save_settings()
+            await bot.send_text(room, f'Deleted rule {args[2]}')
+            return
+        await bot.send_text(room, 'Unknown command - please see readme')
 
     def help(self):
-        return 'Converts Twitter links to nitter links.'
+        return 'Converts Twitter, YouTube, Reddit and Instagram links to privacy friendly front ends.'
 
     def get_settings(self):
         data = super().get_settings()
-        data["enabled_rooms"] = self.enabled_rooms
+        data["rooms"] = self.rooms
+        data["rules"] = self.rewriter.get_rules()
         return data
 
     def set_settings(self, data):
         super().set_settings(data)
-        if data.get("enabled_rooms"):
-            self.enabled_rooms = data["enabled_rooms"]
+        if data.get("rules") is not None:
+            self.rewriter = LinkRewriter(data["rules"])
+        if data.get("rooms") is not None:
+            self.rooms = data["rooms"]
+            self.update_rooms()
+        elif data.get("enabled_rooms"):
+            # Settings from before rewrite rules, when only twitter links were converted
+            self.rooms = {room_id: ['twitter'] for room_id in data["enabled_rooms"]}
+            self.update_rooms()
@@ -1,5 +1,4 @@
 import re
-import urllib.request
 
 from modules.common.module import BotModule
 
@@ -9,7 +8,7 @@ class MatrixModule(BotModule):
         args = event.body.split()
         if len(args) == 2 and len(args[1]) == 4:
             icao = args[1].upper()
-            notam = self.get_notam(icao)
+            notam = await self.get_notam(bot, icao)
             await bot.send_text(room, notam)
         else:
             await bot.send_text(room, 'Usage: !notam <icao code>')
@@ -18,7 +17,7 @@ class MatrixModule(BotModule):
         return ('NOTAM data access (usage: !notam <icao code>) - Currently Finnish airports only')
 
     # TODO: This handles only finnish airports. Implement support for other countries.
-    def get_notam(self, icao):
+    async def get_notam(self, bot, icao):
         if not icao.startswith('EF'):
             return ('Only Finnish airports supported currently, sorry.')
 
@@ -28,10 +27,9 @@ class MatrixModule(BotModule):
         else:
             notam_url = "https://www.ais.fi/ais/bulletins/envfrm.htm"
 
-        response = urllib.request.urlopen(notam_url)
-        lines = response.readlines()
-        lines = b''.join(lines)
-        lines = lines.decode("ISO-8859-1")
+        response = await bot.http.get(notam_url)
+        response.raise_for_status()
+        lines = response.content.decode("ISO-8859-1")
         # Strip EN-ROUTE from end
         lines = lines[0:lines.find('<a name="EN-ROUTE">')]
 
@@ -4,22 +4,19 @@ from typing import Optional
 import sys
 import traceback
 import cups
-import httpx
 import aiofiles
 import os
 
 # Credit: https://medium.com/swlh/how-to-boost-your-python-apps-using-httpx-and-asynchronous-calls-9cfe6f63d6ad
-async def download_file(url: str, filename: Optional[str] = None) -> str:
+async def download_file(http, url: str, filename: Optional[str] = None) -> str:
     filename = filename or url.split("/")[-1]
     filename = f"/tmp/{filename}"
-    client = httpx.AsyncClient()
-    async with client.stream("GET", url) as resp:
+    async with http.stream("GET", url) as resp:
         resp.raise_for_status()
         async with aiofiles.open(filename, "wb") as f:
             async for data in resp.aiter_bytes():
                 if data:
                     await f.write(data)
-    await client.aclose()
     return filename
 
 class MatrixModule(BotModule):
@@ -27,19 +24,18 @@ class MatrixModule(BotModule):
         super().__init__(name)
         self.printers = dict() # roomid <-> printername
         self.bot = None
+        self.subscription = None
         self.paper_size = 'A4' # Todo: configurable
         self.enabled = False
 
     async def file_cb(self, room, event):
         try:
-            if self.bot.should_ignore_event(event):
-                return
             if room.room_id in self.printers:
                 printer = self.printers[room.room_id]
                 self.logger.debug(f'RX file - MXC {event.url} - from {event.sender}')
                 https_url = await self.bot.client.mxc_to_http(event.url)
                 self.logger.debug(f'HTTPS URL {https_url}')
-                filename = await download_file(https_url)
+                filename = await download_file(self.bot.http, https_url)
                 self.logger.debug(f'RX filename {filename}')
                 conn = cups.Connection ()
                 conn.printFile(printer, filename, f"Printed from Matrix - {filename}", {'fit-to-page': 'TRUE', 'PageSize': self.paper_size})
@@ -54,14 +50,18 @@ class MatrixModule(BotModule):
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
-        bot.client.add_event_callback(self.file_cb, RoomMessageMedia)
         self.bot = bot
+        self.subscription = self.subscribe(bot, RoomMessageMedia, self.file_cb, rooms=self.printers.keys())
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.file_cb)
+        self.subscription = None
         self.bot = None
 
+    def update_rooms(self):
+        if self.subscription:
+            self.subscription.set_rooms(self.printers.keys())
+
     async def matrix_message(self, bot, room, event):
         bot.must_be_owner(event)
         args = event.body.split()
@@ -82,6 +82,7 @@ class MatrixModule(BotModule):
                 await bot.send_text(room, msg)
             elif args[0] == 'rmroomprinter':
                 del self.printers[room.room_id]
+                self.update_rooms()
                 await bot.send_text(room, f'Deleted printer from this room.')
                 bot.save_settings()
 
@@ -91,6 +92,7 @@ class MatrixModule(BotModule):
                 if printer in printers:
                     await bot.send_text(room, f'Printing with {printer} here.')
                     self.printers[room.room_id] = printer
+                    self.update_rooms()
                     bot.save_settings()
                 else:
                     await bot.send_text(room, f'No printer called {printer} in your CUPS.')
@@ -112,5 +114,6 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("printers"):
             self.printers = data["printers"]
+            self.update_rooms()
         if data.get("paper_size"):
             self.paper_size = data["paper_size"]
@@ -1,8 +1,4 @@
 from typing import Text
-import urllib
-import urllib.request
-from urllib.parse import urlencode, quote_plus
-import json
 import time 
 
 from modules.common.module import BotModule
@@ -11,14 +7,13 @@ class PeerTubeClient:
     def __init__(self):
         self.instance_url = 'https://sepiasearch.org/'
 
-    def search(self, search_string, count=0):
+    async def search(self, http, search_string, count=0):
         if count == 0:
             count = 15 # Pt default, could also remove from params..
-        params = urlencode({'search': search_string, 'count': count}, quote_via=quote_plus)
-        search_url = self.instance_url + 'api/v1/search/videos?' + params
-        response = urllib.request.urlopen(search_url)
-        data = json.loads(response.read().decode("utf-8"))
-        return data
+        search_url = self.instance_url + 'api/v1/search/videos'
+        response = await http.get(search_url, params={'search': search_string, 'count': count})
+        response.raise_for_status()
+        return response.json()
 
 class MatrixModule(BotModule):
     def __init__(self, name):
@@ -51,7 +46,7 @@ class MatrixModule(BotModule):
             count = 1
             if args[0] == '!ptall':
                 count = 0
-            data = p.search(query, count)
+            data = await p.search(bot.http, query, count)
             if len(data['data']) > 0:
                 for video in data['data']:
                     video_url = video.get("url") or self.instance_url + 'videos/watch/' + video["uuid"]
@@ -6,12 +6,14 @@ class MatrixModule(BotModule):
         super().__init__(name)
         self.bridges = dict()
         self.bot = None
+        self.subscription = None
         self.enabled = False
 
-    async def message_cb(self, room, event):
-        if self.bot.should_ignore_event(event):
-            return
+    def update_rooms(self):
+        if self.subscription:
+            self.subscription.set_rooms(list(self.bridges.keys()) + list(self.bridges.values()))
 
+    async def message_cb(self, room, event):
         if event.body.startswith('!'):
             return
 
@@ -40,12 +42,13 @@ class MatrixModule(BotModule):
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
-        bot.client.add_event_callback(self.message_cb, RoomMessageText)
         self.bot = bot
+        self.subscription = self.subscribe(bot, RoomMessageText, self.message_cb, rooms=[])
+        self.update_rooms()
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.message_cb)
+        self.subscription = None
         self.bot = None
 
     async def matrix_message(self, bot, room, event):
@@ -81,6 +84,7 @@ class MatrixModule(BotModule):
                 if room_to_bridge:
                     await bot.send_text(room, f'Bridging {room_to_bridge.display_name} here.')
                     self.bridges[room.room_id] = roomid
+                    self.update_rooms()
                     bot.save_settings()
                 else:
                     await bot.send_text(room, f'I am not on room with id {roomid} (note: use id, not alias)!')
@@ -90,6 +94,7 @@ class MatrixModule(BotModule):
                 for src_id, tgt_id in self.bridges.items():
                     if i == idx:
                         del self.bridges[src_id]
+                        self.update_rooms()
                         await bot.send_text(room, f'Unbridged {src_id} and {tgt_id}.')
                         bot.save_settings()
                         return
@@ -107,3 +112,4 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("bridges"):
             self.bridges = data["bridges"]
+            self.update_rooms()
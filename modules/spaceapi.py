@@ -1,6 +1,4 @@
 from modules.common.pollingservice import PollingService
-from urllib.request import urlopen
-import json
 import time
 
 class MatrixModule(PollingService):
@@ -12,7 +10,7 @@ class MatrixModule(PollingService):
 
     async def poll_implementation(self, bot, account, roomid, send_messages):
         self.logger.debug(f'polling space api {account}.')
-        spacename, is_open = MatrixModule.open_status(account)
+        spacename, is_open = await MatrixModule.open_status(bot.http, account)
 
         open_str = self.i18n['open'] if is_open else self.i18n['closed']
         text = self.template.format(spacename=spacename, open_closed=open_str)
@@ -25,9 +23,10 @@ class MatrixModule(PollingService):
             bot.save_settings()
 
     @staticmethod
-    def open_status(spaceurl):
-        with urlopen(spaceurl, timeout=5) as response:
-            js = json.load(response)
+    async def open_status(http, spaceurl):
+        response = await http.get(spaceurl, timeout=5)
+        response.raise_for_status()
+        js = response.json()
 
         return js['space'], js['state']['open']
 
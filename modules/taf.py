@@ -1,5 +1,3 @@
-import urllib.request
-
 from modules.common.module import BotModule
 
 
@@ -9,10 +7,11 @@ class MatrixModule(BotModule):
         if len(args) == 2:
             icao = args[1]
             taf_url = "https://aviationweather.gov/adds/dataserver_current/httpparam?dataSource=tafs&requestType=retrieve&format=csv&hoursBeforeNow=3&timeType=issue&mostRecent=true&stationString=" + icao.upper()
-            response = urllib.request.urlopen(taf_url)
-            lines = response.readlines()
+            response = await bot.http.get(taf_url)
+            response.raise_for_status()
+            lines = response.text.splitlines()
             if len(lines) > 6:
-                taf = lines[6].decode("utf-8").split(',')[0]
+                taf = lines[6].split(',')[0]
                 await bot.send_text(room, taf.strip())
             else:
                 await bot.send_text(room, 'Cannot find taf for ' + icao)
@@ -1,10 +1,6 @@
 import time
-import urllib.request
-import urllib.parse
-import urllib.error
 
 import aiohttp.web
-import requests
 import os
 import json
 import asyncio
@@ -14,9 +10,6 @@ from nio import MatrixRoom
 
 from modules.common.module import BotModule
 
-import nest_asyncio
-nest_asyncio.apply()
-
 rooms = dict()
 global_bot = None
 
@@ -35,7 +28,7 @@ async def send_entry(blob, content_type, fmt_params, rooms):
                                        msg_template_plain.format(**fmt_params))
 
 
-def get_image(img=None, width=1000, height=1500):
+async def get_image(img=None, width=1000, height=1500):
     """
     Return image data as array.
     Array contains the image content type and image binary
@@ -61,9 +54,8 @@ def get_image(img=None, width=1000, height=1500):
 
         headers = {'X-Plex-Token': pms_token}
 
-        session = requests.Session()
         try:
-            r = session.request("GET", uri, headers=headers)
+            r = await global_bot.http.get(uri, headers=headers)
             r.raise_for_status()
         except Exception:
             return None
@@ -75,11 +67,11 @@ def get_image(img=None, width=1000, height=1500):
             return response_content, response_headers['Content-Type']
 
 
-def get_from_entry(entry):
+async def get_from_entry(entry):
     blob = None
     content_type = ""
     if "art" in entry:
-        pms_image = get_image(entry["art"], 600, 300)
+        pms_image = await get_image(entry["art"], 600, 300)
         if pms_image:
             (blob, content_type) = pms_image
 
@@ -121,16 +113,21 @@ class WebServer:
         self.port = port
         self.app = web.Application()
         self.app.router.add_post('/notify', self.notify)
+        self.runner = None
 
     async def run(self):
         if not self.host or not self.port:
             return
 
-        loop = asyncio.get_event_loop()
-        runner = web.AppRunner(self.app)
-        loop.run_until_complete(runner.setup())
-        site = web.TCPSite(runner, host=self.host, port=self.port)
-        loop.run_until_complete(site.start())
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host=self.host, port=self.port)
+        await site.start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
 
     async def notify(self, request: web.Request) -> web.Response:
         try:
@@ -145,7 +142,7 @@ class WebServer:
                 data["directors"] = data["directors"].split(",")
 
             global rooms
-            (blob, content_type, fmt_params) = get_from_entry(data)
+            (blob, content_type, fmt_params) = await get_from_entry(data)
             await send_entry(blob, content_type, fmt_params, rooms)
 
         except Exception as exc:
@@ -168,11 +165,12 @@ class MatrixModule(BotModule):
         super().matrix_start(bot)
         global global_bot
         global_bot = bot
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.httpd.run())
 
-    def matrix_stop(self, bot):
-        super().matrix_stop(bot)
+    async def matrix_start_async(self, bot):
+        await self.httpd.run()
+
+    async def matrix_stop_async(self, bot):
+        await self.httpd.stop()
 
     async def matrix_message(self, bot, room, event):
         args = event.body.split()
@@ -189,20 +187,19 @@ class MatrixModule(BotModule):
                 return
 
             try:
-                url = "{}/api/v2?apikey={}&cmd=get_recently_added&count=10".format(os.getenv("TAUTULLI_URL"), self.api_key)
-                req = urllib.request.Request(url + "&media_type=" + media_type)
-                connection = urllib.request.urlopen(req).read()
-                entries = json.loads(connection)
+                url = "{}/api/v2".format(os.getenv("TAUTULLI_URL"))
+                response = await bot.http.get(url, params={'apikey': self.api_key, 'cmd': 'get_recently_added',
+                                                           'count': 10, 'media_type': media_type})
+                response.raise_for_status()
+                entries = response.json()
                 if "response" not in entries and "data" not in entries["response"] and "recently_added" not in entries["response"]["data"]:
                     await bot.send_text(room, "no recently added for %s" % media_type)
                     return
 
                 for entry in entries["response"]["data"]["recently_added"]:
-                    (blob, content_type, fmt_params) = get_from_entry(entry)
+                    (blob, content_type, fmt_params) = await get_from_entry(entry)
                     await send_entry(blob, content_type, fmt_params, {room.room_id: room})
 
-            except urllib.error.HTTPError as err:
-                raise ValueError(err.read())
             except Exception as exc:
                 message = str(exc)
                 await bot.send_text(room, message)
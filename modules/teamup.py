@@ -15,20 +15,43 @@ class MatrixModule(BotModule):
         self.api_key = None
         self.calendar_rooms = dict()  # Roomid -> [calid, calid..]
         self.calendars = dict()  # calid -> Calendar
+        self.calendars_outdated = False  # Calendars need to be set up again after settings change
         self.enabled = False
 
-    async def matrix_poll(self, bot, pollcount):
+    def matrix_start(self, bot):
+        super().matrix_start(bot)
+        self.add_job(bot, 'poll', lambda: self.poll(bot), interval=5 * 60, jitter=10)
+
+    async def matrix_start_async(self, bot):
+        await self.update_calendars(bot)
+
+    async def update_calendars(self, bot):
+        # Creating Calendar objects talks to teamup, so not done when settings are loaded
+        if self.calendars_outdated:
+            # Cleared before, so that changes made while setting up set it again
+            self.calendars_outdated = False
+            try:
+                # A copy, as commands can change calendar_rooms while the worker thread reads it
+                calendar_rooms = {roomid: list(calids) for roomid, calids in self.calendar_rooms.items()}
+                await bot.run_blocking(self.setup_calendars, calendar_rooms)
+            except Exception:
+                # Try again on next poll
+                self.calendars_outdated = True
+                raise
+
+    async def poll(self, bot):
         if self.api_key:
-            if pollcount % (6 * 5) == 0:  # Poll every 5 min
-                await self.poll_all_calendars(bot)
+            await self.update_calendars(bot)
+            await self.poll_all_calendars(bot)
 
     async def matrix_message(self, bot, room, event):
         args = event.body.split()
+        await self.update_calendars(bot)
         if len(args) == 1:
             if self.calendar_rooms.get(room.room_id):
                 for calendarid in self.calendar_rooms.get(room.room_id):
                     calendar = self.calendars[calendarid]
-                    events = calendar.get_event_collection()
+                    events = await bot.run_blocking(calendar.get_event_collection)
                     for event in events:
                         s = '<b>' + str(event.start_dt.day) + \
                             '.' + str(event.start_dt.month)
@@ -64,7 +87,8 @@ class MatrixModule(BotModule):
                 self.logger.info(f'Calendars now for this room {self.calendar_rooms.get(room.room_id)}')
 
                 bot.save_settings()
-                self.setup_calendars()
+                self.calendars_outdated = True
+                await self.update_calendars(bot)
                 await bot.send_text(room, 'Added new teamup calendar to this room')
             if args[1] == 'del':
                 bot.must_be_admin(room, event)
@@ -78,14 +102,16 @@ class MatrixModule(BotModule):
                 self.logger.info(f'Calendars now for this room {self.calendar_rooms.get(room.room_id)}')
 
                 bot.save_settings()
-                self.setup_calendars()
+                self.calendars_outdated = True
+                await self.update_calendars(bot)
                 await bot.send_text(room, 'Removed teamup calendar from this room')
             if args[1] == 'apikey':
                 bot.must_be_owner(event)
 
                 self.api_key = args[2]
                 bot.save_settings()
-                self.setup_calendars()
+                self.calendars_outdated = True
+                await self.update_calendars(bot)
                 await bot.send_text(room, 'Api key set')
 
     def help(self):
@@ -97,8 +123,8 @@ class MatrixModule(BotModule):
             if roomid in bot.client.rooms:
                 calendars = self.calendar_rooms[roomid]
                 for calendarid in calendars:
-                    events, timestamp = self.poll_server(
-                        self.calendars[calendarid])
+                    events, timestamp = await bot.run_blocking(self.poll_server,
+                                                               self.calendars[calendarid])
                     self.calendars[calendarid].timestamp = timestamp
                     for event in events:
                         await bot.send_text(bot.get_room_by_id(roomid), 'Calendar: ' + self.eventToString(event))
@@ -139,14 +165,15 @@ class MatrixModule(BotModule):
         s = s.replace('</p>', '\n')
         return s
 
-    def setup_calendars(self):
-        self.calendars = dict()
+    def setup_calendars(self, calendar_rooms):
+        # Runs in a worker thread, so calendars are replaced only when all are set up
+        calendars = dict()
         if self.api_key:
-            for roomid in self.calendar_rooms:
-                calendars = self.calendar_rooms[roomid]
-                for calid in calendars:
-                    self.calendars[calid] = Calendar(calid, self.api_key)
-                    self.calendars[calid].timestamp = int(time.time())
+            for roomid in calendar_rooms:
+                for calid in calendar_rooms[roomid]:
+                    calendars[calid] = Calendar(calid, self.api_key)
+                    calendars[calid].timestamp = int(time.time())
+        self.calendars = calendars
 
     def get_settings(self):
         data = super().get_settings()
@@ -162,4 +189,4 @@ class MatrixModule(BotModule):
             self.api_key = data['apikey']
         if self.api_key and len(self.api_key) == 0:
             self.api_key = None
-        self.setup_calendars()
+        self.calendars_outdated = True
@@ -1,14 +1,42 @@
+import asyncio
 import re
 import shlex
-from functools import lru_cache
+import urllib.parse
 
 import httpx
 import sys
 import traceback
-from bs4 import BeautifulSoup
 from nio import RoomMessageText
 
+from modules.common.domainrules import DomainRules, url_host
+from modules.common.exceptions import PreviewFailed, UploadFailed
+from modules.common.htmlmeta import HtmlMetaExtractor, parse_head
 from modules.common.module import BotModule
+from modules.common.urlpreview import Preview
+
+# Used until rules are changed with !url rule
+DEFAULT_RULES = {
+    'youtube.com': {'agent': 'curl/7.64.0', 'cookies': 'CONSENT=YES'},
+    'youtu.be': {'agent': 'curl/7.64.0', 'cookies': 'CONSENT=YES'},
+    'google.com': {'agent': 'curl/7.64.0', 'cookies': 'CONSENT=YES'},
+}
+
+
+def split_blacklist(blacklist):
+    """Split an old style blacklist of url substrings to domains, like www.youtube.com or
+    https://example.com/foo, and words that aren't host names, like youtube
+
+    :return: (list of domains, list of words)
+    """
+    domains = []
+    words = []
+    for entry in blacklist:
+        host = url_host(entry) if '://' in entry else entry.split('/')[0]
+        if host and '.' in host:
+            domains.append(host)
+        elif entry:
+            words.append(entry)
+    return domains, words
 
 
 class MatrixModule(BotModule):
@@ -22,6 +50,7 @@ class MatrixModule(BotModule):
         super().__init__(name)
 
         self.bot = None
+        self.subscription = None
         self.status = dict()  # room_id -> what to do with urls
         self.type = "m.notice"  # notice or text
         # this will be extended when matrix_start is called
@@ -32,17 +61,23 @@ class MatrixModule(BotModule):
             "TITLE": "Spamming this channel with titles",
             "DESCRIPTION": "Spamming this channel with descriptions",
             "BOTH": "Spamming this channel with both title and description",
+            "IMAGE": "Spamming this channel with titles and preview images",
         }
-        self.blacklist = [ ]
+        self.rules = DomainRules(DEFAULT_RULES)
+        self.blacklist_words = []  # URLs containing these are ignored, from blacklist entries that aren't domains
+        # maximum size to read of the response in bytes (this prevents us from reading stream forever)
+        self.maxsize = 800000
+        self.thumbnail_size = 480  # preview images are scaled to fit in this many pixels
+        self.image_tasks = set()  # previews images being uploaded and sent
         self.enabled = False
 
     def matrix_start(self, bot):
         """
-        Register callback for all RoomMessageText events on startup
+        Subscribe to RoomMessageText events in rooms with url handling on, on startup
         """
         super().matrix_start(bot)
         self.bot = bot
-        bot.client.add_event_callback(self.text_cb, RoomMessageText)
+        self.subscription = self.subscribe(bot, RoomMessageText, self.text_cb, rooms=self.active_rooms())
         # extend the useragent string to contain version and bot name
         self.useragent = f"Mozilla/5.0 (compatible; Hemppa/{self.bot.version}; {self.bot.client.user}; +https://github.com/vranki/hemppa/)"
         self.logger.debug(f"useragent: {self.useragent}")
@@ -50,30 +85,32 @@ class MatrixModule(BotModule):
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.text_cb)
+        self.subscription = None
+        for task in self.image_tasks:
+            task.cancel()
+
+    def active_rooms(self):
+        return [room_id for room_id, status in self.status.items() if status != "OFF"]
+
+    def update_rooms(self):
+        if self.subscription:
+            self.subscription.set_rooms(self.active_rooms())
 
     def user_agent_for_url(self, url):
-        if ('youtube.com' in url) or ('youtu.be' in url) or ('google.com' in url):
-            return 'curl/7.64.0'
-        return self.useragent
+        return self.rules.lookup_url(url).get('agent', self.useragent)
 
-    # Currently not used, but for future needs:
     def cookies_for_url(self, url):
-        if ('youtube.com' in url) or ('youtu.be' in url) or ('google.com' in url):
-            cookies = httpx.Cookies()
-            cookies.set('CONSENT', 'YES', domain='.youtube.com')
-            return cookies
-#            return {'CONSENT': 'YES', 'Domain': '.youtube.com', 
-#                'Path': '/', 'SameSite' : 'None', 'Expires': 'Sun, 10 Jan 2038 07:59:59 GMT', 'Max-Age': '946080000'}
-        return {}
+        """:return: value for Cookie header from the cookies rule of the url's domain, or None"""
+        cookies = self.rules.lookup_url(url).get('cookies')
+        if not cookies:
+            return None
+        # Sent as a header, as httpx deprecates cookies per request
+        return '; '.join(cookie.strip() for cookie in cookies.split(';') if cookie.strip())
 
     async def text_cb(self, room, event):
         """
-        Handle client callbacks for all room text events
+        Handle text events in rooms with url handling on
         """
-        if self.bot.should_ignore_event(event):
-            return
-
         # no content at all?
         if len(event.body) < 1:
             return
@@ -103,8 +140,8 @@ class MatrixModule(BotModule):
             if len(urls) == 0:
                 return
 
-            # fetch the urls and if we can see a title spit it out
-            for url in urls:
+            candidates = dict()  # url -> seconds to cache its preview, or None for default
+            for url in dict.fromkeys(urls):
                 # fix for #98 a bit ugly, but skip all matrix.to urls
                 # those are 99.99% pills and should not
                 # spam the channel with matrix.to titles
@@ -112,25 +149,29 @@ class MatrixModule(BotModule):
                     self.logger.debug(f"Skipping matrix.to url (#98): {url}")
                     continue
 
-                url_blacklisted = False
-                for blacklisted in self.blacklist:
-                    if blacklisted in url:
-                        url_blacklisted = True
-                if url_blacklisted:
+                policy = self.rules.lookup_url(url)
+                if policy.get('block') or any(word in url for word in self.blacklist_words):
                     self.logger.debug(f"Skipping blacklisted url {url}")
                     continue
-
-                try:
-                    title, description = self.get_content_from_url(url)
-                except Exception as e:
-                    self.logger.warning(f"could not fetch url: {e}")
-                    traceback.print_exc(file=sys.stderr)
+                if self.bot.url_previews.lookup(url) is None and not self.rules.allow_fetch(policy):
+                    self.logger.debug(f"Skipping url {url}, {policy.domain('rate')} fetched too often")
+                    continue
+                ttl = policy.get('ttl')
+                candidates[url] = ttl * 60 * 60 if ttl else None
+
+            # fetch the urls at the same time and if we can see a title spit it out
+            previews = await asyncio.gather(*[self.bot.url_previews.get(url, self.fetch_preview, ttl=ttl)
+                                              for url, ttl in candidates.items()])
+            for url, preview in zip(candidates, previews):
+                if preview.error:
                     # failed fetching, give up
                     continue
+                title = preview.title
+                description = preview.description
 
                 msg = ""
 
-                if status == "TITLE" and title is not None:
+                if status in ("TITLE", "IMAGE") and title is not None:
                     msg = f"Title: {title}"
                 elif status == "DESCRIPTION" and description is not None:
                     msg = f"Description: {description}"
@@ -145,86 +186,82 @@ class MatrixModule(BotModule):
 
                 if msg.strip(): # Evaluates to true on non-empty strings
                     await self.bot.send_text(room, msg, msgtype=self.type, bot_ignore=True)
+
+                if status == "IMAGE" and preview.image and not self.rules.lookup_url(preview.image).get('block'):
+                    # Downloading and scaling the image can take a while, don't keep the next messages waiting
+                    task = asyncio.get_running_loop().create_task(self.send_preview_image(room, url, preview))
+                    self.image_tasks.add(task)
+                    task.add_done_callback(self.image_tasks.discard)
         except Exception as e:
             self.logger.warning(f"Unexpected error in url module text_cb: {e}")
             traceback.print_exc(file=sys.stderr)
 
-    @lru_cache(maxsize=128)
-    def get_content_from_url(self, url):
+    async def send_preview_image(self, room, url, preview):
         """
-        Fetch url and try to get the title and description from the response
+        Send the og:image of a page scaled down, uploading it only once for all rooms
         """
-        title = None
-        description = None
-        # timeout will still handle network timeouts
-        timeout = httpx.Timeout(10.0)
-        responsetext = ""  # read our response here
         try:
-            self.logger.debug(f"start streaming {url}")
-            # stream the response so that we can set a upper limit on how much we want to fetch.
-            # as we are using stream the r.text wont be available, save our read data ourself
-
-            # maximum size to read of the response in characters (this prevents us from reading stream forever)
-            maxsize = 800000
-            headers = {
-                'user-agent': self.user_agent_for_url(url)
-            }
-            # Google may break things anytime so here are some things to try:
-            # If needed some day..  'Set-Cookie': "CONSENT=YES; Domain=.youtube.com; Path=/; SameSite=None; Secure; Expires=Sun, 10 Jan 2038 07:59:59 GMT; Max-Age=946080000"
-            # cookies = self.cookies_for_url(url)
-            # print('cookies', url, cookies)
-            # print('headers', headers)
-            with httpx.stream("GET", url, timeout=timeout, headers=headers) as r:
-                for part in r.iter_text():
-                    # self.logger.debug(
-                    #     f"reading response stream, limiting in {maxsize} bytes"
-                    # )
-
-                    responsetext += part
-                    maxsize -= len(part)
-
-                    if maxsize < 0:
-                        break
-
-            self.logger.debug(f"end streaming {url}")
+            matrix_uri, mimetype, w, h, size = await self.bot.upload_thumbnail(preview.image, self.thumbnail_size)
+        except UploadFailed:
+            self.logger.debug(f"Could not upload preview image {preview.image} of {url}")
+            return
         except Exception as e:
-            self.logger.warning(f"Failed fetching url {url}. Error: {e}")
-            return (title, description)
+            self.logger.warning(f"Unexpected error uploading preview image {preview.image}: {e}")
+            return
+        await self.bot.send_image(room, matrix_uri, preview.title or f"Image: {url}", None, mimetype, w, h, size)
 
-        if r.status_code != 200:
-            self.logger.warning(
-                f"Failed fetching url {url}. Status code: {r.status_code}"
-            )
-            return (title, description)
+    async def fetch_preview(self, url):
+        """
+        Fetch url and try to get the title and description from the response
 
-        # try parse and get the title
-        try:
-            soup = BeautifulSoup(responsetext, "html.parser")
+        Called by bot.url_previews, which caches the result.
 
-            if soup.title and len(soup.title.string) > 0:
-                title = soup.title.string
-            else:
-                title_tag = soup.find("meta", attrs={"name": "title"})
-                ogtitle = soup.find("meta", property="og:title")
-                if title_tag:
-                    title = title_tag.get("content", None)
-                elif ogtitle:
-                    title = ogtitle["content"]
-                elif soup.head and soup.head.title:
-                    title = soup.head.title.string.strip()
-            descr_tag = soup.find("meta", attrs={"name": "description"})
-            if descr_tag:
-                description = descr_tag.get("content", None)
-        except Exception as e:
-            self.logger.warning(f"Failed parsing response from url {url}. Error: {e}")
-            return (title, description)
+        :return: Preview
+        :raises: PreviewFailed or httpx.HTTPError if the url could not be fetched
+        """
+        # timeout will still handle network timeouts
+        timeout = httpx.Timeout(10.0)
+        self.logger.debug(f"start streaming {url}")
+        # stream the response so that we can stop reading at the end of <head>, where the
+        # title and description are, and set a upper limit on how much we want to fetch.
+
+        policy = self.rules.lookup_url(url)
+        maxsize = policy.get('maxbytes', self.maxsize)
+        headers = {
+            'user-agent': policy.get('agent', self.useragent)
+        }
+        # Google may break things anytime, the cookies rule of youtube.com and google.com accepts their consent page
+        cookies = self.cookies_for_url(url)
+        if cookies:
+            headers['cookie'] = cookies
+        async with self.bot.http.stream("GET", url, timeout=timeout, headers=headers) as r:
+            if r.status_code != 200:
+                raise PreviewFailed(f"Status code: {r.status_code}")
+            content_type = r.headers.get('content-type')
+            if content_type and 'html' not in content_type:
+                # Image, pdf or such, nothing to read
+                self.logger.debug(f"not reading {content_type} from {url}")
+                return Preview()
+            extractor = HtmlMetaExtractor(content_type)
+            async for part in r.aiter_bytes():
+                if extractor.feed(part) or extractor.bytes_read > maxsize:
+                    break
+
+        self.logger.debug(f"end streaming {url}, read {extractor.bytes_read} bytes")
+        meta = extractor.close()
+        image = urllib.parse.urljoin(url, meta.image) if meta.image else None
+        if image and not image.startswith(("https://", "http://")):
+            image = None
+        return Preview(meta.title, meta.description, image)
+
+    def parse_content(self, text):
+        """
+        Get the title and description from a html page
 
-        # Title should not contain newlines or tabs
-        if title is not None:
-            assert isinstance(title, str)
-            title = title.replace("\n", "")
-            title = title.replace("\t", "")
-        return (title, description)
+        :return: (title, description), either can be None
+        """
+        meta = parse_head(text)
+        return (meta.title, meta.description)
 
     async def matrix_message(self, bot, room, event):
         """
@@ -238,6 +275,7 @@ class MatrixModule(BotModule):
         # save the new status
         if len(args) == 1 and self.STATUSES.get(args[0].upper()) is not None:
             self.status[room.room_id] = args[0].upper()
+            self.update_rooms()
             bot.save_settings()
             await bot.send_text(
                 room, f"Ok, {self.STATUSES.get(self.status[room.room_id])}"
@@ -246,7 +284,10 @@ class MatrixModule(BotModule):
 
         # show status
         elif len(args) == 1 and args[0] == "status":
-            status = self.STATUSES.get(self.status.get(room.room_id, "OFF")) + f', URL blacklist: {self.blacklist}'
+            status = self.STATUSES.get(self.status.get(room.room_id, "OFF")) \
+                + f', URL blacklist: {self.blacklist()}, words in URL blacklist: {self.blacklist_words}' \
+                + f', {len(self.rules.rules)} domain rules' \
+                + f'\nPreview cache: {bot.url_previews.stats()}'
             await bot.send_text(
                 room, status
             )
@@ -271,12 +312,43 @@ class MatrixModule(BotModule):
         # set blacklist
         elif len(args) == 2 and args[0] == "blacklist":
             bot.must_be_owner(event)
-            if args[1] == 'clear':
-                self.blacklist = []
+            self.rules.remove_setting('block', True)
+            self.blacklist_words = []
+            if args[1] != 'clear':
+                self.set_blacklist(args[1].split(','))
+            bot.save_settings()
+            await bot.send_text(room, f"Blacklisted domains set to {self.blacklist()}, "
+                                      f"URLs containing words {self.blacklist_words}")
+            return
+
+        # show domain rules
+        elif len(args) == 1 and args[0] == "rules":
+            await bot.send_text(room, self.rules.describe() or "No domain rules")
+            return
+
+        # change domain rules
+        elif len(args) >= 2 and args[0] == "rule":
+            bot.must_be_owner(event)
+            domain = args[1]
+            if len(args) == 3 and args[2] == "clear":
+                removed = self.rules.remove(domain)
+            elif len(args) == 3:
+                removed = self.rules.remove(domain, args[2])
+            elif len(args) == 4:
+                try:
+                    self.rules.set(domain, args[2], args[3])
+                except ValueError as e:
+                    await bot.send_text(room, f"Invalid rule: {e}")
+                    return
+                removed = False
             else:
-                self.blacklist = args[1].split(',')
+                await bot.send_text(room, "Usage: !url rule <domain> <setting> [value] or !url rule <domain> clear")
+                return
+            if len(args) == 3 and not removed:
+                await bot.send_text(room, f"No such rule for {domain}")
+                return
             bot.save_settings()
-            await bot.send_text(room, f"Blacklisted URLs set to {self.blacklist}")
+            await bot.send_text(room, self.rules.describe() or "No domain rules")
             return
 
         # invalid command
@@ -291,17 +363,37 @@ class MatrixModule(BotModule):
         data = super().get_settings()
         data["status"] = self.status
         data["type"] = self.type
-        data["blacklist"] = self.blacklist
+        data["rules"] = self.rules.get_rules()
+        data["blacklist_words"] = self.blacklist_words
         return data
 
     def set_settings(self, data):
         super().set_settings(data)
         if data.get("status"):
             self.status = data["status"]
+            self.update_rooms()
         if data.get("type"):
             self.type = data["type"]
-        if data.get("blacklist"):
-            self.blacklist = data["blacklist"]
+        if data.get("rules") is not None:
+            self.rules.load(data["rules"])
+        elif data.get("blacklist"):
+            # Settings from before domain rules
+            self.set_blacklist(data["blacklist"])
+            self.logger.info(f"Converted URL blacklist {data['blacklist']} to domain rules {self.blacklist()} "
+                             f"and words {self.blacklist_words}")
+        if data.get("blacklist_words"):
+            self.blacklist_words = data["blacklist_words"]
+
+    def set_blacklist(self, blacklist):
+        """Block domains in blacklist, entries that aren't host names still block URLs containing them"""
+        domains, words = split_blacklist(blacklist)
+        for domain in domains:
+            self.rules.set(domain, 'block', True)
+        self.blacklist_words = words
+
+    def blacklist(self):
+        """:return: domains blocked by rules"""
+        return [domain for domain, settings in self.rules.rules.items() if settings.get('block')]
 
     def help(self):
         return "If I see a url in a message I will try to get the title from the page and spit it out"
@@ -1,10 +1,12 @@
 from modules.common.module import BotModule
 import fnmatch
+import re
 
 class MatrixModule(BotModule):
     def __init__(self, name):
         super().__init__(name)
         self.classes = dict() # classname <-> pattern
+        self.user_classes = dict() # mxid -> tuple of classnames matching it
 
     async def matrix_message(self, bot, room, event):
         args = event.body.split()
@@ -12,9 +14,6 @@ class MatrixModule(BotModule):
 
         if len(args) == 1:
             if args[0] == 'stats' or args[0] == 'roomstats':
-                stats = dict()
-                for name, pattern in self.classes.items():
-                    stats[name] = 0
                 if args[0] == 'stats':
                     allusers = self.get_users(bot)
                 else:
@@ -24,16 +23,7 @@ class MatrixModule(BotModule):
                     await bot.send_text(room, "I don't see any users. How did this happen?")
                     return
 
-                matched = 0
-                for user in allusers:
-                    for name, pattern in self.classes.items():
-                        match = fnmatch.fnmatch(user, pattern)
-                        if match:
-                            stats[name] = stats[name] + 1
-                            matched = matched + 1
-                
-                stats['Matrix'] = total - matched
-                stats = dict(sorted(stats.items(), key=lambda item: item[1], reverse=True))
+                stats = self.classify(allusers)
 
                 if args[0] == 'stats':
                     reply = f'I am seeing total {len(allusers)} users in {len(self.bot.client.rooms)} rooms:\n'
@@ -79,6 +69,7 @@ class MatrixModule(BotModule):
                     name = args[2]
                     pattern = args[3]
                     self.classes[name] = pattern
+                    self.user_classes.clear()
                     await bot.send_text(room, f'Added class {name} pattern {pattern}.')
                     bot.save_settings()
                     return
@@ -88,6 +79,7 @@ class MatrixModule(BotModule):
                     bot.must_be_owner(event)
                     name = args[2]
                     del self.classes[name]
+                    self.user_classes.clear()
                     await bot.send_text(room, f'Deleted class {name}.')
                     bot.save_settings()
                     return
@@ -95,21 +87,39 @@ class MatrixModule(BotModule):
         await bot.send_text(room, 'Unknown command - please see readme')
 
     def get_users(self, bot, roomid=None):
-        allusers = []
-        for croomid in self.bot.client.rooms:
-            if not roomid or (roomid == croomid):
-                try:
-                    users = self.bot.client.rooms[croomid].users
-                except (KeyError, ValueError) as e:
-                    self.logger.warning(f"Couldn't get user list in room with id {croomid}, skipping: {repr(e)}")
-                    continue
-                for user in users:
-                    allusers.append(user)
-        allusers = list(dict.fromkeys(allusers)) # Deduplicate
-        return allusers
+        return list(bot.membership.get_users(roomid))
+
+    def classify(self, users):
+        """Count users in each class, users not in any class are counted as Matrix
+
+        Classes of each user are cached until classes change.
+
+        :return: dict of class name -> number of users, largest first
+        """
+        stats = dict()
+        for name, pattern in self.classes.items():
+            stats[name] = 0
+
+        if len(self.user_classes) > 2 * len(users) + 10000:
+            # Drop users who are gone, keeping the ones asked about now
+            self.user_classes = {user: self.user_classes[user] for user in users if user in self.user_classes}
+
+        matchers = [(name, re.compile(fnmatch.translate(pattern)).match) for name, pattern in self.classes.items()]
+        matched = 0
+        for user in users:
+            names = self.user_classes.get(user)
+            if names is None:
+                names = tuple([name for name, match in matchers if match(user)])
+                self.user_classes[user] = names
+            for name in names:
+                stats[name] = stats[name] + 1
+            matched = matched + len(names)
+
+        stats['Matrix'] = len(users) - matched
+        return dict(sorted(stats.items(), key=lambda item: item[1], reverse=True))
 
     def search_users(self, bot, pattern):
-        allusers = self.get_users(self, bot)
+        allusers = self.get_users(bot)
         return fnmatch.filter(allusers, pattern)
 
     def help(self):
@@ -124,6 +134,7 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("classes"):
             self.classes = data["classes"]
+            self.user_classes.clear()
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
@@ -1,7 +1,5 @@
 import re
 
-import requests
-
 from modules.common.module import BotModule
 
 
@@ -17,7 +15,7 @@ class MatrixModule(BotModule):
         if len(args) > 1:
             query = event.body[len(args[0]) + 1:]
             try:
-                response = requests.get(self.api_url, params={
+                response = await bot.http.get(self.api_url, params={
                     'action': 'query',
                     'format': 'json',
                     'exintro': True,
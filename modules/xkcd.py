@@ -1,8 +1,6 @@
 import re
 import html
 
-import requests
-
 from modules.common.module import BotModule
 from modules.common.exceptions import UploadFailed
 
@@ -53,7 +51,7 @@ class MatrixModule(BotModule):
 
     async def send_xkcd(self, bot, room, uri):
         self.logger.debug(f"send request using uri {uri}")
-        response = requests.get(uri)
+        response = await bot.http.get(uri)
 
         if response.status_code != 200:
             self.logger.error("unable to request api. response: [status: %d text: %s]", response.status_code, response.text)
@@ -64,14 +62,9 @@ class MatrixModule(BotModule):
 
         img_url = xkcd.img
         try:
-            matrix_uri = None
-            matrix_uri, mimetype, w, h, size = bot.get_uri_cache(img_url)
-        except (TypeError, ValueError):
-            self.logger.debug(f"Not found in cache: {img_url}")
-            try:
-                matrix_uri, mimetype, w, h, size = await bot.upload_image(img_url)
-            except (UploadFailed, TypeError, ValueError):
-                await bot.send_text(room, f"Something went wrong uploading {img_url}.")
+            matrix_uri, mimetype, w, h, size = await bot.upload_image(img_url)
+        except (UploadFailed, TypeError, ValueError):
+            return await bot.send_text(room, f"Something went wrong uploading {img_url}.")
 
         await bot.send_html(room, f"<b>{html.escape(xkcd.title)} ({html.escape(str(xkcd.num))})</b>", f"{xkcd.title} ({str(xkcd.num)})")
         await bot.send_image(room, matrix_uri, img_url, None, mimetype, w, h, size)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""Minimal stand-in for a Matrix homeserver, for load testing the bot without network
+
+Implements just enough of the client-server API for the bot to run: sync (long polling),
+sending events, uploads, account data, filters, profiles, room members and state.
+Messages can be injected into rooms as if users had sent them, and everything the bot
+sends is recorded with the time it arrived.
+
+Run standalone to poke at it by hand:
+
+    python tools/fake_homeserver.py --port 8008 --rooms 3 --users 5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class FakeHomeserver:
+    def __init__(self, server_name='localhost', bot_user='@hemppa:localhost', access_token='fake-token'):
+        self.server_name = server_name
+        self.bot_user = bot_user
+        self.access_token = access_token
+        self.rooms = dict()  # room id -> {'members': [mxid], 'name': str}
+        self.timeline = []  # (sequence, room id, event)
+        self.sequence = 0
+        self.ids = itertools.count(1)
+        self.new_events = None
+        self.account_data = dict()  # type -> content
+        self.account_data_writes = 0
+        self.account_data_bytes = 0
+        self.uploads = dict()  # media id -> (content type, bytes)
+        self.sent = []  # (monotonic time, room id, event type, content)
+        self.send_listeners = []  # functions (room id, event type, content)
+        self.syncs = 0
+        self.sync_waiters = []  # (count, Future)
+        self.requests = defaultdict(int)  # route -> count
+        self.unknown = defaultdict(int)  # path -> count
+        self.runner = None
+        self.port = None
+        self.stopping = False
+
+    def new_id(self, sigil):
+        return f'{sigil}{next(self.ids)}:{self.server_name}'
+
+    def add_room(self, members, name=None):
+        """:return: id of a new room with the bot and given users joined"""
+        room_id = self.new_id('!')
+        self.rooms[room_id] = {'members': [self.bot_user] + [m for m in members if m != self.bot_user],
+                               'name': name or room_id}
+        return room_id
+
+    def inject(self, room_id, sender, body, msgtype='m.text'):
+        """Add a message to a room as if a user had sent it
+
+        :return: the event
+        """
+        return self.append(room_id, {'type': 'm.room.message', 'sender': sender,
+                                     'content': {'msgtype': msgtype, 'body': body}})
+
+    def append(self, room_id, event):
+        event = dict(event)
+        event.setdefault('event_id', self.new_id('$'))
+        event.setdefault('origin_server_ts', now_ms())
+        event.setdefault('unsigned', {'age': 0})
+        event['room_id'] = room_id
+        self.sequence += 1
+        self.timeline.append((self.sequence, room_id, event))
+        if self.new_events:
+            self.new_events.set()
+        return event
+
+    def wait_for_syncs(self, count):
+        """:return: Future done when the bot has started count sync requests"""
+        future = asyncio.get_running_loop().create_future()
+        if self.syncs >= count:
+            future.set_result(self.syncs)
+        else:
+            self.sync_waiters.append((count, future))
+        return future
+
+    def state_events(self, room_id):
+        room = self.rooms[room_id]
+        creator = room['members'][0]
+        events = [
+            {'type': 'm.room.create', 'state_key': '', 'sender': creator, 'content': {'creator': creator}},
+            {'type': 'm.room.name', 'state_key': '', 'sender': creator, 'content': {'name': room['name']}},
+            {'type': 'm.room.power_levels', 'state_key': '', 'sender': creator,
+             'content': {'users': {self.bot_user: 100}, 'users_default': 0, 'events_default': 0,
+                         'state_default': 50, 'ban': 50, 'kick': 50, 'redact': 50, 'invite': 0}},
+        ]
+        for member in room['members']:
+            events.append({'type': 'm.room.member', 'state_key': member, 'sender': member,
+                           'content': {'membership': 'join', 'displayname': member[1:].split(':')[0]}})
+        for event in events:
+            event.setdefault('event_id', self.new_id('$'))
+            event.setdefault('origin_server_ts', now_ms())
+            event['room_id'] = room_id
+        return events
+
+    # Request handling
+
+    def authorized(self, request):
+        header = request.headers.get('Authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else request.query.get('access_token')
+        return token == self.access_token
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else 'unknown'
+        self.requests[f'{request.method} {route}'] += 1
+        if request.path.startswith('/_matrix/client/') and not request.path.endswith('/versions') \
+                and not self.authorized(request):
+            return web.json_response({'errcode': 'M_UNKNOWN_TOKEN', 'error': 'Invalid access token'}, status=401)
+        return await handler(request)
+
+    async def handle_unknown(self, request):
+        self.unknown[f'{request.method} {request.path}'] += 1
+        return web.json_response({'errcode': 'M_UNRECOGNIZED', 'error': 'Not implemented in fake homeserver'},
+                                 status=404)
+
+    async def versions(self, request):
+        return web.json_response({'versions': ['r0.6.1', 'v1.1', 'v1.2', 'v1.3']})
+
+    async def whoami(self, request):
+        return web.json_response({'user_id': self.bot_user})
+
+    async def sync(self, request):
+        since = request.query.get('since')
+        timeout = int(request.query.get('timeout', '0')) / 1000
+        full_state = request.query.get('full_state') == 'true' or not since
+        after = int(since[1:]) if since and since.startswith('s') else 0
+        if not since:
+            after = self.sequence  # Initial sync has no timeline, just state
+
+        self.syncs += 1
+        for count, future in list(self.sync_waiters):
+            if self.syncs >= count:
+                self.sync_waiters.remove((count, future))
+                if not future.done():
+                    future.set_result(self.syncs)
+
+        deadline = time.monotonic() + timeout
+        while since and self.sequence <= after and time.monotonic() < deadline and not self.stopping:
+            self.new_events.clear()
+            try:
+                await asyncio.wait_for(self.new_events.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+
+        join = dict()
+        for room_id, room in self.rooms.items():
+            entry = {'timeline': {'events': [], 'limited': False, 'prev_batch': f's{after}'},
+                     'state': {'events': self.state_events(room_id) if full_state else []},
+                     'ephemeral': {'events': []},
+                     'account_data': {'events': []},
+                     'summary': {'m.joined_member_count': len(room['members']), 'm.invited_member_count': 0}}
+            join[room_id] = entry
+        for sequence, room_id, event in self.timeline:
+            if sequence > after and room_id in join:
+                join[room_id]['timeline']['events'].append(event)
+        if not full_state:
+            join = {room_id: entry for room_id, entry in join.items() if entry['timeline']['events']}
+
+        account_data = [{'type': data_type, 'content': content} for data_type, content in self.account_data.items()
+                        if data_type == 'm.direct'] if full_state else []
+        response = {'next_batch': f's{self.sequence}',
+                    'rooms': {'join': join, 'invite': {}, 'leave': {}},
+                    'account_data': {'events': account_data},
+                    'presence': {'events': []},
+                    'to_device': {'events': []},
+                    'device_lists': {'changed': [], 'left': []},
+                    'device_one_time_keys_count': {}}
+
+        return web.json_response(response)
+
+    async def upload_filter(self, request):
+        return web.json_response({'filter_id': str(next(self.ids))})
+
+    async def send(self, request):
+        room_id = request.match_info['room_id']
+        if room_id not in self.rooms:
+            return web.json_response({'errcode': 'M_FORBIDDEN', 'error': 'Not in room'}, status=403)
+        event_type = request.match_info['event_type']
+        content = await request.json()
+        self.sent.append((time.monotonic(), room_id, event_type, content))
+        for listener in self.send_listeners:
+            listener(room_id, event_type, content)
+        event = self.append(room_id, {'type': event_type, 'sender': self.bot_user, 'content': content})
+        return web.json_response({'event_id': event['event_id']})
+
+    async def put_state(self, request):
+        event = self.append(request.match_info['room_id'], {
+            'type': request.match_info['event_type'], 'state_key': request.match_info.get('state_key', ''),
+            'sender': self.bot_user, 'content': await request.json()})
+        return web.json_response({'event_id': event['event_id']})
+
+    async def room_state(self, request):
+        room_id = request.match_info['room_id']
+        if room_id not in self.rooms:
+            return web.json_response({'errcode': 'M_FORBIDDEN', 'error': 'Not in room'}, status=403)
+        return web.json_response(self.state_events(room_id))
+
+    async def joined_members(self, request):
+        room = self.rooms.get(request.match_info['room_id'])
+        if not room:
+            return web.json_response({'errcode': 'M_FORBIDDEN', 'error': 'Not in room'}, status=403)
+        return web.json_response({'joined': {member: {'display_name': member[1:].split(':')[0], 'avatar_url': None}
+                                             for member in room['members']}})
+
+    async def members(self, request):
+        room_id = request.match_info['room_id']
+        if room_id not in self.rooms:
+            return web.json_response({'errcode': 'M_FORBIDDEN', 'error': 'Not in room'}, status=403)
+        return web.json_response({'chunk': [event for event in self.state_events(room_id)
+                                            if event['type'] == 'm.room.member']})
+
+    async def get_event(self, request):
+        event_id = request.match_info['event_id']
+        for _, room_id, event in reversed(self.timeline):
+            if event['event_id'] == event_id:
+                return web.json_response(event)
+        return web.json_response({'errcode': 'M_NOT_FOUND', 'error': 'Event not found'}, status=404)
+
+    async def get_account_data(self, request):
+        content = self.account_data.get(request.match_info['data_type'])
+        if content is None:
+            return web.json_response({'errcode': 'M_NOT_FOUND', 'error': 'Account data not found'}, status=404)
+        return web.json_response(content)
+
+    async def put_account_data(self, request):
+        body = await request.read()
+        self.account_data_writes += 1
+        self.account_data_bytes += len(body)
+        self.account_data[request.match_info['data_type']] = json.loads(body)
+        return web.json_response({})
+
+    async def upload(self, request):
+        data = await request.read()
+        media_id = f'media{next(self.ids)}'
+        self.uploads[media_id] = (request.headers.get('Content-Type'), data)
+        return web.json_response({'content_uri': f'mxc://{self.server_name}/{media_id}'})
+
+    async def displayname(self, request):
+        user_id = request.match_info['user_id']
+        return web.json_response({'displayname': user_id[1:].split(':')[0]})
+
+    async def profile(self, request):
+        user_id = request.match_info['user_id']
+        return web.json_response({'displayname': user_id[1:].split(':')[0], 'avatar_url': None})
+
+    async def create_room(self, request):
+        data = await request.json()
+        room_id = self.add_room(data.get('invite', []), data.get('name'))
+        return web.json_response({'room_id': room_id})
+
+    async def join(self, request):
+        room_id = request.match_info['room_id']
+        if room_id not in self.rooms:
+            return web.json_response({'errcode': 'M_NOT_FOUND', 'error': 'No such room'}, status=404)
+        return web.json_response({'room_id': room_id})
+
+    async def leave(self, request):
+        self.rooms.pop(request.match_info['room_id'], None)
+        return web.json_response({})
+
+    async def typing(self, request):
+        return web.json_response({})
+
+    async def page(self, request):
+        """A web page for url previews, so tests don't need internet"""
+        name = request.match_info['name']
+        html = (f'<html><head><title>Page {name}</title>'
+                f'<meta name="description" content="Description of page {name}"></head>'
+                f'<body>{"<p>Filler text</p>" * 50}</body></html>')
+        return web.Response(text=html, content_type='text/html')
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware], client_max_size=100 * 1024 * 1024)
+        client = '/_matrix/client/{version}'
+        add = app.router.add_route
+        add('GET', '/_matrix/client/versions', self.versions)
+        add('GET', client + '/account/whoami', self.whoami)
+        add('GET', client + '/sync', self.sync)
+        add('POST', client + '/user/{user_id}/filter', self.upload_filter)
+        add('GET', client + '/user/{user_id}/account_data/{data_type}', self.get_account_data)
+        add('PUT', client + '/user/{user_id}/account_data/{data_type}', self.put_account_data)
+        add('PUT', client + '/rooms/{room_id}/send/{event_type}/{txn_id}', self.send)
+        add('PUT', client + '/rooms/{room_id}/state/{event_type}', self.put_state)
+        add('PUT', client + '/rooms/{room_id}/state/{event_type}/{state_key}', self.put_state)
+        add('GET', client + '/rooms/{room_id}/state', self.room_state)
+        add('GET', client + '/rooms/{room_id}/joined_members', self.joined_members)
+        add('GET', client + '/rooms/{room_id}/members', self.members)
+        add('GET', client + '/rooms/{room_id}/event/{event_id}', self.get_event)
+        add('PUT', client + '/rooms/{room_id}/typing/{user_id}', self.typing)
+        add('POST', client + '/rooms/{room_id}/join', self.join)
+        add('POST', client + '/join/{room_id}', self.join)
+        add('POST', client + '/rooms/{room_id}/leave', self.leave)
+        add('POST', client + '/createRoom', self.create_room)
+        add('GET', client + '/profile/{user_id}/displayname', self.displayname)
+        add('GET', client + '/profile/{user_id}', self.profile)
+        add('POST', '/_matrix/media/{version}/upload', self.upload)
+        add('GET', '/pages/{name}', self.page)
+        add('*', '/{path:.*}', self.handle_unknown)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start serving. With port 0 a free port is picked, see self.port.
+
+        :return: base url of the server
+        """
+        self.new_events = asyncio.Event()
+        self.stopping = False
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{self.port}'
+
+    async def stop(self):
+        if self.runner:
+            # Answer pending long-polling syncs now, cleanup() would wait for them to time out
+            self.stopping = True
+            self.new_events.set()
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--rooms', type=int, default=1, help='rooms to create')
+    parser.add_argument('--users', type=int, default=2, help='users in each room besides the bot')
+    parser.add_argument('--bot-user', default='@hemppa:localhost')
+    parser.add_argument('--access-token', default='fake-token')
+    args = parser.parse_args()
+
+    server = FakeHomeserver(bot_user=args.bot_user, access_token=args.access_token)
+    for _ in range(args.rooms):
+        server.add_room([f'@user{i}:localhost' for i in range(args.users)])
+    url = await server.start(args.host, args.port)
+    print(f'Fake homeserver running at {url}, rooms: {", ".join(server.rooms)}')
+    print(f'Run the bot with MATRIX_SERVER={url} MATRIX_USER={args.bot_user} '
+          f'MATRIX_ACCESS_TOKEN={args.access_token} BOT_OWNERS=@user0:localhost')
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""Load test the bot against a local fake homeserver
+
+Starts tools/fake_homeserver.py in process, runs a real Bot against it and injects
+synthetic traffic into N rooms from M users: commands (!echo), urls for the url module
+to preview (served by the fake homeserver, so no network is needed) and plain chatter.
+Reports commands per second, command-to-reply latency, memory growth and how much
+account data the bot wrote.
+
+Run from anywhere, for example:
+
+    python tools/loadtest.py --rooms 10 --users 50 --messages 2000 --rate 200 --mix commands=2,urls=1,chatter=7
+
+Exits with status 1 if some replies never arrived, so it can be used in CI.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_homeserver import FakeHomeserver  # noqa: E402
+
+BOT_USER = '@hemppa:localhost'
+ACCESS_TOKEN = 'loadtest-token'
+TOKEN_RE = re.compile(r'lt\d+')
+CHATTER = ['hello everyone', 'anyone up for lunch?', 'that build is broken again', 'lol',
+           'see you tomorrow', 'did you read the minutes from yesterday?', 'ok', 'thanks!']
+
+
+def parse_mix(text):
+    """:return: dict of kind -> weight from e.g. 'commands=1,urls=1,chatter=3'"""
+    mix = dict()
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('commands', 'urls', 'chatter'):
+            raise argparse.ArgumentTypeError(f'Unknown message kind {kind}')
+        mix[kind] = float(weight or 1)
+    if not sum(mix.values()) > 0:
+        raise argparse.ArgumentTypeError('Mix needs a positive weight')
+    return mix
+
+
+def rss_bytes():
+    """:return: current resident memory of this process, or peak where current is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.server = FakeHomeserver(bot_user=BOT_USER, access_token=ACCESS_TOKEN)
+        self.users = [f'@user{i}:localhost' for i in range(args.users)]
+        self.pending = dict()  # token -> (kind, monotonic time injected)
+        self.latencies = {'commands': [], 'urls': []}
+        self.sent_counts = {'commands': 0, 'urls': 0, 'chatter': 0}
+        self.replies_done = None
+        self.first_sent = None
+        self.last_reply = None
+        self.bot = None
+
+    def setup_rooms(self):
+        for _ in range(self.args.rooms):
+            size = self.args.room_size or len(self.users)
+            self.server.add_room(self.random.sample(self.users, min(size, len(self.users))))
+
+    def reply_received(self, room_id, event_type, content):
+        now = time.monotonic()
+        for token in TOKEN_RE.findall(content.get('body', '')):
+            entry = self.pending.pop(token, None)
+            if entry:
+                kind, sent = entry
+                self.latencies[kind].append(now - sent)
+                self.last_reply = now
+        if not self.pending and self.replies_done and not self.replies_done.done():
+            self.replies_done.set_result(True)
+
+    def message(self, number, base_url):
+        """:return: (kind, body, token or None)"""
+        mix = self.args.mix
+        kind = self.random.choices(list(mix), weights=list(mix.values()))[0]
+        token = f'lt{number:07d}'
+        if kind == 'commands':
+            return kind, f'!echo {token}', token
+        if kind == 'urls':
+            return kind, f'have a look at {base_url}/pages/{token}', token
+        return kind, self.random.choice(CHATTER), None
+
+    async def start_bot(self, base_url):
+        os.environ.update({
+            'MATRIX_SERVER': base_url,
+            'MATRIX_USER': BOT_USER,
+            'MATRIX_ACCESS_TOKEN': ACCESS_TOKEN,
+            'BOT_OWNERS': self.users[0],
+            'SYNC_TOKEN_FILE': '',
+            'SEND_RATE': str(self.args.send_rate),
+            'SEND_BURST': str(max(10, int(self.args.send_rate))),
+        })
+        os.chdir(ROOT)
+        from bot import Bot
+        # The url module is off by default, turn it on with titles in every room
+        self.server.account_data['org.vranki.hemppa.module.url'] = {
+            'enabled': True, 'status': {room_id: 'TITLE' for room_id in self.server.rooms}}
+        self.bot = Bot()
+        logging.root.setLevel(self.args.log_level)
+        for handler in logging.root.handlers:
+            handler.setLevel(self.args.log_level)
+        self.bot.init()
+        run_task = asyncio.get_running_loop().create_task(self.bot.run())
+        # Initial sync plus the first request of the sync loop, then callbacks are in place
+        ready = self.server.wait_for_syncs(2)
+        await asyncio.wait([ready, run_task], return_when=asyncio.FIRST_COMPLETED)
+        if run_task.done():
+            run_task.result()
+            raise RuntimeError('Bot stopped before it started syncing')
+        return run_task
+
+    async def stop_bot(self, run_task):
+        self.bot.scheduler.stop()
+        if getattr(self.bot, 'bot_task', None):
+            self.bot.bot_task.cancel()
+        await run_task
+        await self.bot.shutdown()
+
+    async def traffic(self, base_url):
+        rooms = list(self.server.rooms)
+        interval = 1 / self.args.rate if self.args.rate else 0
+        started = time.monotonic()
+        self.first_sent = started
+        for number in range(self.args.messages):
+            kind, body, token = self.message(number, base_url)
+            room_id = self.random.choice(rooms)
+            sender = self.random.choice(self.server.rooms[room_id]['members'][1:])
+            if token:
+                self.pending[token] = (kind, time.monotonic())
+            self.sent_counts[kind] += 1
+            self.server.inject(room_id, sender, body)
+            if interval:
+                delay = started + (number + 1) * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif number % 100 == 99:
+                await asyncio.sleep(0)
+
+    async def run(self):
+        self.setup_rooms()
+        base_url = await self.server.start()
+        self.server.send_listeners.append(self.reply_received)
+        run_task = await self.start_bot(base_url)
+        gc.collect()
+        rss_start = rss_bytes()
+        writes_start = self.server.account_data_writes
+        bytes_start = self.server.account_data_bytes
+
+        await self.traffic(base_url)
+        traffic_end = time.monotonic()
+        # Created only now, as pending can be empty for a moment while traffic is still coming
+        self.replies_done = asyncio.get_running_loop().create_future()
+        if self.pending:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.replies_done), self.args.timeout)
+            except asyncio.TimeoutError:
+                pass
+        gc.collect()
+        rss_end = rss_bytes()
+        writes_traffic = self.server.account_data_writes - writes_start
+        bytes_traffic = self.server.account_data_bytes - bytes_start
+
+        await self.stop_bot(run_task)
+        await self.server.stop()
+        return self.report(traffic_end, rss_start, rss_end, writes_traffic, bytes_traffic)
+
+    def report(self, traffic_end, rss_start, rss_end, writes_traffic, bytes_traffic):
+        answered = len(self.latencies['commands'])
+        elapsed = (self.last_reply or traffic_end) - self.first_sent
+        result = {
+            'rooms': self.args.rooms,
+            'users': self.args.users,
+            'messages': self.sent_counts,
+            'traffic_seconds': round(traffic_end - self.first_sent, 3),
+            'commands_per_second': round(answered / elapsed, 2) if elapsed > 0 else None,
+            'missing_replies': {kind: sum(1 for k, _ in self.pending.values() if k == kind)
+                                for kind in ('commands', 'urls')},
+            'rss_start_bytes': rss_start,
+            'rss_end_bytes': rss_end,
+            'rss_growth_bytes': rss_end - rss_start,
+            'account_data_writes': writes_traffic,
+            'account_data_bytes': bytes_traffic,
+            'account_data_writes_total': self.server.account_data_writes,
+            'account_data_bytes_total': self.server.account_data_bytes,
+            'events_sent_by_bot': len(self.server.sent),
+            'unknown_endpoints': dict(self.server.unknown),
+        }
+        for kind, latencies in self.latencies.items():
+            result[f'{kind}_latency'] = {
+                'count': len(latencies),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+                'max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+            }
+        return result
+
+
+def format_report(result):
+    mib = 1024 * 1024
+    lines = [
+        f"Rooms {result['rooms']}, users {result['users']}, sent "
+        + ', '.join(f'{count} {kind}' for kind, count in result['messages'].items())
+        + f" in {result['traffic_seconds']:.1f}s",
+        f"Commands per second: {result['commands_per_second']}",
+    ]
+    for kind in ('commands', 'urls'):
+        latency = result[f'{kind}_latency']
+        if latency['count']:
+            lines.append(f"{kind.capitalize()} reply latency: p50 {latency['p50_ms']} ms, "
+                         f"p99 {latency['p99_ms']} ms, max {latency['max_ms']} ms ({latency['count']} replies)")
+        if result['missing_replies'][kind]:
+            lines.append(f"Missing {kind} replies: {result['missing_replies'][kind]}")
+    lines.append(f"Memory: {result['rss_start_bytes'] / mib:.1f} MiB -> {result['rss_end_bytes'] / mib:.1f} MiB "
+                 f"({result['rss_growth_bytes'] / mib:+.1f} MiB)")
+    lines.append(f"Account data writes during traffic: {result['account_data_writes']} "
+                 f"({result['account_data_bytes']} bytes), in total {result['account_data_writes_total']} "
+                 f"({result['account_data_bytes_total']} bytes)")
+    if result['unknown_endpoints']:
+        lines.append('Endpoints not implemented by fake homeserver: '
+                     + ', '.join(f'{path} ({count})' for path, count in result['unknown_endpoints'].items()))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=5, help='number of rooms (default 5)')
+    parser.add_argument('--users', type=int, default=20, help='number of users (default 20)')
+    parser.add_argument('--room-size', type=int, default=0, help='users in each room, default all')
+    parser.add_argument('--messages', type=int, default=500, help='messages to send (default 500)')
+    parser.add_argument('--rate', type=float, default=100, help='messages per second, 0 for as fast as possible '
+                                                                '(default 100)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('commands=1,urls=1,chatter=3'),
+                        help='relative weights of message kinds (default commands=1,urls=1,chatter=3)')
+    parser.add_argument('--send-rate', type=float, default=1000, help="bot's SEND_RATE, messages per second "
+                                                                      "(default 1000)")
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for replies after sending')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+    if args.users < 1 or args.rooms < 1:
+        parser.error('Need at least one room and user')
+
+    result = asyncio.run(LoadTest(args).run())
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+    sys.exit(1 if any(result['missing_replies'].values()) else 0)
+
+
+if __name__ == '__main__':
+    main()
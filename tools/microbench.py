@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for CPU-bound code in the bot and modules
+
+Each benchmark is timed with timeit, taking the best of several repeats, and compared
+to the baselines stored in tools/microbench_baseline.json. Benchmarks more than
+--threshold slower than their baseline are flagged and make the exit status 1.
+Benchmarks whose module can't be imported (missing optional library) are skipped.
+
+    python tools/microbench.py                 # compare to baselines
+    python tools/microbench.py --save          # record new baselines after a deliberate change
+    python tools/microbench.py -k url --repeat 10
+
+Baselines depend on the machine, record them on the machine you compare on.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+BASELINE_FILE = os.path.join(ROOT, 'tools', 'microbench_baseline.json')
+
+BENCHMARKS = dict()  # name -> setup function returning the function to time
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def users(count, seed=1):
+    rng = random.Random(seed)
+    servers = ['matrix.org', 'hacklab.fi', 'example.com', 'kde.org', 'mozilla.org']
+    bridged = ['@_discord_{}:t2bot.io', '@telegram_{}:t2bot.io', '@irc_{}:libera.chat', '@_slack_{}:example.com']
+    result = []
+    for i in range(count):
+        if rng.random() < 0.3:
+            result.append(rng.choice(bridged).format(i))
+        else:
+            result.append(f'@user{i}:{rng.choice(servers)}')
+    return result
+
+
+def html_page(size):
+    """:return: html document of about size characters, with title and description in head"""
+    head = ('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">'
+            + ''.join(f'<link rel="stylesheet" href="/static/style{i}.css">' for i in range(20))
+            + '<script>' + 'var x = 1; ' * 500 + '</script>'
+            + '<title>A rather long article title | Example News</title>'
+            + '<meta name="description" content="What the article is about, in a sentence or two.">'
+            + '<meta property="og:title" content="A rather long article title"></head>')
+    paragraph = ('<div class="para"><p>Lorem ipsum <a href="/link">dolor</a> sit amet, <b>consectetur</b> '
+                 'adipiscing elit, sed do eiusmod tempor incididunt ut labore.</p></div>\n')
+    return head + '<body>' + paragraph * max(1, (size - len(head)) // len(paragraph)) + '</body></html>'
+
+
+@benchmark('bot.command_parse')
+def bench_command_parse():
+    from bot import Bot
+    bodies = ['!echo hello world', '!url title', 'just chatting about nothing in particular',
+              'see https://example.com/some/long/path?with=parameters', '!bot status', '! not a command',
+              'a much longer message ' * 50, '!loc Tampere, Finland']
+
+    def run():
+        for body in bodies:
+            if Bot.starts_with_command(body):
+                Bot.command_name(body)
+    return run
+
+
+@benchmark('bot.changed_settings_large')
+def bench_changed_settings():
+    from bot import Bot
+    from modules.common.moduleloader import UnloadedModule
+    bot = Bot()
+    rooms = [f'!room{i}:example.com' for i in range(2000)]
+    for i in range(40):
+        module = UnloadedModule(f'module{i}', f'module{i}.py', {'enabled': True, 'help': None})
+        module.set_settings({'enabled': True, 'rooms': {room: {'status': 'TITLE', 'last_room_users': users(20, i)}
+                                                        for room in rooms[:50 * (i % 5 + 1)]}})
+        bot.modules[module.name] = module
+    for i in range(1000):
+        bot.media_cache.put(f'hash{i}', [f'mxc://example.com/{i}', 'image/png', 640, 480, 12345],
+                            f'https://example.com/image{i}.png')
+    return bot.changed_settings
+
+
+@benchmark('url.parse_content_800k')
+def bench_url_parse():
+    from modules.url import MatrixModule
+    module = MatrixModule('url')
+    page = html_page(800000)
+    return lambda: module.parse_content(page)
+
+
+@benchmark('htmlmeta.stream_800k')
+def bench_htmlmeta_stream():
+    from modules.common.htmlmeta import HtmlMetaExtractor
+    page = html_page(800000).encode()
+    chunks = [page[i:i + 65536] for i in range(0, len(page), 65536)]
+
+    def run():
+        extractor = HtmlMetaExtractor('text/html; charset=utf-8')
+        for chunk in chunks:
+            if extractor.feed(chunk):
+                break
+        return extractor.close()
+    return run
+
+
+@benchmark('bs4.parse_800k')
+def bench_bs4_parse():
+    """What url previews did before modules.common.htmlmeta, for comparison"""
+    from bs4 import BeautifulSoup
+    page = html_page(800000)
+
+    def run():
+        soup = BeautifulSoup(page, 'html.parser')
+        return soup.title.string, soup.find('meta', attrs={'name': 'description'})
+    return run
+
+
+@benchmark('url.domain_rules_1000_urls')
+def bench_domain_rules():
+    from modules.url import MatrixModule
+    module = MatrixModule('url')
+    rng = random.Random(1)
+    domains = [f'{rng.choice(["www.", "", "news.", "m."])}site{i}.{rng.choice(["com", "org", "fi"])}'
+               for i in range(1000)]
+    module.set_settings({'blacklist': domains[::2]})
+    for domain in domains[1::10]:
+        module.rules.set(domain, 'ttl', 2)
+    urls = [f'https://{rng.choice(["", "cdn.", "a.b."])}{rng.choice(domains)}/path/{i}?q=1' for i in range(1000)]
+
+    def run():
+        for url in urls:
+            module.rules.lookup_url(url)
+    return run
+
+
+@benchmark('linkrewrite.1000_messages')
+def bench_link_rewrite():
+    from modules.common.linkrewrite import DEFAULT_RULES, LinkRewriter
+    rewriter = LinkRewriter(DEFAULT_RULES)
+    for i in range(20):
+        rewriter.add(f'custom{i}', rf'https?://(?:www\.)?site{i}\.example/(\S*)', rf'https://mirror{i}.example/\1')
+    rng = random.Random(1)
+    links = ['https://twitter.com/user/status/123?s=20', 'https://www.youtube.com/watch?v=abcdefghijk',
+             'https://old.reddit.com/r/python/comments/x', 'https://example.com/not/rewritten',
+             'https://site7.example/page']
+    messages = [' '.join(rng.choice(['just', 'some', 'chatter', 'here', rng.choice(links)]) for _ in range(15))
+                for _ in range(1000)]
+    names = list(rewriter.rules)
+
+    def run():
+        for message in messages:
+            rewriter.rewrite(message, names)
+    return run
+
+
+@benchmark('wa.parse_api_response')
+def bench_wa_parse():
+    from modules.wa import MatrixModule
+    module = MatrixModule('wa')
+    pods = []
+    for i in range(60):
+        pods.append({'@title': 'Result' if i == 5 else f'Pod {i}', '@primary': i == 5,
+                     'subpod': [{'@title': f'Subpod {j}', 'plaintext': f'line one {i} {j}\nline <two> & more'}
+                                for j in range(20)]})
+    response = {'pod': pods}
+    return lambda: module.parse_api_response(response)
+
+
+def flights(count):
+    rng = random.Random(1)
+    devices = [{'address': f'DD{i:04X}', 'registration': f'OH-{i:03d}', 'aircraft': 'LS-4',
+                'competition': f'{i:02d}', 'aircraft_type': 1} for i in range(200)]
+    log = [{'device': rng.randrange(len(devices)), 'start': f'{rng.randrange(8, 20)}h{rng.randrange(60):02d}',
+            'stop': f'{rng.randrange(8, 20)}h{rng.randrange(60):02d}' if rng.random() < 0.9 else None,
+            'duration': rng.randrange(300, 20000), 'max_alt': rng.randrange(300, 3000),
+            'towing': rng.random() < 0.3} for _ in range(count)]
+    return {'airfield': {'name': 'Test field', 'code': 'EFTEST'}, 'date': '2021-06-01', 'devices': devices,
+            'flights': log}
+
+
+@benchmark('flog.flight2string_2000')
+def bench_flight2string():
+    from modules.flog import FlightBook
+    book = FlightBook()
+    data = flights(2000)
+
+    def run():
+        for flight in data['flights']:
+            book.flight2string(flight, data)
+    return run
+
+
+@benchmark('flog.html_flog_2000')
+def bench_html_flog():
+    from modules.flog import MatrixModule
+    module = MatrixModule('flog')
+    data = flights(2000)
+    return lambda: module.html_flog(data, True)
+
+
+def users_module():
+    from modules.users import MatrixModule
+    module = MatrixModule('users')
+    module.classes = {'Discord': '@_discord_*:t2bot.io', 'Telegram': '@telegram_*:t2bot.io',
+                      'IRC': '@irc_*:libera.chat', 'Slack': '@_slack_*', 'Hacklab': '*:hacklab.fi'}
+    return module
+
+
+@benchmark('users.classify_10k')
+def bench_users_classify():
+    module = users_module()
+    all_users = users(10000)
+    return lambda: module.classify(all_users)
+
+
+@benchmark('users.classify_10k_uncached')
+def bench_users_classify_uncached():
+    module = users_module()
+    all_users = users(10000)
+
+    def run():
+        module.user_classes.clear()
+        module.classify(all_users)
+    return run
+
+
+def rooms(count, user_count, seed=1):
+    """Rooms as in client.rooms: most small, a few with thousands of users, from a pool of user_count users
+
+    :return: dict of room id -> MatrixRoom
+    """
+    from nio import MatrixRoom
+    rng = random.Random(seed)
+    pool = users(user_count, seed)
+    result = dict()
+    for i in range(count):
+        room = MatrixRoom(f'!room{i}:example.com', '@hemppa:example.com')
+        size = rng.choice([2, 2, 5, 10, 20, 50]) if i % 100 else 5000
+        for mxid in rng.sample(pool, min(size, len(pool))):
+            room.add_member(mxid, None, None)
+        result[room.room_id] = room
+    return result
+
+
+@benchmark('membership.rebuild_2000_rooms')
+def bench_membership_rebuild():
+    from modules.common.membership import MembershipIndex
+    index = MembershipIndex()
+    client_rooms = rooms(2000, 50000)
+    return lambda: index.rebuild(client_rooms)
+
+
+@benchmark('bot.stats_2000_rooms')
+def bench_bot_stats():
+    from types import SimpleNamespace
+
+    from modules.bot import MatrixModule
+    from modules.common.membership import MembershipIndex
+    client_rooms = rooms(2000, 50000)
+    bot = SimpleNamespace(client=SimpleNamespace(rooms=client_rooms), membership=MembershipIndex())
+    bot.membership.rebuild(client_rooms)
+    module = MatrixModule('bot')
+    return lambda: module.stats_text(bot)
+
+
+@benchmark('welcome_room.user_list_delta_10k')
+def bench_user_list_delta():
+    from modules.welcome_room import MatrixModule
+    module = MatrixModule('welcome_room')
+    previous = users(10000)
+    current = {user: None for user in previous[200:] + users(200, seed=2)}  # room.users is a dict
+    return lambda: module.get_user_list_delta(current, previous)
+
+
+def measure(func, repeat):
+    """:return: best time per call in seconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('µs', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def load_baselines(path):
+    try:
+        with open(path) as f:
+            return json.load(f).get('results', {})
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='filter', help='run only benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats, best is taken (default 5)')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='flag as regression when slower than baseline by this fraction (default 0.25)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save results as new baselines')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    logging.disable(logging.WARNING)
+    baselines = load_baselines(args.baseline)
+    results = dict()
+    skipped = dict()
+    regressions = []
+    rows = []
+    for name, setup in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        try:
+            func = setup()
+        except ImportError as e:
+            skipped[name] = str(e)
+            rows.append(f'{name:<36}{"skipped: " + str(e):>24}')
+            continue
+        seconds = measure(func, args.repeat)
+        results[name] = seconds
+        baseline = baselines.get(name)
+        if baseline:
+            change = seconds / baseline - 1
+            flag = ''
+            if change > args.threshold:
+                flag = '  REGRESSION'
+                regressions.append(name)
+            elif change < -args.threshold:
+                flag = '  faster'
+            rows.append(f'{name:<36}{format_time(seconds):>12}{format_time(baseline):>12}{change:>+9.1%}{flag}')
+        else:
+            rows.append(f'{name:<36}{format_time(seconds):>12}{"-":>12}')
+
+    if args.json:
+        print(json.dumps({'results': results, 'baselines': baselines, 'regressions': regressions,
+                          'skipped': skipped}, indent=2))
+    else:
+        print(f'{"Benchmark":<36}{"Time":>12}{"Baseline":>12}{"Change":>9}')
+        print('\n'.join(rows))
+
+    if args.save:
+        try:
+            with open(args.baseline) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = {}
+        saved['python'] = platform.python_version()
+        saved['machine'] = f'{platform.system()} {platform.machine()} {platform.processor()}'.strip()
+        saved.setdefault('results', {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Saved {len(results)} baselines to {args.baseline}', file=sys.stderr)
+    elif regressions:
+        print(f'{len(regressions)} benchmarks slower than baseline by over {args.threshold:.0%}: '
+              f'{", ".join(regressions)}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""Replay recorded Matrix events through the bot, offline
+
+Loads a real Bot with a client that never touches the network and feeds it room events
+from a JSONL file, one event per line as they appear in a sync response's timeline,
+with room_id added. Events go through the same callbacks as in a real sync: commands
+through message_cb, other events to module subscriptions. Everything the bot sends
+or writes to account data is captured in memory.
+
+Lines with "type": "hemppa.replay.http" are not events but canned HTTP responses
+for bot.http, for example for url title fetching:
+
+    {"type": "hemppa.replay.http", "url": "https://example.com/", "status": 200,
+     "headers": {"content-type": "text/html"}, "body": "<title>Example</title>"}
+
+Other HTTP requests get status 404, so replays are deterministic. By default each
+event is handled completely, including sending replies, before the next one; use
+--no-wait to replay as fast as the bot takes events in. Scheduled jobs don't run.
+
+    python tools/replay.py tools/replay_example.jsonl --settings '{"url": {"status": {"!room:localhost": "TITLE"}}}'
+    python tools/replay.py events.jsonl --output sent.jsonl --repeat 100
+"""
+import argparse
+import asyncio
+import collections.abc
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT_USER = '@hemppa:localhost'
+HTTP_TYPE = 'hemppa.replay.http'
+# Requests whose response has no content
+ACKNOWLEDGED = ('RoomTypingResponse', 'RoomReadMarkersResponse', 'RoomLeaveResponse', 'RoomForgetResponse')
+
+
+def load_lines(path):
+    """:return: (list of event dicts, dict of url -> canned response dict)"""
+    events = []
+    responses = dict()
+    with open(path, encoding='utf-8') if path != '-' else sys.stdin as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                raise SystemExit(f'{path}:{number}: {e}')
+            if data.get('type') == HTTP_TYPE:
+                responses[data['url']] = data
+            elif 'room_id' not in data:
+                raise SystemExit(f'{path}:{number}: event has no room_id')
+            else:
+                events.append(data)
+    return events, responses
+
+
+async def payload_size(data):
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    if isinstance(data, collections.abc.AsyncIterable):
+        return sum([len(chunk) async for chunk in data])
+    if isinstance(data, collections.abc.Iterable):
+        return sum(len(chunk) for chunk in data)
+    if hasattr(data, 'read'):
+        return len(data.read())
+    return 0
+
+
+def create_classes():
+    """Classes that need the bot's imports, created after changing to the bot directory"""
+    from nio import (AsyncClient, JoinedMembersResponse, ProfileGetAvatarResponse, ProfileGetDisplayNameResponse,
+                     RoomGetStateResponse, RoomSendResponse, UploadResponse)
+
+    from bot import Bot
+    from modules.common.httpclient import HttpClient
+
+    class ReplayClient(AsyncClient):
+        """AsyncClient answering requests itself, recording what was sent"""
+
+        def __init__(self, homeserver, user):
+            super().__init__(homeserver, user)
+            self.user_id = user
+            self.sent = []  # (index of replayed event, room id, event type, content)
+            self.requests = collections.Counter()  # response class name -> count
+            self.uploaded_bytes = 0
+            self.current_event = None
+            self.ids = 0
+
+        def new_id(self, prefix):
+            self.ids += 1
+            return f'{prefix}{self.ids}'
+
+        def response_json(self, response_class, path, body):
+            if response_class is RoomSendResponse:
+                return {'event_id': self.new_id('$sent')}
+            if response_class is UploadResponse:
+                return {'content_uri': f'mxc://localhost/{self.new_id("media")}'}
+            if response_class is JoinedMembersResponse:
+                room = self.rooms.get(urllib.parse.unquote(path.split('/rooms/')[1].split('/')[0]))
+                users = room.users if room else {}
+                return {'joined': {user_id: {'display_name': user.display_name, 'avatar_url': user.avatar_url}
+                                   for user_id, user in users.items()}}
+            if response_class is RoomGetStateResponse:
+                return []
+            if response_class is ProfileGetDisplayNameResponse:
+                user_id = urllib.parse.unquote(path.split('/profile/')[1].split('/')[0])
+                for room in self.rooms.values():
+                    if user_id in room.users:
+                        return {'displayname': room.users[user_id].display_name}
+                return {'displayname': user_id[1:].split(':')[0]}
+            if response_class is ProfileGetAvatarResponse:
+                return {}
+            if response_class.__name__ in ACKNOWLEDGED:
+                return {}
+            return {'errcode': 'M_UNRECOGNIZED', 'error': 'Not available in replay'}
+
+        async def _send(self, response_class, method, path, data=None, response_data=None, content_type=None,
+                        **kwargs):
+            self.requests[response_class.__name__] += 1
+            body = None
+            if response_class is UploadResponse:
+                self.uploaded_bytes += await payload_size(data)
+            elif isinstance(data, (str, bytes)) and data:
+                body = json.loads(data)
+            if response_class is RoomSendResponse:
+                parts = path.split('?')[0].split('/')
+                room_id = urllib.parse.unquote(parts[parts.index('rooms') + 1])
+                event_type = urllib.parse.unquote(parts[parts.index('send') + 1])
+                self.sent.append((self.current_event, room_id, event_type, body))
+            return response_class.from_dict(self.response_json(response_class, path, body), *(response_data or ()))
+
+    class ReplayHttpClient(HttpClient):
+        """bot.http answering from canned responses"""
+
+        def __init__(self, user_agent, responses):
+            self.responses = responses
+            self.fetched = collections.Counter()
+            super().__init__(user_agent)
+
+        def handle(self, request):
+            url = str(request.url)
+            self.fetched[url] += 1
+            canned = self.responses.get(url)
+            if not canned:
+                return httpx.Response(404, text='Not in replay file')
+            return httpx.Response(canned.get('status', 200), headers=canned.get('headers', {}),
+                                  content=canned.get('body', '').encode('utf-8'))
+
+        def create_client(self, verify):
+            return httpx.AsyncClient(transport=httpx.MockTransport(self.handle),
+                                     headers={'User-Agent': self.user_agent}, follow_redirects=True)
+
+    class ReplayBot(Bot):
+        """Bot with account data kept in memory"""
+
+        def __init__(self):
+            super().__init__()
+            self.account_data_store = dict()  # type -> json
+            self.account_data_writes_done = 0
+            self.account_data_bytes_written = 0
+
+        async def put_account_data(self, payload, data_type=None):
+            data_type = data_type or self.appid
+            self.account_data_store[data_type] = payload
+            self.account_data_writes_done += 1
+            self.account_data_bytes_written += len(payload)
+            self.account_data_writes.inc('ok')
+            self.account_data_bytes.inc(amount=len(payload))
+            return True
+
+        async def get_account_data(self, data_type=None):
+            payload = self.account_data_store.get(data_type or self.appid)
+            return json.loads(payload) if payload is not None else None
+
+    return ReplayBot, ReplayClient, ReplayHttpClient
+
+
+class Replay:
+    def __init__(self, args, events, responses):
+        self.args = args
+        self.events = events
+        self.responses = responses
+        self.bot = None
+        self.client = None
+
+    async def setup(self):
+        os.environ.update({
+            'MATRIX_SERVER': 'http://localhost',
+            'MATRIX_USER': self.args.user,
+            'MATRIX_ACCESS_TOKEN': 'replay',
+            'BOT_OWNERS': self.args.owners,
+            'SYNC_TOKEN_FILE': '',
+            'SEND_RATE': '1000000',
+            'SEND_BURST': '1000000',
+        })
+        os.chdir(ROOT)
+        ReplayBot, ReplayClient, ReplayHttpClient = create_classes()
+        bot = ReplayBot()
+        logging.root.setLevel(self.args.log_level)
+        for handler in logging.root.handlers:
+            handler.setLevel(self.args.log_level)
+        bot.init()
+        await bot.close()
+        self.client = ReplayClient(bot.client.homeserver, self.args.user)
+        self.client.access_token = 'replay'
+        bot.client = self.client
+        bot.http = ReplayHttpClient(bot.http.user_agent, self.responses)
+        # Recorded events are older than the bot, but should be handled
+        bot.start_timestamp = 0
+        for modulename, settings in json.loads(self.args.settings).items():
+            if modulename in bot.modules:
+                settings = dict(settings)
+                settings.setdefault('enabled', True)
+                bot.account_data_store[bot.settings_type(modulename)] = json.dumps(settings)
+            else:
+                raise SystemExit(f'No module {modulename} for settings')
+        self.bot = bot
+
+    def get_room(self, room_id):
+        from nio import MatrixRoom
+        room = self.client.rooms.get(room_id)
+        if not room:
+            room = MatrixRoom(room_id, self.client.user_id)
+            room.add_member(self.client.user_id, 'hemppa', None)
+            self.client.rooms[room_id] = room
+        return room
+
+    async def idle(self):
+        """Wait until commands, event handlers and sends started by events so far are done"""
+        bot = self.bot
+        while True:
+            await asyncio.sleep(0)
+            if bot.dispatcher.tasks or bot.events.tasks or bot.send_queue.rooms or bot.send_queue.busy_rooms:
+                await asyncio.sleep(0.001)
+                continue
+            return
+
+    async def replay_event(self, index, source):
+        from nio import Event, RoomMemberEvent
+        source = dict(source)
+        source.setdefault('event_id', f'$replay{index}')
+        source.setdefault('origin_server_ts', 1)
+        source.setdefault('unsigned', {})
+        room = self.get_room(source['room_id'])
+        event = Event.parse_event(source)
+        if event is None:
+            return
+        self.client.current_event = index
+        if isinstance(event, RoomMemberEvent):
+            room.handle_membership(event)
+            self.bot.membership.update_member(room, event.state_key)
+        elif 'state_key' in source:
+            room.handle_event(event)
+        for callback in self.client.event_callbacks:
+            if callback.filter is None or isinstance(event, callback.filter):
+                await callback.func(room, event)
+        if not self.args.no_wait:
+            await self.idle()
+
+    async def run(self):
+        await self.setup()
+        bot = self.bot
+        bot.send_queue.start()
+        for room_id in dict.fromkeys(event['room_id'] for event in self.events):
+            self.get_room(room_id)
+        bot.direct_rooms.rebuild(self.client.rooms)
+        bot.membership.rebuild(self.client.rooms)
+        settings = await bot.fetch_settings()
+        bot.load_settings(settings)
+        await bot.start()
+        bot.load_settings(settings)
+        bot.add_callbacks()
+
+        started = time.perf_counter()
+        count = 0
+        for _ in range(self.args.repeat):
+            for index, source in enumerate(self.events):
+                await self.replay_event(index, source)
+                count += 1
+        await self.idle()
+        elapsed = time.perf_counter() - started
+
+        bot.scheduler.stop()
+        await bot.stop()
+        await bot.send_queue.stop()
+        await bot.flush_settings()
+        await bot.http.aclose()
+        return count, elapsed
+
+    def module_timings(self):
+        """:return: dict of module -> [calls, seconds] for commands and event handlers"""
+        timings = dict()
+        for labels, (_, total, count) in self.bot.command_duration.values.items():
+            entry = timings.setdefault(labels[0], [0, 0.0, 0, 0.0])
+            entry[0] += count
+            entry[1] += total
+        for labels, (_, total, count) in self.bot.event_handler_duration.values.items():
+            entry = timings.setdefault(labels[0], [0, 0.0, 0, 0.0])
+            entry[2] += count
+            entry[3] += total
+        return timings
+
+    def write_output(self):
+        output = sys.stdout if self.args.output == '-' else open(self.args.output, 'w', encoding='utf-8')
+        try:
+            for index, room_id, event_type, content in self.client.sent:
+                output.write(json.dumps({'after': index, 'room_id': room_id, 'type': event_type,
+                                         'content': content}, sort_keys=True) + '\n')
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    def report(self, count, elapsed):
+        lines = [f'Replayed {count} events in {elapsed:.3f}s ({count / elapsed if elapsed else 0:.0f} events/s), '
+                 f'bot sent {len(self.client.sent)} events, uploaded {self.client.uploaded_bytes} bytes',
+                 f'Account data: {self.bot.account_data_writes_done} writes, '
+                 f'{self.bot.account_data_bytes_written} bytes',
+                 f'{"Module":<16}{"Commands":>10}{"ms":>10}{"ms/cmd":>9}{"Events":>10}{"ms":>10}{"ms/event":>10}']
+        timings = sorted(self.module_timings().items(), key=lambda item: -(item[1][1] + item[1][3]))
+        for module, (commands, command_time, events, event_time) in timings:
+            lines.append(f'{module:<16}{commands:>10}{command_time * 1000:>10.1f}'
+                         f'{command_time * 1000 / commands if commands else 0:>9.2f}'
+                         f'{events:>10}{event_time * 1000:>10.1f}{event_time * 1000 / events if events else 0:>10.2f}')
+        unanswered = [url for url, fetched in self.bot.http.fetched.items() if url not in self.responses]
+        if unanswered:
+            lines.append(f'HTTP requests without canned response: {", ".join(unanswered)}')
+        other = {name: count for name, count in self.client.requests.items()
+                 if name not in ('RoomSendResponse', 'UploadResponse')}
+        if other:
+            lines.append('Other matrix requests: ' + ', '.join(f'{name} ({count})' for name, count in other.items()))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('events', help='JSONL file of events, - for stdin')
+    parser.add_argument('--settings', default='{}',
+                        help='json object of module name -> module settings, modules listed are enabled')
+    parser.add_argument('--user', default=BOT_USER, help=f'mxid of the bot (default {BOT_USER})')
+    parser.add_argument('--owners', default='@owner:localhost', help='BOT_OWNERS (default @owner:localhost)')
+    parser.add_argument('--output', help='write events the bot sent to this file as JSONL, - for stdout')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the events this many times')
+    parser.add_argument('--no-wait', action='store_true',
+                        help="don't wait for each event to be handled before the next one")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    args.events = os.path.abspath(args.events) if args.events != '-' else args.events
+    if args.output and args.output != '-':
+        args.output = os.path.abspath(args.output)
+
+    events, responses = load_lines(args.events)
+    replay = Replay(args, events, responses)
+    count, elapsed = asyncio.run(replay.run())
+    if args.output:
+        replay.write_output()
+    print(replay.report(count, elapsed), file=sys.stderr if args.output == '-' else sys.stdout)
+
+
+if __name__ == '__main__':
+    main()